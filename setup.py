@@ -13,6 +13,7 @@ requires = [
     'psycopg2',
     'dogpile.cache',    # cache regions, lets you cache the result of queries
     'shapely',          # PostGIS-ish operations in python
+    'numpy',            # in-memory clustering strategy
     'transaction',
     'pyramid_tm',
     'pyramid_debugtoolbar',
@@ -37,10 +38,20 @@ setup(name='thesis',
       url='',
       keywords='web wsgi bfg pylons pyramid',
       packages=find_packages(),
+      # serve_green, which has to patch the standard library before thesis is imported
+      py_modules=['thesis_green'],
       include_package_data=True,
       zip_safe=False,
       test_suite='thesis',
       install_requires=requires,
+      extras_require={
+          # serve_green: non blocking queries from gevent greenlets
+          'green': ['gevent', 'psycogreen'],
+          # brotli compressed responses
+          'brotli': ['brotli'],
+          # a monotonic clock for the benchmarks (Python 2)
+          'benchmark': ['monotonic'],
+          },
       entry_points="""\
       [paste.app_factory]
       main = thesis:main
@@ -49,5 +60,9 @@ setup(name='thesis',
       destroy_db = thesis.scripts.destroy_db:main
       seed_db = thesis.scripts.seed_db:main
       test_scenario_one = thesis.scripts.test_scenario_one:main
+      pre_process_db = thesis.scripts.pre_process_db:main
+      manage_indexes = thesis.scripts.manage_indexes:main
+      serve_green = thesis_green:main
+      warm_cache = thesis.scripts.warm_cache:main
       """,
       )
@@ -1,11 +1,22 @@
+import logging
+import threading
+import transaction
+
 from pyramid.config import Configurator
+from pyramid.settings import asbool
 from sqlalchemy import engine_from_config
+from sqlalchemy.exc import DBAPIError
 
 from thesis.models import (
     DBSession,
     Base,
+    MappablePoint,
+    CachedGriddedAndBoundMappablePoint,
+    ViewportAccess,
     )
 
+from thesis.cache import configure_cluster_cache
+
 
 def main(global_config, **settings):
     """ This function returns a Pyramid WSGI application.
@@ -13,8 +24,47 @@ def main(global_config, **settings):
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
     Base.metadata.bind = engine
+    configure_cluster_cache(settings)
+    MappablePoint.STREAM_BATCH_SIZE = int(settings.get('thesis.stream_batch_size', MappablePoint.STREAM_BATCH_SIZE))
+
+    try:
+        with transaction.manager:
+            CachedGriddedAndBoundMappablePoint.load_cache_record_index()
+    except DBAPIError, e:
+        # e.g. the database isn't initialised yet, the index is loaded as it's used
+        logging.getLogger(__name__).warn("Couldn't load the cache record index: %s", e)
+
+    ViewportAccess.RECORD_ACCESSES = asbool(settings.get('thesis.record_viewport_accesses', False))
+
+    warm_top_n = int(settings.get('thesis.warm_cache.top_n', 0))
+    if warm_top_n:
+        # Warm the cluster cache in the background, so startup isn't held up
+        warmer = threading.Thread(
+            target=warm_cache,
+            args=(warm_top_n, int(settings.get('thesis.warm_cache.neighbours', 0))),
+            name='warm_cache',
+        )
+        warmer.daemon = True
+        warmer.start()
+
     config = Configurator(settings=settings)
     config.add_static_view('static', 'static', cache_max_age=3600)
     config.add_route('home', '/')
+    config.add_route('clusters', '/layers/{layer}/clusters')
+    config.add_route('bboxes_clusters', '/layers/{layer}/clusters/batch')
+    config.add_route('layers_clusters', '/clusters')
+    config.add_route('tile', '/layers/{layer}/tiles/{z}/{x}/{y}.{format}')
     config.scan()
     return config.make_wsgi_app()
+
+def warm_cache(top_n, neighbours=0):
+    """ Replay the most accessed viewports into the cluster cache (see
+        ViewportAccess.warm)
+    """
+    try:
+        with transaction.manager:
+            ViewportAccess.warm(top_n, neighbours)
+    except DBAPIError, e:
+        logging.getLogger(__name__).warn("Couldn't warm the cluster cache: %s", e)
+    finally:
+        DBSession.remove()
@@ -0,0 +1,107 @@
+""" Timing of the benchmark harness (the MappablePoint test_* methods).
+
+    Each call is timed with a monotonic clock, repeated after warmups, and
+    summarised as min/median/p95/p99/stddev, alongside the first (cold)
+    call, so that a change to a strategy can be judged on more than a single
+    noisy sample.
+"""
+import math
+import os
+import logging
+
+""" Whether the timer is monotonic (so unaffected by changes to the system
+    clock). Without it, the timings of a benchmark run can't be trusted.
+"""
+MONOTONIC = True
+
+try:
+    # Python 3.3+
+    from time import perf_counter as timer
+except ImportError:
+    try:
+        from monotonic import monotonic as timer
+    except ImportError:
+        # Wall clock time, with the best resolution of the platform
+        from timeit import default_timer as timer
+        MONOTONIC = False
+
+        logging.getLogger(__name__).warn(
+            "No monotonic clock, benchmarks are timed with the wall clock "
+            "(pip install thesis[benchmark] for the monotonic package)"
+        )
+
+""" The order of the summary stats """
+STATS = ['cold', 'iterations', 'min', 'median', 'mean', 'p95', 'p99', 'max', 'stddev']
+
+def percentile(samples, p):
+    """ The p'th percentile (0 to 100) of the samples, linearly interpolated
+        between the closest ranks. None if there are no samples.
+    """
+    if not samples:
+        return None
+
+    samples = sorted(samples)
+
+    rank = (len(samples) - 1) * p / 100.0
+    lower = int(math.floor(rank))
+    upper = int(math.ceil(rank))
+
+    return samples[lower] + (samples[upper] - samples[lower]) * (rank - lower)
+
+def summarise(samples, cold=None):
+    """ The summary stats (see STATS) of the timing samples, in seconds. The
+        stddev is the sample standard deviation.
+    """
+    n = len(samples)
+    mean = sum(samples) / float(n) if n else None
+    stddev = None
+    if n > 1:
+        stddev = math.sqrt(sum((sample - mean) ** 2 for sample in samples) / (n - 1))
+
+    return {
+        'cold': cold,
+        'iterations': n,
+        'min': min(samples) if n else None,
+        'median': percentile(samples, 50),
+        'mean': mean,
+        'p95': percentile(samples, 95),
+        'p99': percentile(samples, 99),
+        'max': max(samples) if n else None,
+        'stddev': stddev,
+    }
+
+def time_call(fn):
+    """ The (result, seconds) of a call of fn() """
+    start_t = timer()
+    result = fn()
+    return result, timer() - start_t
+
+def cpu_time():
+    """ The CPU time (user + system) of the process so far, in seconds """
+    times = os.times()
+    return times[0] + times[1]
+
+def time_cpu_call(fn):
+    """ The (result, CPU seconds, seconds) of a call of fn(). The CPU time is
+        the process's, so only meaningful if fn() does the work in process
+        (e.g. compressing, not waiting on the database).
+    """
+    start_cpu_t = cpu_time()
+    result, delta_t_s = time_call(fn)
+    return result, cpu_time() - start_cpu_t, delta_t_s
+
+def benchmark(fn, warmups, iterations):
+    """ Time the first (cold) call of fn(), then warmups calls that aren't
+        measured, and then iterations measured (warm) calls.
+
+        Returns the result of the cold call, and the summary stats of the warm
+        calls (see summarise) with the cold call's time.
+    """
+    result, cold = time_call(fn)
+
+    for i in range(warmups):
+        fn()
+
+    samples = [time_call(fn)[1] for i in range(iterations)]
+
+    return result, summarise(samples, cold)
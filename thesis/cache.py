@@ -0,0 +1,150 @@
+""" The cache region for rendered cluster responses.
+
+    Configured from the app settings prefixed with 'cache.clusters.' (see
+    development.ini). Until it's configured with a backend, nothing is cached.
+"""
+import logging
+import uuid
+import transaction
+
+from dogpile.cache import make_region
+from dogpile.cache.api import NO_VALUE
+from dogpile.cache.util import sha1_mangle_key
+
+from thesis.compression import compress
+
+""" The settings prefix of the cluster cache region """
+CLUSTER_CACHE_SETTINGS_PREFIX = 'cache.clusters.'
+
+cluster_region = make_region(key_mangler=sha1_mangle_key)
+
+""" The cache key of the generation of all cached responses """
+GENERATION_KEY = 'generation'
+
+""" The cache key of the generation of a layer's cached responses """
+LAYER_GENERATION_KEY = 'layer_generation:%s'
+
+# Called with the id of each layer invalidated (see add_invalidation_listener)
+invalidation_listeners = []
+
+def configure_cluster_cache(settings):
+    """ Configure the cluster cache region from the app settings.
+        Does nothing if there is no cache.clusters.backend setting.
+    """
+    log = logging.getLogger(__name__)
+
+    if (CLUSTER_CACHE_SETTINGS_PREFIX + 'backend') not in settings:
+        log.debug("No cluster cache backend configured")
+        return
+
+    cluster_region.configure_from_config(settings, CLUSTER_CACHE_SETTINGS_PREFIX)
+    log.info("Cluster cache backend: %s", settings[CLUSTER_CACHE_SETTINGS_PREFIX + 'backend'])
+
+def cluster_cache_enabled():
+    return cluster_region.is_configured
+
+def get_generations(layer_id):
+    """ The current generation of all cached responses, and of the layer's.
+        Invalidating bumps the generation, so the old keys are never hit again.
+    """
+    generations = cluster_region.get_multi(
+        [GENERATION_KEY, LAYER_GENERATION_KEY % layer_id],
+        ignore_expiration=True
+    )
+    return [generation if generation is not NO_VALUE else 0 for generation in generations]
+
+def cluster_cache_key(strategy, layer_id, format, bbox, grid_size):
+    """ The cache key of a rendered cluster response """
+    generation, layer_generation = get_generations(layer_id)
+
+    return "clusters:%s:%s:%s:%s:%s:%r:%r" % (
+        generation,
+        layer_id,
+        layer_generation,
+        strategy.__name__,
+        format,
+        grid_size,
+        bbox,
+    )
+
+def get_or_create_clusters_str(strategy, layer, format, creator, bbox=None, grid_size=None):
+    """ The rendered cluster response from the cache, or from creator() on a
+        miss. Concurrent misses on the same key only call creator once.
+
+        Takes the following params:
+            * strategy : The MappablePoint strategy class rendering the response
+            * layer : The layer
+            * format : The format of the response, e.g. geojson
+            * creator : Renders the response
+            * bbox, grid_size : The bbox and grid size that the response
+                                depends on (None if it doesn't)
+    """
+    if not cluster_cache_enabled():
+        return creator()
+
+    key = cluster_cache_key(strategy, layer.id, format, bbox, grid_size)
+    return cluster_region.get_or_create(key, creator)
+
+def get_or_create_encoded_clusters_str(strategy, layer, format, encoding, creator, bbox=None, grid_size=None):
+    """ The rendered cluster response compressed with the content encoding
+        (e.g. gzip), from the cache, or compressed from the cached (or
+        created) response on a miss. The compressed response is cached
+        alongside the response, so a hit is served without recompressing.
+
+        Takes the params of get_or_create_clusters_str, and:
+            * encoding : The content encoding (None for the response as is)
+    """
+    if encoding == None:
+        return get_or_create_clusters_str(strategy, layer, format, creator, bbox, grid_size)
+
+    compressed_creator = lambda: compress(
+        get_or_create_clusters_str(strategy, layer, format, creator, bbox, grid_size),
+        encoding
+    )
+
+    if not cluster_cache_enabled():
+        return compressed_creator()
+
+    key = cluster_cache_key(strategy, layer.id, '%s.%s' % (format, encoding), bbox, grid_size)
+    return cluster_region.get_or_create(key, compressed_creator)
+
+def add_invalidation_listener(listener):
+    """ Call listener(layer_id) whenever a layer is invalidated (see
+        invalidate_layer), and listener(None) when everything is (see
+        invalidate_all), e.g. to drop the in process copies of its points.
+        Listeners are called whether or not the cache is configured.
+    """
+    invalidation_listeners.append(listener)
+
+def invalidate_layer(layer_id):
+    """ Invalidate the layer's cached responses. Call when the layer's points
+        or cache records change.
+    """
+    for listener in invalidation_listeners:
+        listener(layer_id)
+
+    if cluster_cache_enabled():
+        cluster_region.set(LAYER_GENERATION_KEY % layer_id, uuid.uuid4().hex)
+
+def invalidate_layer_after_commit(layer_id):
+    """ Invalidate the layer's cached responses once the current transaction
+        commits (and not at all if it aborts). Call when the layer's points or
+        cache records are changed within a transaction.
+
+        Invalidating before the commit would let a request in between cache
+        the old rows under the new generation.
+    """
+    transaction.get().addAfterCommitHook(invalidate_layer_if_committed, (layer_id,))
+
+def invalidate_layer_if_committed(committed, layer_id):
+    """ The after commit hook of invalidate_layer_after_commit """
+    if committed:
+        invalidate_layer(layer_id)
+
+def invalidate_all():
+    """ Invalidate all cached responses """
+    for listener in invalidation_listeners:
+        listener(None)
+
+    if cluster_cache_enabled():
+        cluster_region.set(GENERATION_KEY, uuid.uuid4().hex)
@@ -0,0 +1,110 @@
+""" Content negotiated compression of cluster responses.
+
+    Responses are gzipped, or compressed with brotli if the brotli package is
+    installed and the client accepts it.
+"""
+import zlib
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+""" The zlib compression level of gzipped responses """
+GZIP_LEVEL = 6
+
+""" The brotli quality of brotli compressed responses (0 to 11) """
+BROTLI_QUALITY = 5
+
+def get_encodings():
+    """ The content encodings we can compress to, most preferred first """
+    if brotli != None:
+        return ['br', 'gzip']
+
+    return ['gzip']
+
+def parse_accept_encoding(header):
+    """ The {coding: qvalue} of an Accept-Encoding header """
+    codings = {}
+
+    for coding in header.split(','):
+        params = coding.strip().split(';')
+        name = params[0].strip().lower()
+        if not name:
+            continue
+
+        qvalue = 1.0
+        for param in params[1:]:
+            key, _, value = param.strip().partition('=')
+            if key.strip().lower() == 'q':
+                try:
+                    qvalue = float(value)
+                except ValueError:
+                    qvalue = 0.0
+
+        codings[name] = qvalue
+
+    return codings
+
+def negotiate_encoding(request):
+    """ The content encoding to compress the response to the request with.
+        Returns None if the client doesn't accept any of ours.
+    """
+    header = request.headers.get('Accept-Encoding')
+    if not header:
+        return None
+
+    codings = parse_accept_encoding(header)
+
+    for encoding in get_encodings():
+        if codings.get(encoding, codings.get('*', 0)) > 0:
+            return encoding
+
+    return None
+
+def get_compressor(encoding):
+    """ A streaming compressor for the encoding, with compress(data) and
+        flush() methods like zlib's
+    """
+    if encoding == 'gzip':
+        # 16 + MAX_WBITS writes a gzip header and trailer
+        return zlib.compressobj(GZIP_LEVEL, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    if encoding == 'br' and brotli != None:
+        return BrotliCompressor()
+
+    raise ValueError('Unsupported content encoding: %s' % encoding)
+
+class BrotliCompressor(object):
+    """ A brotli.Compressor with the zlib compressobj interface """
+
+    def __init__(self):
+        self.compressor = brotli.Compressor(quality=BROTLI_QUALITY)
+
+    def compress(self, data):
+        return self.compressor.process(data)
+
+    def flush(self):
+        return self.compressor.finish()
+
+def compress(body, encoding):
+    """ Compress a whole response body """
+    if isinstance(body, unicode):
+        body = body.encode('utf-8')
+
+    compressor = get_compressor(encoding)
+    return compressor.compress(body) + compressor.flush()
+
+def iter_compress(chunks, encoding):
+    """ Compress a streamed response body as it's generated """
+    compressor = get_compressor(encoding)
+
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+
+    yield compressor.flush()
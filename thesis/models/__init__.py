@@ -24,5 +24,9 @@ from thesis.models.bound_mappable_point import *
 from thesis.models.gridded_mappable_point import *
 from thesis.models.gridded_and_bound_mappable_point import *
 from thesis.models.cached_gridded_and_bound_mappable_point import *
+from thesis.models.in_memory_gridded_and_bound_mappable_point import *
+from thesis.models.tiled_cached_mappable_point import *
+from thesis.models.viewport_access import *
 
 
+from thesis.models.partitioning import *
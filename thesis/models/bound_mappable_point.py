@@ -64,16 +64,24 @@ class BoundMappablePoint(MappablePoint):
 
         return bbox
 
+    @classmethod
+    def get_cache_key_params(class_, bbox=[-180,-90,180,90], **kwargs):
+        return (list(bbox), None)
+
     @classmethod
     def get_points_as_geojson(class_, layer, bbox=[-180,-90,180,90], **kwargs):
         MappablePoint = class_
 
+        precision = class_.compute_coordinate_precision(bbox)
+
         q = DBSession.query(
 #            geo_func.ST_AsGeoJSON(
 #                ST_Collect(MappablePoint.location)
 #            ).label("locations"),
-            geo_func.ST_AsGeoJSON(
-                MappablePoint.location
+            class_.format_centroid(
+                geo_func.ST_AsGeoJSON,
+                MappablePoint.location,
+                precision
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).group_by(
@@ -90,12 +98,16 @@ class BoundMappablePoint(MappablePoint):
     def get_points_as_wkt(class_, layer, bbox=[-180,-90,180,90], **kwargs):
         MappablePoint = class_
 
+        precision = class_.compute_coordinate_precision(bbox)
+
         q = DBSession.query(
 #            geo_func.ST_AsText(
 #                ST_Collect(MappablePoint.location)
 #            ).label("locations"),
-            geo_func.ST_AsText(
-                MappablePoint.location
+            class_.format_centroid(
+                geo_func.ST_AsText,
+                MappablePoint.location,
+                precision
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).group_by(
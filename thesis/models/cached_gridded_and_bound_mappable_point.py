@@ -9,6 +9,9 @@ from thesis.models import (
     ST_MakeEnvelope,
     )
 import logging
+import datetime
+import time
+import transaction
 
 from sqlalchemy import (
     Column,
@@ -17,8 +20,15 @@ from sqlalchemy import (
     Text,
     Unicode,
     ForeignKey,
+    Index,
     )
 
+from sqlalchemy.sql import text
+
+from zope.sqlalchemy import mark_changed
+
+from thesis.cache import invalidate_layer_after_commit
+
 from sqlalchemy.sql import expression
 
 from sqlalchemy.ext.declarative import declarative_base
@@ -29,6 +39,7 @@ from sqlalchemy.orm import (
     relationship,
     backref,
     )
+from sqlalchemy.orm.query import Query
 
 from sqlalchemy import func as func
 
@@ -63,12 +74,29 @@ class CachedGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
         cache_record_id = Column(Integer, ForeignKey("cache_records.id"), nullable=False, index=True)
         cache_record = relationship("CacheRecord", backref=backref("cached_mappable_point_clusters", order_by=id, enable_typechecks=False))
 
+        # The layer of the cache record, so the clusters can be partitioned by layer
+        layer_id = Column(Integer, ForeignKey("layers.id"), nullable=False)
+
         cluster_size = Column(Integer, nullable=False)
         centroid = Column(Geometry(geometry_type='POINT', srid=DEFAULT_PROJECTION))
         # locations = Column(Geometry(geometry_type='MULTIPOINT', srid=DEFAULT_PROJECTION))
         # cluster_envelope = Column(Geometry(geometry_type='GEOMETRY', srid=DEFAULT_PROJECTION))
 
-        def __init__(self, cluster_size, centroid, projection=DEFAULT_PROJECTION): #locations, projection=DEFAULT_PROJECTION):
+        # The grid cell (the ST_SnapToGrid of the cluster's points) this cluster
+        # is for, and the sums of its points' coordinates. Together with the
+        # cluster_size these are mergeable, so the cluster can be updated as
+        # points are added to or removed from the layer.
+        cell_x = Column(Float)
+        cell_y = Column(Float)
+        sum_x = Column(Float)
+        sum_y = Column(Float)
+
+        __table_args__ = (
+            Index('ix_cached_mappable_point_cluster_cell', 'cache_record_id', 'cell_x', 'cell_y'),
+        )
+
+        def __init__(self, cluster_size, centroid, projection=DEFAULT_PROJECTION,
+                cell_x=None, cell_y=None, sum_x=None, sum_y=None, layer_id=None): #locations, projection=DEFAULT_PROJECTION):
             """ CachedMappablePointCluster constructor
 
                 Takes the following params:
@@ -76,15 +104,292 @@ class CachedGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
                     * centroid: A WKT description of the cluster's centroid
                     * locations: A WKT description of the cluster's locations
                     * projection : The EPSG projection as an integer
+                    * cell_x, cell_y: The grid cell the cluster is for
+                    * sum_x, sum_y: The sums of the cluster's point coordinates
+                    * layer_id: The layer of the cluster's cache record
             """
             self.cluster_size = cluster_size
             self.centroid = WKTElement(centroid, srid=projection)
 #            self.locations = WKTElement(locations, srid=projection)
+            self.cell_x = cell_x
+            self.cell_y = cell_y
+            self.sum_x = sum_x
+            self.sum_y = sum_y
+            self.layer_id = layer_id
+
+    class CacheBuildCluster(Base):
+        """ A cluster built by a (parallel) cache build, staged here until the
+            build commits its cache records.
+        """
+        __tablename__ = 'cache_build_clusters'
+        id = Column(Integer, primary_key=True)
+
+        build_id = Column(Text, nullable=False, index=True)
+        layer_id = Column(Integer, ForeignKey("layers.id"), nullable=False)
+        grid_size = Column(Float, nullable=False)
+
+        cluster_size = Column(Integer, nullable=False)
+        cell_x = Column(Float)
+        cell_y = Column(Float)
+        sum_x = Column(Float)
+        sum_y = Column(Float)
+
+    """ The ids of the cache records, by layer id, then by grid size. A layer's
+        entry is loaded on first use (or by load_cache_record_index at startup),
+        and forgotten once a transaction that rebuilds the layer's cache is
+        over, so it's reloaded from what was committed.
+    """
+    cache_record_index = {}
+
+    """ When the cache_record_index was last cleared """
+    cache_record_index_cleared_at = time.time()
+
+    """ The seconds until the cache_record_index is cleared, picking up caches
+        rebuilt by other processes
+    """
+    CACHE_RECORD_INDEX_MAX_AGE = 300
+
+    class CachedClustersQuery(Query):
+        """ A query of the clusters of an indexed cache record. If it comes
+            back empty and the cache record is stale (see
+            is_cache_record_stale), the rows of the fallback query (of the
+            layer's points) are returned instead.
+        """
+        strategy = None
+        layer = None
+        cache_record_id = None
+        fallback = None
+
+        def with_fallback(self, strategy, layer, cache_record_id, fallback):
+            """ fallback is called (with no arguments) for the query to use """
+            self.strategy = strategy
+            self.layer = layer
+            self.cache_record_id = cache_record_id
+            self.fallback = fallback
+            return self
+
+        def __iter__(self):
+            empty = True
+            for row in Query.__iter__(self):
+                empty = False
+                yield row
+
+            if empty and self.strategy.is_cache_record_stale(self.layer, self.cache_record_id):
+                for row in self.fallback():
+                    yield row
+
+        def all(self):
+            return list(self)
+
+    """ Whether pre_process computes the layer's own grid sizes (see
+        GriddedMappablePoint.compute_grid_sizes) before building its cache, by default
+    """
+    ADAPTIVE_GRID_SIZES = False
+
+    """ How pre_process builds the cache, by default. One of CACHE_GENERATION_MODES """
+    CACHE_GENERATION_MODE = 'per_level'
+
+    """ The clusters generate_cache_clusters inserts per statement """
+    CACHE_CLUSTER_INSERT_BATCH_SIZE = 10000
+
+    """ The cache generation modes, and the method implementing each """
+    CACHE_GENERATION_MODES = {
+        # One scan of the layer's points per grid size
+        'per_level': 'generate_cache_for_all_grid_size',
+        # One scan of the layer's points, rolled up level by level
+        'hierarchical': 'generate_cache_hierarchically',
+        # One INSERT ... SELECT per grid size, without leaving the database
+        'set_based': 'generate_cache_for_all_grid_size_in_db',
+    }
+
+    """ The cached clusters of a layer within each of a VALUES list of bboxes,
+        each from its own cache record, in one statement
+    """
+    BBOXES_CACHED_CLUSTERS_SQL = """
+        SELECT
+            bboxes.i AS i,
+            %(centroid_function)s(c.centroid, bboxes.precision) AS centroid,
+            c.cluster_size AS cluster_size
+        FROM (VALUES %(bboxes)s) AS bboxes (i, w, s, e, n, cache_record_id, precision)
+        JOIN cached_mappable_point_cluster AS c
+        ON c.cache_record_id = bboxes.cache_record_id
+        AND ST_Intersects(c.centroid, ST_MakeEnvelope(bboxes.w, bboxes.s, bboxes.e, bboxes.n, %(projection)i))
+        WHERE c.layer_id = :layer_id
+    """
+
+    """ The aggregates (grid cell, coordinate sums and count) of a layer's points
+        at a grid size. These are what a cached cluster is built from.
+    """
+    CACHE_CLUSTER_AGGREGATES_SQL = """
+        SELECT
+            ST_X(cell) AS cell_x,
+            ST_Y(cell) AS cell_y,
+            sum(ST_X(location)) AS sum_x,
+            sum(ST_Y(location)) AS sum_y,
+            count(location) AS cluster_size
+        FROM (
+            SELECT location, ST_SnapToGrid(location, :grid_size) AS cell
+            FROM mappable_points
+            WHERE layer_id = :layer_id
+        ) AS points
+        GROUP BY ST_X(cell), ST_Y(cell)
+    """
+
+    """ Materialise a cache record's clusters from the aggregates of its
+        layer's points, entirely within the database.
+    """
+    INSERT_CACHE_CLUSTERS_SQL = """
+        INSERT INTO cached_mappable_point_cluster
+            (cache_record_id, layer_id, cluster_size, centroid, cell_x, cell_y, sum_x, sum_y)
+        SELECT
+            :cache_record_id,
+            :layer_id,
+            cluster_size,
+            ST_SetSRID(ST_MakePoint(sum_x / cluster_size, sum_y / cluster_size), :projection),
+            cell_x, cell_y, sum_x, sum_y
+        FROM (%s) AS clusters
+    """ % CACHE_CLUSTER_AGGREGATES_SQL
+
+    """ Stage the clusters of a layer at a grid size for a cache build """
+    STAGE_CACHE_CLUSTERS_SQL = """
+        INSERT INTO cache_build_clusters
+            (build_id, layer_id, grid_size, cluster_size, cell_x, cell_y, sum_x, sum_y)
+        SELECT
+            :build_id, :layer_id, :grid_size,
+            cluster_size, cell_x, cell_y, sum_x, sum_y
+        FROM (%s) AS clusters
+    """ % CACHE_CLUSTER_AGGREGATES_SQL
+
+    """ Move the staged clusters of a layer at a grid size into a cache record """
+    COMMIT_STAGED_CACHE_CLUSTERS_SQL = """
+        INSERT INTO cached_mappable_point_cluster
+            (cache_record_id, layer_id, cluster_size, centroid, cell_x, cell_y, sum_x, sum_y)
+        SELECT
+            :cache_record_id,
+            :layer_id,
+            cluster_size,
+            ST_SetSRID(ST_MakePoint(sum_x / cluster_size, sum_y / cluster_size), :projection),
+            cell_x, cell_y, sum_x, sum_y
+        FROM cache_build_clusters
+        WHERE build_id = :build_id
+        AND layer_id = :layer_id
+        AND grid_size = :grid_size
+    """
+
+    """ The signed aggregates of a set of points, for every cache record of
+        their layer.
+    """
+    CACHE_CLUSTER_DELTAS_SQL = """
+        CREATE TEMPORARY TABLE cache_cluster_deltas AS
+        SELECT
+            cache_record_id,
+            CAST(:layer_id AS integer) AS layer_id,
+            ST_X(cell) AS cell_x,
+            ST_Y(cell) AS cell_y,
+            :sign * sum(ST_X(location)) AS sum_x,
+            :sign * sum(ST_Y(location)) AS sum_y,
+            :sign * count(location) AS cluster_size
+        FROM (
+            SELECT
+                cache_records.id AS cache_record_id,
+                mappable_points.location AS location,
+                ST_SnapToGrid(mappable_points.location, cache_records.grid_size) AS cell
+            FROM mappable_points, cache_records
+            WHERE mappable_points.id = ANY(:point_ids)
+            AND cache_records.layer_id = :layer_id
+        ) AS points
+        GROUP BY cache_record_id, ST_X(cell), ST_Y(cell)
+    """
+
+    """ Merge the cache_cluster_deltas into the cached clusters. Clusters left
+        with no points are deleted, and cells that had no cluster get one.
+    """
+    APPLY_CACHE_CLUSTER_DELTAS_SQL = [
+        """
+        DELETE FROM cached_mappable_point_cluster AS c
+        USING cache_cluster_deltas AS d
+        WHERE c.layer_id = d.layer_id
+        AND c.cache_record_id = d.cache_record_id
+        AND c.cell_x = d.cell_x AND c.cell_y = d.cell_y
+        AND c.cluster_size + d.cluster_size <= 0
+        """,
+        """
+        UPDATE cached_mappable_point_cluster AS c
+        SET
+            cluster_size = c.cluster_size + d.cluster_size,
+            sum_x = c.sum_x + d.sum_x,
+            sum_y = c.sum_y + d.sum_y,
+            centroid = ST_SetSRID(ST_MakePoint(
+                (c.sum_x + d.sum_x) / (c.cluster_size + d.cluster_size),
+                (c.sum_y + d.sum_y) / (c.cluster_size + d.cluster_size)
+            ), :projection)
+        FROM cache_cluster_deltas AS d
+        WHERE c.layer_id = d.layer_id
+        AND c.cache_record_id = d.cache_record_id
+        AND c.cell_x = d.cell_x AND c.cell_y = d.cell_y
+        """,
+        """
+        INSERT INTO cached_mappable_point_cluster
+            (cache_record_id, layer_id, cluster_size, centroid, cell_x, cell_y, sum_x, sum_y)
+        SELECT
+            d.cache_record_id,
+            d.layer_id,
+            d.cluster_size,
+            ST_SetSRID(ST_MakePoint(d.sum_x / d.cluster_size, d.sum_y / d.cluster_size), :projection),
+            d.cell_x, d.cell_y, d.sum_x, d.sum_y
+        FROM cache_cluster_deltas AS d
+        WHERE d.cluster_size > 0
+        AND NOT EXISTS (
+            SELECT 1 FROM cached_mappable_point_cluster AS c
+            WHERE c.layer_id = d.layer_id
+            AND c.cache_record_id = d.cache_record_id
+            AND c.cell_x = d.cell_x AND c.cell_y = d.cell_y
+        )
+        """,
+        """
+        DROP TABLE cache_cluster_deltas
+        """,
+    ]
 
     @classmethod
-    def pre_process(class_, layer, **kwargs):
-        """ Generate the cache for all normalised grid sizes"""
-        class_.generate_cache_for_all_grid_size(layer)
+    def pre_process(class_, layer, mode=None, verify=False, adaptive=None, **kwargs):
+        """ Generate the cache for all normalised grid sizes (the layer's own,
+            if it has them)
+
+            Takes the following params:
+                * mode: One of the CACHE_GENERATION_MODES (defaults to
+                        CACHE_GENERATION_MODE)
+                * adaptive: Compute the layer's grid sizes first (defaults to
+                            ADAPTIVE_GRID_SIZES)
+                * verify: Check the generated cache against the per level
+                          aggregates of the layer's points
+        """
+        if mode == None:
+            mode = class_.CACHE_GENERATION_MODE
+
+        if mode not in class_.CACHE_GENERATION_MODES:
+            raise ValueError("Unknown cache generation mode: %s" % mode)
+
+        if adaptive == None:
+            adaptive = class_.ADAPTIVE_GRID_SIZES
+
+        if adaptive:
+            class_.store_grid_sizes(layer, class_.compute_grid_sizes(layer))
+
+        getattr(class_, class_.CACHE_GENERATION_MODES[mode])(layer)
+        invalidate_layer_after_commit(layer.id)
+        class_.invalidate_cache_record_index_after_commit(layer)
+
+        if verify:
+            class_.verify_cache(layer)
+
+    @classmethod
+    def update_grid_sizes(class_, layer, **kwargs):
+        """ Compute and store the layer's grid sizes, and rebuild its cache at
+            them (see pre_process, which takes the same params)
+        """
+        class_.pre_process(layer, adaptive=True, **kwargs)
+        return layer.grid_sizes
 
     @classmethod
     def generate_cache_for_all_grid_size(class_, layer):
@@ -94,14 +399,285 @@ class CachedGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
         log = logging.getLogger(__name__)
         log.debug("Generating cache for all grid sizes")
 
-        for grid_size in class_.GRID_SIZES:
+        for grid_size in class_.get_grid_sizes(layer):
             class_.generate_cache_clusters(layer, grid_size)
             DBSession.flush()
 
         log.debug("Finished generating cache for all grid sizes")
 
+    @classmethod
+    def generate_cache_for_all_grid_size_in_db(class_, layer):
+        """ Generate the cache for all grid sizes, using a single
+            INSERT ... SELECT per grid size.
+        """
+        log = logging.getLogger(__name__)
+        log.debug("Generating cache in the database for all grid sizes")
+
+        for grid_size in class_.get_grid_sizes(layer):
+            class_.generate_cache_clusters_in_db(layer, grid_size)
+
+        log.debug("Finished generating cache in the database for all grid sizes")
+
+    @classmethod
+    def generate_cache_clusters_in_db(class_, layer, grid_size, projection=DEFAULT_PROJECTION):
+        """ Generate the cache clusters of a grid size with a single
+            INSERT ... SELECT ... GROUP BY ST_SnapToGrid(...). No clusters are
+            transferred to, or constructed in, python.
+
+            Returns the number of clusters generated, and the seconds it took.
+        """
+        log = logging.getLogger(__name__)
+
+        start_t = datetime.datetime.now()
+
+        cache_record = class_.CacheRecord(grid_size)
+        layer.cache_records.append(cache_record)
+        DBSession.flush()
+
+        result = DBSession.execute(text(class_.INSERT_CACHE_CLUSTERS_SQL), {
+            'cache_record_id': cache_record.id,
+            'layer_id': layer.id,
+            'grid_size': grid_size,
+            'projection': projection,
+        })
+        mark_changed(DBSession())
+
+        end_t = datetime.datetime.now()
+        delta_t = end_t - start_t
+        delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+
+        log.debug(
+            "Generated %i clusters in the database for grid size: %s, took: seconds: %f",
+            result.rowcount,
+            grid_size,
+            delta_t_s,
+        )
+
+        return result.rowcount, delta_t_s
+
+    @classmethod
+    def stage_cache_clusters(class_, connection, build_id, layer_id, grid_size):
+        """ Build the clusters of a layer at a grid size into the
+            cache_build_clusters staging table, using the given connection.
+
+            This is the unit of work of a parallel cache build. It only needs
+            ids, so it can run in a worker process with its own connection.
+
+            Returns the number of clusters staged.
+        """
+        result = connection.execute(text(class_.STAGE_CACHE_CLUSTERS_SQL), {
+            'build_id': build_id,
+            'layer_id': layer_id,
+            'grid_size': grid_size,
+        })
+        return result.rowcount
+
+    @classmethod
+    def commit_staged_cache(class_, layer, build_id, grid_sizes, replace=True, projection=DEFAULT_PROJECTION):
+        """ Create the layer's cache records from the clusters staged by a
+            cache build, and clear the build's staged clusters.
+
+            If replace is set, the layer's existing cache records are deleted
+            first. Run this within a single transaction for the switch over to
+            the new cache to be atomic.
+        """
+        log = logging.getLogger(__name__)
+
+        if replace:
+            class_.delete_cache(layer)
+
+        for grid_size in grid_sizes:
+            cache_record = class_.CacheRecord(grid_size)
+            layer.cache_records.append(cache_record)
+            DBSession.flush()
+
+            result = DBSession.execute(text(class_.COMMIT_STAGED_CACHE_CLUSTERS_SQL), {
+                'cache_record_id': cache_record.id,
+                'build_id': build_id,
+                'layer_id': layer.id,
+                'grid_size': grid_size,
+                'projection': projection,
+            })
+            log.debug("Committed %i staged clusters for layer %s grid size: %s", result.rowcount, layer.name, grid_size)
+
+        DBSession.query(class_.CacheBuildCluster).filter(
+            class_.CacheBuildCluster.build_id == build_id
+        ).filter(
+            class_.CacheBuildCluster.layer_id == layer.id
+        ).delete(synchronize_session=False)
+
+        mark_changed(DBSession())
+        invalidate_layer_after_commit(layer.id)
+        class_.invalidate_cache_record_index_after_commit(layer)
+
+    @classmethod
+    def delete_cache(class_, layer):
+        """ Delete all of the layer's cache records, and their clusters """
+        cache_record_ids = [cache_record.id for cache_record in layer.cache_records]
+
+        if cache_record_ids:
+            DBSession.query(class_.CachedMappablePointCluster).filter(
+                class_.CachedMappablePointCluster.cache_record_id.in_(cache_record_ids)
+            ).delete(synchronize_session=False)
+            DBSession.query(class_.CacheRecord).filter(
+                class_.CacheRecord.id.in_(cache_record_ids)
+            ).delete(synchronize_session=False)
+
+        mark_changed(DBSession())
+        invalidate_layer_after_commit(layer.id)
+        class_.invalidate_cache_record_index_after_commit(layer)
+        DBSession.expire(layer)
+
+    @classmethod
+    def generate_cache_hierarchically(class_, layer, projection=DEFAULT_PROJECTION):
+        """ Generate the cache for all grid sizes from a single scan of the
+            layer's points.
+
+            The scan groups the points by their cell at every grid size at
+            once (the common refinement of all the grids). Each level's clusters
+            are then aggregated from that table, finest level first, and the
+            table is rolled up to drop the level's cells before moving on to
+            the next level, so each pass works on fewer rows than the last.
+
+            Because every row carries its exact cell at all of the coarser
+            levels, the result is the same as building each level from the
+            raw points, even where the grids don't nest.
+        """
+        log = logging.getLogger(__name__)
+        log.debug("Generating cache hierarchically for all grid sizes")
+
+        grid_sizes = sorted(class_.get_grid_sizes(layer))
+        levels = range(len(grid_sizes))
+
+        cell_columns = lambda levels: ", ".join(
+            "cell_x_%i, cell_y_%i" % (level, level) for level in levels
+        )
+
+        params = { 'layer_id': layer.id }
+        for level in levels:
+            params['grid_size_%i' % level] = grid_sizes[level]
+
+        DBSession.execute(text("""
+            CREATE TEMPORARY TABLE cache_pyramid AS
+            SELECT
+                %s,
+                sum(ST_X(location)) AS sum_x,
+                sum(ST_Y(location)) AS sum_y,
+                count(location)::integer AS cluster_size
+            FROM (
+                SELECT location, %s
+                FROM mappable_points
+                WHERE layer_id = :layer_id
+            ) AS points
+            GROUP BY %s
+        """ % (
+            ", ".join(
+                "ST_X(cell_%i) AS cell_x_%i, ST_Y(cell_%i) AS cell_y_%i" % (level, level, level, level)
+                for level in levels
+            ),
+            ", ".join(
+                "ST_SnapToGrid(location, :grid_size_%i) AS cell_%i" % (level, level)
+                for level in levels
+            ),
+            ", ".join(
+                "ST_X(cell_%i), ST_Y(cell_%i)" % (level, level) for level in levels
+            ),
+        )), params)
+
+        for level in levels:
+            grid_size = grid_sizes[level]
+
+            cache_record = class_.CacheRecord(grid_size)
+            layer.cache_records.append(cache_record)
+            DBSession.flush()
+
+            result = DBSession.execute(text("""
+                INSERT INTO cached_mappable_point_cluster
+                    (cache_record_id, layer_id, cluster_size, centroid, cell_x, cell_y, sum_x, sum_y)
+                SELECT
+                    :cache_record_id,
+                    :layer_id,
+                    sum(cluster_size),
+                    ST_SetSRID(ST_MakePoint(
+                        sum(sum_x) / sum(cluster_size),
+                        sum(sum_y) / sum(cluster_size)
+                    ), :projection),
+                    cell_x_%i, cell_y_%i, sum(sum_x), sum(sum_y)
+                FROM cache_pyramid
+                GROUP BY cell_x_%i, cell_y_%i
+            """ % (level, level, level, level)), {
+                'cache_record_id': cache_record.id,
+                'layer_id': layer.id,
+                'projection': projection,
+            })
+
+            log.debug("Generated %i clusters for grid size: %s", result.rowcount, grid_size)
+
+            coarser_levels = levels[level + 1:]
+            DBSession.execute(text("DROP TABLE cache_pyramid" if not coarser_levels else """
+                CREATE TEMPORARY TABLE cache_pyramid_rollup AS
+                SELECT
+                    %s,
+                    sum(sum_x) AS sum_x,
+                    sum(sum_y) AS sum_y,
+                    sum(cluster_size)::integer AS cluster_size
+                FROM cache_pyramid
+                GROUP BY %s;
+
+                DROP TABLE cache_pyramid;
+                ALTER TABLE cache_pyramid_rollup RENAME TO cache_pyramid;
+            """ % (cell_columns(coarser_levels), cell_columns(coarser_levels))))
+
+        mark_changed(DBSession())
+        DBSession.expire(layer)
+
+        log.debug("Finished generating cache hierarchically for all grid sizes")
+
+    @classmethod
+    def verify_cache(class_, layer):
+        """ Compare each of the layer's cache records with the clusters a per
+            level build from the layer's points would produce.
+
+            Returns True if the number of clusters and the number of points
+            match at every grid size.
+        """
+        log = logging.getLogger(__name__)
+
+        verified = True
+        for cache_record in layer.cache_records:
+            cached = DBSession.query(
+                func.count(class_.CachedMappablePointCluster.id),
+                func.coalesce(func.sum(class_.CachedMappablePointCluster.cluster_size), 0),
+            ).filter(
+                class_.CachedMappablePointCluster.cache_record_id == cache_record.id
+            ).one()
+
+            expected = DBSession.execute(
+                text("SELECT count(*), coalesce(sum(cluster_size), 0) FROM (%s) AS clusters" % class_.CACHE_CLUSTER_AGGREGATES_SQL),
+                { 'layer_id': layer.id, 'grid_size': cache_record.grid_size }
+            ).fetchone()
+
+            if tuple(cached) != tuple(expected):
+                verified = False
+                log.warn(
+                    "Cache for layer %s grid size %s has (clusters, points): %s, expected: %s",
+                    layer.name,
+                    cache_record.grid_size,
+                    tuple(cached),
+                    tuple(expected),
+                )
+
+        log.info("(%s) verify_cache(%s) verified: %s", class_.__name__, layer.name, verified)
+
+        return verified
+
     @classmethod
     def generate_cache_clusters(class_, layer, grid_size):
+        """ Generate the layer's cache at the grid size, by streaming the
+            aggregates of its points and inserting the clusters in batches of
+            CACHE_CLUSTER_INSERT_BATCH_SIZE. The clusters aren't loaded into
+            the session, so memory use doesn't grow with the layer.
+        """
         log = logging.getLogger(__name__)
         log.debug("Generating cache for grid size: %s", grid_size)
 
@@ -109,23 +685,350 @@ class CachedGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
         layer.cache_records.append(cache_record)
         DBSession.flush()
 
-        clusters = GriddedAndBoundMappablePoint.get_points_as_wkt(layer, grid_size=grid_size)\
-                .filter(
-                    MappablePoint.layer_id == layer.id
-                )
+        # Stream the aggregates, rather than holding them all in memory
+        clusters = DBSession.execute(
+            text(class_.CACHE_CLUSTER_AGGREGATES_SQL).execution_options(stream_results=True),
+            { 'layer_id': layer.id, 'grid_size': grid_size }
+        )
+
+        insert = class_.CachedMappablePointCluster.__table__.insert()
 
         i = 0
+        batch = []
         for cluster in clusters:
             i += 1
-            centroid = cluster.centroid
             cluster_size = cluster.cluster_size
-#            locations = cluster.locations
-            cached_mappable_cluster = class_.CachedMappablePointCluster(cluster_size, centroid) #, locations)
-            cache_record.cached_mappable_point_clusters.append(cached_mappable_cluster)
-            if (i % 10000 == 0):
+            centroid = 'POINT(%r %r)' % (cluster.sum_x / cluster_size, cluster.sum_y / cluster_size)
+            batch.append({
+                'cache_record_id': cache_record.id,
+                'layer_id': layer.id,
+                'cluster_size': cluster_size,
+                'centroid': WKTElement(centroid, srid=DEFAULT_PROJECTION),
+                'cell_x': cluster.cell_x,
+                'cell_y': cluster.cell_y,
+                'sum_x': cluster.sum_x,
+                'sum_y': cluster.sum_y,
+            })
+
+            if len(batch) == class_.CACHE_CLUSTER_INSERT_BATCH_SIZE:
                 log.debug("Up to cluster: %i", i)
-                DBSession.flush()
+                DBSession.execute(insert, batch)
+                batch = []
+
+        if batch:
+            DBSession.execute(insert, batch)
+
+        mark_changed(DBSession())
+
+
+    @classmethod
+    def add_points(class_, layer, locations_wkt, projection=DEFAULT_PROJECTION):
+        """ Add points to the layer, updating the layer's cached clusters
+            in place.
+
+            Takes the following params:
+                * layer: The layer to add the points to
+                * locations_wkt: A list of WKT descriptions of the points
+                * projection : The EPSG projection as an integer
+
+            Returns the new mappable points.
+        """
+        mappable_points = [class_(location_wkt, projection) for location_wkt in locations_wkt]
+        layer.mappable_points.extend(mappable_points)
+        DBSession.flush()
+
+        class_.update_cache_clusters(layer, [p.id for p in mappable_points], 1, projection)
+
+        return mappable_points
+
+    @classmethod
+    def remove_points(class_, layer, mappable_points, projection=DEFAULT_PROJECTION):
+        """ Remove points from the layer, updating the layer's cached clusters
+            in place.
+        """
+        # The points need to still exist for us to calculate their deltas
+        class_.update_cache_clusters(layer, [p.id for p in mappable_points], -1, projection)
+
+        for mappable_point in mappable_points:
+            DBSession.delete(mappable_point)
+        DBSession.flush()
+
+        # layer.mappable_points is now out of date
+        DBSession.expire(layer)
+
+    @classmethod
+    def update_cache_clusters(class_, layer, point_ids, sign, projection=DEFAULT_PROJECTION):
+        """ Merge the given points into (sign=1), or out of (sign=-1), the
+            cached clusters of every cache record of the layer.
+
+            Only the grid cells containing the points are touched.
+        """
+        log = logging.getLogger(__name__)
+        log.debug("Updating cache clusters of layer %s for %i points", layer.name, len(point_ids))
+
+        if not point_ids:
+            return
 
+        DBSession.flush()
+
+        DBSession.execute(
+            text(class_.CACHE_CLUSTER_DELTAS_SQL),
+            { 'sign': sign, 'point_ids': list(point_ids), 'layer_id': layer.id }
+        )
+        for sql in class_.APPLY_CACHE_CLUSTER_DELTAS_SQL:
+            DBSession.execute(text(sql), { 'projection': projection })
+
+        mark_changed(DBSession())
+        invalidate_layer_after_commit(layer.id)
+
+        # Any cached clusters already loaded by the session are now out of date
+        DBSession.expire_all()
+
+    @classmethod
+    def load_cache_record_index(class_):
+        """ Load the cache record ids of all layers (e.g. at startup). If a
+            layer has more than one record for a grid size, the newest wins.
+        """
+        cache_record_index = {}
+
+        rows = DBSession.query(
+            class_.CacheRecord.layer_id,
+            class_.CacheRecord.grid_size,
+            class_.CacheRecord.id,
+        ).order_by(
+            class_.CacheRecord.id
+        ).all()
+
+        for layer_id, grid_size, cache_record_id in rows:
+            cache_record_index.setdefault(layer_id, {})[grid_size] = cache_record_id
+
+        # Swap the whole index in, for the sake of concurrent requests
+        class_.cache_record_index = cache_record_index
+        class_.cache_record_index_cleared_at = time.time()
+
+        return cache_record_index
+
+    @classmethod
+    def refresh_cache_record_index(class_, layer):
+        """ (Re)load the layer's cache record ids into the cache_record_index.
+            If the layer has more than one record for a grid size, the newest
+            wins.
+        """
+        rows = DBSession.query(
+            class_.CacheRecord.grid_size,
+            class_.CacheRecord.id,
+        ).filter(
+            class_.CacheRecord.layer_id == layer.id
+        ).order_by(
+            class_.CacheRecord.id
+        ).all()
+
+        layer_index = dict(rows)
+        class_.cache_record_index[layer.id] = layer_index
+
+        return layer_index
+
+    @classmethod
+    def invalidate_cache_record_index(class_, layer=None):
+        """ Forget the cache record ids of the layer (of all layers if no
+            layer is given). They'll be reloaded on the next request.
+        """
+        if layer == None:
+            class_.cache_record_index = {}
+            class_.cache_record_index_cleared_at = time.time()
+        else:
+            class_.cache_record_index.pop(layer.id, None)
+
+    @classmethod
+    def invalidate_cache_record_index_after_commit(class_, layer):
+        """ Forget the layer's cache record ids now, and again once the
+            current transaction is committed, so the ids this transaction
+            sees (or deleted) aren't served once it's over.
+        """
+        class_.invalidate_cache_record_index(layer)
+        transaction.get().addAfterCommitHook(class_.invalidate_layer_cache_record_index, (layer.id,))
+
+    @classmethod
+    def invalidate_layer_cache_record_index(class_, committed, layer_id):
+        """ The after commit hook of invalidate_cache_record_index_after_commit.
+            The ids are forgotten whether or not the commit succeeded.
+        """
+        class_.cache_record_index.pop(layer_id, None)
+
+    @classmethod
+    def is_cache_record_stale(class_, layer, cache_record_id):
+        """ Has the indexed cache record been deleted (e.g. the layer's cache
+            was rebuilt by another process, or by a transaction that aborted).
+            If it has, the layer's cache record ids are forgotten.
+        """
+        stale = DBSession.query(class_.CacheRecord.id).filter(
+            class_.CacheRecord.id == cache_record_id
+        ).first() == None
+
+        if stale:
+            class_.invalidate_cache_record_index(layer)
+
+        return stale
+
+    @classmethod
+    def get_cache_record_id(class_, layer, grid_size):
+        """ The id of the layer's cache record for the (normalised) grid size,
+            or None if there isn't one.
+        """
+        if time.time() - class_.cache_record_index_cleared_at > class_.CACHE_RECORD_INDEX_MAX_AGE:
+            class_.invalidate_cache_record_index()
+
+        layer_index = class_.cache_record_index.get(layer.id)
+        if layer_index == None:
+            layer_index = class_.refresh_cache_record_index(layer)
+
+        return layer_index.get(grid_size)
+
+    @classmethod
+    def get_cache_key_params(class_, layer=None, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        return (list(bbox), class_.normalise_grid_size(grid_size, layer))
+
+    @classmethod
+    def get_layers_points(class_, layers, format, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        """ The clusters of each of the layers, from a single query of their
+            cache records (see MappablePoint.get_layers_points).
+
+            Layers without a cache record at the grid size are clustered from
+            their points, grouped by their normalised grid size.
+        """
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        centroid_function = class_.CENTROID_FUNCTIONS[format]
+
+        cached_layers = []
+        cache_record_ids = []
+        cached_grid_sizes = []
+        uncached_layers = {}
+
+        for layer in layers:
+            normalised_grid_size = class_.normalise_grid_size(grid_size, layer)
+            cache_record_id = class_.get_cache_record_id(layer, normalised_grid_size)
+
+            if cache_record_id == None:
+                uncached_layers.setdefault(normalised_grid_size, []).append(layer)
+            else:
+                cached_layers.append(layer)
+                cache_record_ids.append(cache_record_id)
+                cached_grid_sizes.append(normalised_grid_size)
+
+        results = class_.group_rows_by_layer(layers, [])
+
+        if cached_layers:
+            # One query, so to the precision of the finest grid size
+            precision = class_.compute_coordinate_precision(bbox, min(cached_grid_sizes))
+
+            CachedMappablePointCluster = class_.CachedMappablePointCluster
+
+            q = DBSession.query(
+                CachedMappablePointCluster.layer_id.label('layer_id'),
+                class_.format_centroid(
+                    centroid_function,
+                    CachedMappablePointCluster.centroid,
+                    precision
+                ).label('centroid'),
+                CachedMappablePointCluster.cluster_size.label('cluster_size')
+            ).filter(
+                CachedMappablePointCluster.layer_id.in_([layer.id for layer in cached_layers])
+            ).filter(
+                CachedMappablePointCluster.cache_record_id.in_(cache_record_ids)
+            ).filter(
+                CachedMappablePointCluster.centroid.intersects(ST_MakeEnvelope(*bbox))
+            )
+
+            results.update(class_.group_rows_by_layer(cached_layers, q))
+
+            # Layers whose caches were rebuilt since their ids were indexed
+            for layer, cache_record_id, normalised_grid_size in zip(cached_layers, cache_record_ids, cached_grid_sizes):
+                if not results[layer.id] and class_.is_cache_record_stale(layer, cache_record_id):
+                    uncached_layers.setdefault(normalised_grid_size, []).append(layer)
+
+        for normalised_grid_size, grid_size_layers in uncached_layers.iteritems():
+            # The grid size isn't cached, cluster the points
+            results.update(GriddedAndBoundMappablePoint.get_layers_points(
+                grid_size_layers, format, bbox, normalised_grid_size
+            ))
+
+        return results
+
+    @classmethod
+    def query_bboxes_points(class_, layer, bboxes, format, grid_sizes, projection=DEFAULT_PROJECTION):
+        """ Query the layer's cached clusters within all of the bboxes in a
+            single statement (see MappablePoint.get_bboxes_points).
+
+            The bboxes whose grid sizes aren't cached are clustered from the
+            layer's points, in a second statement.
+        """
+        results = [[] for bbox in bboxes]
+
+        rows = []
+        cached = []
+        uncached = []
+
+        for i, (bbox, grid_size) in enumerate(zip(bboxes, grid_sizes)):
+            if grid_size == None:
+                grid_size = class_.get_cluster_grid_size(bbox)
+
+            normalised_grid_size = class_.normalise_grid_size(grid_size, layer)
+            cache_record_id = class_.get_cache_record_id(layer, normalised_grid_size)
+
+            if cache_record_id == None:
+                uncached.append((i, bbox, normalised_grid_size))
+                continue
+
+            precision = class_.compute_coordinate_precision(bbox, normalised_grid_size)
+            if precision == None:
+                precision = class_.MAX_COORDINATE_PRECISION
+
+            rows.append([i] + list(bbox) + [cache_record_id, precision])
+            cached.append((i, bbox, normalised_grid_size, cache_record_id))
+
+        if rows:
+            values_sql, params = class_.get_values_sql(
+                rows, ['integer', 'float8', 'float8', 'float8', 'float8', 'integer', 'integer']
+            )
+            params['layer_id'] = layer.id
+
+            sql = class_.BBOXES_CACHED_CLUSTERS_SQL % {
+                'centroid_function': class_.CENTROID_SQL_FUNCTIONS[format],
+                'bboxes': values_sql,
+                'projection': projection,
+            }
+
+            clusters = DBSession.execute(text(sql).execution_options(stream_results=True), params)
+            for cluster in clusters:
+                results[cluster.i].append(cluster)
+
+            # The cache may have been rebuilt since its ids were indexed
+            stale = {}
+            for i, bbox, normalised_grid_size, cache_record_id in cached:
+                if not results[i]:
+                    if cache_record_id not in stale:
+                        stale[cache_record_id] = class_.is_cache_record_stale(layer, cache_record_id)
+                    if stale[cache_record_id]:
+                        uncached.append((i, bbox, normalised_grid_size))
+
+        if uncached:
+            # The grid sizes aren't cached, cluster the points
+            uncached_results = GriddedAndBoundMappablePoint.query_bboxes_points(
+                layer,
+                [bbox for i, bbox, grid_size in uncached],
+                format,
+                [grid_size for i, bbox, grid_size in uncached],
+                projection
+            )
+            for (i, bbox, grid_size), clusters in zip(uncached, uncached_results):
+                results[i] = clusters
+
+        return results
 
     @classmethod
     def get_points_as_geojson(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
@@ -134,23 +1037,35 @@ class CachedGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
         if grid_size == None:
             grid_size = class_.get_cluster_grid_size(bbox)
 
-        # Normalise our grid size to one of the standard grid sizes
-        normalised_grid_size = class_.normalise_grid_size(grid_size)
+        # Normalise our grid size to one of the layer's grid sizes
+        normalised_grid_size = class_.normalise_grid_size(grid_size, layer)
+
+        cache_record_id = class_.get_cache_record_id(layer, normalised_grid_size)
+        if cache_record_id == None:
+            # The grid size isn't cached, cluster the points
+            return GriddedAndBoundMappablePoint.get_points_as_geojson(layer, bbox, normalised_grid_size)
 
-        cache_record = next(cache_record for cache_record in layer.cache_records if cache_record.grid_size == normalised_grid_size)
+        precision = class_.compute_coordinate_precision(bbox, normalised_grid_size)
 
-        q = DBSession.query(
+        q = class_.CachedClustersQuery([
 #            geo_func.ST_AsGeoJSON(
 #                class_.CachedMappablePointCluster.locations
 #            ).label("locations"),
-            geo_func.ST_AsGeoJSON(
-                class_.CachedMappablePointCluster.centroid
+            class_.format_centroid(
+                geo_func.ST_AsGeoJSON,
+                class_.CachedMappablePointCluster.centroid,
+                precision
             ).label("centroid"),
             class_.CachedMappablePointCluster.cluster_size.label("cluster_size")
+        ], DBSession()).filter(
+            class_.CachedMappablePointCluster.layer_id == layer.id
         ).filter(
-            class_.CachedMappablePointCluster.cache_record_id == cache_record.id
+            class_.CachedMappablePointCluster.cache_record_id == cache_record_id
         ).filter(
             class_.CachedMappablePointCluster.centroid.intersects(ST_MakeEnvelope(*bbox))
+        ).with_fallback(
+            class_, layer, cache_record_id,
+            lambda: GriddedAndBoundMappablePoint.get_points_as_geojson(layer, bbox, normalised_grid_size)
         )
 
         return q
@@ -162,30 +1077,45 @@ class CachedGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
         if grid_size == None:
             grid_size = class_.get_cluster_grid_size(bbox)
 
-        # Normalise our grid size to one of the standard grid sizes
-        normalised_grid_size = class_.normalise_grid_size(grid_size)
+        # Normalise our grid size to one of the layer's grid sizes
+        normalised_grid_size = class_.normalise_grid_size(grid_size, layer)
+
+        cache_record_id = class_.get_cache_record_id(layer, normalised_grid_size)
+        if cache_record_id == None:
+            # The grid size isn't cached, cluster the points
+            return GriddedAndBoundMappablePoint.get_points_as_wkt(layer, bbox, normalised_grid_size)
 
-        cache_record = next(cache_record for cache_record in layer.cache_records if cache_record.grid_size == normalised_grid_size)
+        precision = class_.compute_coordinate_precision(bbox, normalised_grid_size)
 
-        q = DBSession.query(
+        q = class_.CachedClustersQuery([
 #            geo_func.ST_AsText(
 #                class_.CachedMappablePointCluster.locations
 #            ).label("locations"),
-            geo_func.ST_AsText(
-                class_.CachedMappablePointCluster.centroid
+            class_.format_centroid(
+                geo_func.ST_AsText,
+                class_.CachedMappablePointCluster.centroid,
+                precision
             ).label("centroid"),
             class_.CachedMappablePointCluster.cluster_size.label("cluster_size")
+        ], DBSession()).filter(
+            class_.CachedMappablePointCluster.layer_id == layer.id
         ).filter(
             class_.CachedMappablePointCluster.centroid.intersects(ST_MakeEnvelope(*bbox))
         ).filter(
-            class_.CachedMappablePointCluster.cache_record_id == cache_record.id
+            class_.CachedMappablePointCluster.cache_record_id == cache_record_id
+        ).with_fallback(
+            class_, layer, cache_record_id,
+            lambda: GriddedAndBoundMappablePoint.get_points_as_wkt(layer, bbox, normalised_grid_size)
         )
 
         return q
 
     @classmethod
-    def extra_log_details(class_):
+    def extra_log_details(class_, layer=None):
+        # The layer's own grid sizes, if it has them
+        grid_sizes = class_.get_grid_sizes(layer)
         return {
-            "grid_sizes": class_.GRID_SIZES,
-            "grid_sizes_length": len(class_.GRID_SIZES),
+            "grid_sizes": grid_sizes,
+            "grid_sizes_length": len(grid_sizes),
+            "cache_generation_mode": class_.CACHE_GENERATION_MODE,
         }
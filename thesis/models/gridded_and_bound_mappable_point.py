@@ -22,6 +22,7 @@ from sqlalchemy import (
     )
 
 from sqlalchemy.sql import expression
+from sqlalchemy.sql import text
 
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -40,11 +41,117 @@ import geoalchemy2.functions as geo_func
 
 class GriddedAndBoundMappablePoint(GriddedMappablePoint):
 
+    """ The SQL centroid function of each format of the batch API """
+    CENTROID_SQL_FUNCTIONS = {
+        'geojson': 'ST_AsGeoJSON',
+        'wkt': 'ST_AsText',
+    }
+
+    """ The clusters of a layer within each of a VALUES list of bboxes, each
+        at its own grid size (and coordinate precision), in one statement
+    """
+    BBOXES_CLUSTERS_SQL = """
+        SELECT
+            bboxes.i AS i,
+            %(centroid_function)s(ST_Centroid(ST_Collect(p.location)), bboxes.precision) AS centroid,
+            count(p.location) AS cluster_size
+        FROM (VALUES %(bboxes)s) AS bboxes (i, w, s, e, n, grid_size, precision)
+        JOIN mappable_points AS p
+        ON ST_Intersects(p.location, ST_MakeEnvelope(bboxes.w, bboxes.s, bboxes.e, bboxes.n, %(projection)i))
+        WHERE p.layer_id = :layer_id
+        GROUP BY bboxes.i, bboxes.precision, ST_SnapToGrid(p.location, bboxes.grid_size)
+    """
 
     @classmethod
     def pre_process(class_, layer, **kwargs):
         pass
 
+    @classmethod
+    def get_cache_key_params(class_, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        return (list(bbox), grid_size)
+
+
+    @classmethod
+    def get_layers_points(class_, layers, format, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        """ The clusters of each of the layers, from a single query grouped by
+            layer (see MappablePoint.get_layers_points)
+        """
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        if not layers:
+            return class_.group_rows_by_layer(layers, [])
+
+        q = class_.get_layers_points_query(layers, class_.CENTROID_FUNCTIONS[format], bbox, grid_size)
+        return class_.group_rows_by_layer(layers, q)
+
+    @classmethod
+    def query_bboxes_points(class_, layer, bboxes, format, grid_sizes, projection=DEFAULT_PROJECTION):
+        """ Query the layer's clusters within all of the bboxes in a single
+            statement (see MappablePoint.get_bboxes_points)
+        """
+        results = [[] for bbox in bboxes]
+        if not bboxes:
+            return results
+
+        rows = []
+        for i, (bbox, grid_size) in enumerate(zip(bboxes, grid_sizes)):
+            if grid_size == None:
+                grid_size = class_.get_cluster_grid_size(bbox)
+
+            precision = class_.compute_coordinate_precision(bbox, grid_size)
+            if precision == None:
+                precision = class_.MAX_COORDINATE_PRECISION
+
+            rows.append([i] + list(bbox) + [grid_size, precision])
+
+        values_sql, params = class_.get_values_sql(
+            rows, ['integer', 'float8', 'float8', 'float8', 'float8', 'float8', 'integer']
+        )
+        params['layer_id'] = layer.id
+
+        sql = class_.BBOXES_CLUSTERS_SQL % {
+            'centroid_function': class_.CENTROID_SQL_FUNCTIONS[format],
+            'bboxes': values_sql,
+            'projection': projection,
+        }
+
+        clusters = DBSession.execute(text(sql).execution_options(stream_results=True), params)
+        for cluster in clusters:
+            results[cluster.i].append(cluster)
+
+        return results
+
+    @classmethod
+    def get_layers_points_query(class_, layers, centroid_function, bbox, grid_size):
+        """ Query the clusters of all of the layers at once, as
+            (layer_id, centroid, cluster_size) rows
+        """
+        MappablePoint = class_
+
+        precision = class_.compute_coordinate_precision(bbox, grid_size)
+
+        q = DBSession.query(
+            MappablePoint.layer_id.label('layer_id'),
+            class_.format_centroid(
+                centroid_function,
+                geo_func.ST_Centroid(ST_Collect(MappablePoint.location)),
+                precision
+            ).label('centroid'),
+            func.count(MappablePoint.location).label('cluster_size')
+        ).group_by(
+            MappablePoint.layer_id,
+            ST_SnapToGrid(MappablePoint.location, grid_size)
+        ).filter(
+            MappablePoint.layer_id.in_([layer.id for layer in layers])
+        ).filter(
+            MappablePoint.location.intersects(ST_MakeEnvelope(*bbox))
+        )
+
+        return q
 
     @classmethod
     def get_points_as_geojson(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
@@ -53,12 +160,16 @@ class GriddedAndBoundMappablePoint(GriddedMappablePoint):
         if grid_size == None:
             grid_size = class_.get_cluster_grid_size(bbox)
 
+        precision = class_.compute_coordinate_precision(bbox, grid_size)
+
         q = DBSession.query(
 #            geo_func.ST_AsGeoJSON(
 #                ST_Collect(MappablePoint.location)
 #            ).label("locations"),
-            geo_func.ST_AsGeoJSON(
-                geo_func.ST_Centroid(ST_Collect(MappablePoint.location))
+            class_.format_centroid(
+                geo_func.ST_AsGeoJSON,
+                geo_func.ST_Centroid(ST_Collect(MappablePoint.location)),
+                precision
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).group_by(
@@ -79,12 +190,16 @@ class GriddedAndBoundMappablePoint(GriddedMappablePoint):
         if grid_size == None:
             grid_size = class_.get_cluster_grid_size(bbox)
 
+        precision = class_.compute_coordinate_precision(bbox, grid_size)
+
         q = DBSession.query(
 #            geo_func.ST_AsText(
 #                ST_Collect(MappablePoint.location)
 #            ).label("locations"),
-            geo_func.ST_AsText(
-                geo_func.ST_Centroid(ST_Collect(MappablePoint.location))
+            class_.format_centroid(
+                geo_func.ST_AsText,
+                geo_func.ST_Centroid(ST_Collect(MappablePoint.location)),
+                precision
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).group_by(
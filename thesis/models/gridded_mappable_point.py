@@ -1,3 +1,10 @@
+import logging
+import datetime
+import math
+import random
+import csv
+import os
+
 from thesis.models import (
     DBSession,
     Base,
@@ -19,6 +26,7 @@ from sqlalchemy import (
     )
 
 from sqlalchemy.sql import expression
+from sqlalchemy.sql import text
 
 from sqlalchemy.ext.declarative import declarative_base
 
@@ -31,6 +39,8 @@ from sqlalchemy.orm import (
 
 from sqlalchemy import func as func
 
+from thesis.cache import invalidate_layer_after_commit
+
 from geoalchemy2 import *
 from geoalchemy2.functions import GenericFunction
 import geoalchemy2.functions as geo_func
@@ -40,6 +50,11 @@ class GriddedMappablePoint(MappablePoint):
     """ The possible grid sizes that should be used (the normalised grid sizes) """
     GRID_SIZES = [0, 0.015, 0.03125, 0.0625, 0.125, 0.25, 0.5, 1, 2, 4, 8, 16, 32, 64, 128]
 
+    """ The number of finer grid sizes (each half the last) below the smallest
+        non zero GRID_SIZE that compute_grid_sizes tries for dense layers
+    """
+    ADAPTIVE_FINER_GRID_SIZES = 4
+
     """ The grid size is the span of the window divided by GRID_SIZE_WINDOW_FRACTION
         The total number of grids will, on average, be GRID_SIZE_WINDOW_FRACTION^2
     """
@@ -49,16 +64,38 @@ class GriddedMappablePoint(MappablePoint):
     """
     ROUND_GRID_SIZE_TO_N_PLACES = 3
 
+    """ The bounds that a canonical bbox is clamped to """
+    WORLD_BBOX = [-180, -90, 180, 90]
+
+    """ The number of places to round the edges of a canonical bbox to
+        (drops the floating point noise of the grid multiples)
+    """
+    ROUND_CANONICAL_BBOX_TO_N_PLACES = 9
+
+    """ The number of jittered requests per bbox, and the size of the jitter as
+        a fraction of the bbox's span, of the cache key hit rate benchmark
+    """
+    HIT_RATE_REQUESTS_PER_BBOX = 100
+    HIT_RATE_JITTER_FRACTION = 0.01
+
     @classmethod
-    def normalise_grid_size(class_, grid_size):
+    def get_grid_sizes(class_, layer=None):
+        """ The layer's own grid sizes if it has them, otherwise GRID_SIZES """
+        if layer != None and layer.grid_sizes:
+            return layer.grid_sizes
+
+        return class_.GRID_SIZES
+
+    @classmethod
+    def normalise_grid_size(class_, grid_size, layer=None):
         """ The result is normalised such that there is only a fixed number of
-            possible grid sizes. This should be used for the cache interfaces to ensure
-            that we don't cache to excess.
+            possible grid sizes (the layer's, if given). This should be used for
+            the cache interfaces to ensure that we don't cache to excess.
         """
         return_grid_size = None
 
         # Sort the grid sizes such that the smallest candidate grid sizes are first
-        sorted_grid_sizes = sorted(class_.GRID_SIZES)
+        sorted_grid_sizes = sorted(class_.get_grid_sizes(layer))
         for candidate_grid_size in sorted_grid_sizes:
             # If we are larger (or equal) to this grid size, normalise to it.
             if grid_size >= candidate_grid_size:
@@ -90,23 +127,164 @@ class GriddedMappablePoint(MappablePoint):
 
         return grid_size
 
+    @classmethod
+    def get_candidate_grid_sizes(class_):
+        """ The grid sizes compute_grid_sizes chooses from: GRID_SIZES, and the
+            ADAPTIVE_FINER_GRID_SIZES below them. Smallest first.
+        """
+        grid_sizes = set(class_.GRID_SIZES)
+        grid_sizes.add(0)
+
+        finest_grid_size = min(size for size in grid_sizes if size > 0)
+        for i in range(1, class_.ADAPTIVE_FINER_GRID_SIZES + 1):
+            grid_sizes.add(finest_grid_size / float(2 ** i))
+
+        return sorted(grid_sizes)
+
+    @classmethod
+    def count_clusters(class_, layer, grid_sizes):
+        """ The number of clusters of the layer's points at each of the grid
+            sizes (as a dict), from a single scan of the points.
+        """
+        params = { 'layer_id': layer.id }
+        counts = []
+        for i, grid_size in enumerate(grid_sizes):
+            params['grid_size_%i' % i] = grid_size
+            counts.append("count(DISTINCT ST_SnapToGrid(location, :grid_size_%i))" % i)
+
+        row = DBSession.execute(text(
+            "SELECT %s FROM mappable_points WHERE layer_id = :layer_id" % ", ".join(counts)
+        ), params).fetchone()
+
+        return dict(zip(grid_sizes, row))
+
+    @classmethod
+    def compute_grid_sizes(class_, layer):
+        """ Choose the layer's grid sizes from the distribution of its points.
+
+            Going from the finest candidate grid size to the coarsest, a grid
+            size is only kept if it merges the layer's points into fewer
+            clusters than the last grid size kept. So grid sizes that wouldn't
+            change the clusters (e.g. most of them, for a sparse layer) are
+            skipped, and the finer candidates are only kept where the layer's
+            points are dense enough for them to cluster.
+        """
+        candidates = class_.get_candidate_grid_sizes()
+        counts = class_.count_clusters(layer, candidates)
+
+        grid_sizes = []
+        last_count = None
+        for grid_size in candidates:
+            count = counts[grid_size]
+            if last_count == None or count < last_count:
+                grid_sizes.append(grid_size)
+                last_count = count
+
+        return grid_sizes
+
+    @classmethod
+    def update_grid_sizes(class_, layer):
+        """ Compute, and store, the layer's grid sizes.
+
+            The grid sizes are shared by all of the strategies, so a layer
+            with a cluster cache (built at its old grid sizes) must have them
+            updated by CachedGriddedAndBoundMappablePoint.pre_process(layer,
+            adaptive=True), which rebuilds the cache in the same transaction.
+        """
+        if layer.cache_records:
+            raise ValueError(
+                "Layer %s has a cluster cache, update its grid sizes with "
+                "CachedGriddedAndBoundMappablePoint.pre_process(layer, adaptive=True)" % layer.name
+            )
+
+        return class_.store_grid_sizes(layer, class_.compute_grid_sizes(layer))
+
+    @classmethod
+    def store_grid_sizes(class_, layer, grid_sizes):
+        """ Store the layer's grid sizes. The layer's cluster cache (if any)
+            must be rebuilt at them in the same transaction.
+        """
+        log = logging.getLogger(__name__)
+
+        layer.grid_sizes = grid_sizes
+        DBSession.flush()
+        invalidate_layer_after_commit(layer.id)
+
+        log.info("Grid sizes of layer %s: %s", layer.name, layer.grid_sizes)
+
+        return layer.grid_sizes
+
+    @classmethod
+    def canonicalise_bbox(class_, bbox, grid_size=None, layer=None):
+        """ Canonicalise the bbox (a w,s,e,n string or array) and grid size of
+            a request, so that near identical viewports make identical requests.
+
+            The grid size (calculated from the bbox if not given) is normalised,
+            and the bbox is expanded outward to multiples of it, and clamped to
+            the world. A grid size of 0 uses the smallest non zero grid size.
+            The grid sizes are the layer's, if a layer is given.
+
+            Returns (bbox, grid_size), or (None, None) if the bbox is invalid.
+        """
+        if isinstance(bbox, basestring):
+            bbox = BoundMappablePoint.convert_bbox_string_to_array(bbox)
+
+        if bbox == None or len(bbox) != 4:
+            return (None, None)
+
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        grid_size = class_.normalise_grid_size(grid_size, layer)
+
+        if not grid_size:
+            # Fall back to the standard grid sizes if the layer only has 0
+            non_zero_grid_sizes = [size for size in class_.get_grid_sizes(layer) if size > 0]
+            non_zero_grid_sizes = non_zero_grid_sizes or [size for size in class_.GRID_SIZES if size > 0]
+
+        step = grid_size or min(non_zero_grid_sizes)
+
+        w, s, e, n = bbox
+        world_w, world_s, world_e, world_n = class_.WORLD_BBOX
+
+        canonical_bbox = [
+            max(world_w, math.floor(w / step) * step),
+            max(world_s, math.floor(s / step) * step),
+            min(world_e, math.ceil(e / step) * step),
+            min(world_n, math.ceil(n / step) * step),
+        ]
+        canonical_bbox = [round(edge, class_.ROUND_CANONICAL_BBOX_TO_N_PLACES) for edge in canonical_bbox]
+
+        return (canonical_bbox, grid_size)
+
     @classmethod
     def pre_process(class_, layer, **kwargs):
         pass
 
+    @classmethod
+    def get_cache_key_params(class_, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        return (None, grid_size)
+
     @classmethod
     def get_points_as_geojson(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
         if grid_size == None:
             grid_size = class_.get_cluster_grid_size(bbox)
 
+        precision = class_.compute_coordinate_precision(grid_size=grid_size)
+
         MappablePoint = class_
 
         q = DBSession.query(
 #            geo_func.ST_AsGeoJSON(
 #                ST_Collect(MappablePoint.location)
 #            ).label("locations"),
-            geo_func.ST_AsGeoJSON(
-                geo_func.ST_Centroid(ST_Collect(MappablePoint.location))
+            class_.format_centroid(
+                geo_func.ST_AsGeoJSON,
+                geo_func.ST_Centroid(ST_Collect(MappablePoint.location)),
+                precision
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).group_by(
@@ -122,14 +300,18 @@ class GriddedMappablePoint(MappablePoint):
         if grid_size == None:
             grid_size = class_.get_cluster_grid_size(bbox)
 
+        precision = class_.compute_coordinate_precision(grid_size=grid_size)
+
         MappablePoint = class_
 
         q = DBSession.query(
 #            geo_func.ST_AsText(
 #                ST_Collect(MappablePoint.location)
 #            ).label("locations"),
-            geo_func.ST_AsText(
-                geo_func.ST_Centroid(ST_Collect(MappablePoint.location))
+            class_.format_centroid(
+                geo_func.ST_AsText,
+                geo_func.ST_Centroid(ST_Collect(MappablePoint.location)),
+                precision
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).group_by(
@@ -139,3 +321,69 @@ class GriddedMappablePoint(MappablePoint):
         )
 
         return q
+
+    @classmethod
+    def test_cache_key_hit_rate(class_, bbox, requests=None, jitter_fraction=None, seed=0):
+        """ Simulate requests for slightly panned/zoomed copies of the bbox, and
+            compare the hit rate of the cluster cache keys of the raw requests
+            to that of the canonicalised requests.
+
+            The hit rate is the fraction of requests whose key was already seen.
+        """
+        log = logging.getLogger(__name__)
+
+        if requests == None:
+            requests = class_.HIT_RATE_REQUESTS_PER_BBOX
+        if jitter_fraction == None:
+            jitter_fraction = class_.HIT_RATE_JITTER_FRACTION
+
+        rand = random.Random(seed)
+
+        w, s, e, n = bbox
+        jitter_x = abs(e - w) * jitter_fraction
+        jitter_y = abs(n - s) * jitter_fraction
+
+        raw_keys = set()
+        canonical_keys = set()
+
+        for i in range(requests):
+            request_bbox = [
+                w + rand.uniform(-jitter_x, jitter_x),
+                s + rand.uniform(-jitter_y, jitter_y),
+                e + rand.uniform(-jitter_x, jitter_x),
+                n + rand.uniform(-jitter_y, jitter_y),
+            ]
+
+            raw_bbox, raw_grid_size = class_.get_cache_key_params(bbox=request_bbox)
+            raw_keys.add(repr((raw_bbox, raw_grid_size)))
+
+            canonical_bbox, grid_size = class_.canonicalise_bbox(request_bbox)
+            canonical_bbox, grid_size = class_.get_cache_key_params(bbox=canonical_bbox, grid_size=grid_size)
+            canonical_keys.add(repr((canonical_bbox, grid_size)))
+
+        raw_hit_rate = 1 - ( len(raw_keys) / float(requests) )
+        canonical_hit_rate = 1 - ( len(canonical_keys) / float(requests) )
+
+        log.info(
+            "(%s) cache key hit rate for %i requests around %s: raw: %f, canonical: %f",
+            class_.__name__,
+            requests,
+            bbox,
+            raw_hit_rate,
+            canonical_hit_rate,
+        )
+
+        return ["cache_key_hit_rate", class_.__name__, str(bbox), requests, raw_hit_rate, canonical_hit_rate]
+
+    @classmethod
+    def write_cache_key_hit_rate_csv(class_, results_dir, in_rows):
+        rows =  [row for row in in_rows if row[0] == "cache_key_hit_rate"]
+
+        out_rows = [["Strategy", "BBOX", "Requests", "Raw Hit Rate", "Canonical Hit Rate"]]
+        for row in rows:
+            out_rows.append(row[1:])
+
+        cache_key_hit_rate_csv = os.path.join(results_dir, "cache_key_hit_rate.csv")
+        with open(cache_key_hit_rate_csv, 'wb') as csvfile:
+            my_writer = csv.writer(csvfile, delimiter=',')
+            my_writer.writerows(out_rows)
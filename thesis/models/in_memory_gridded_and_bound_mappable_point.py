@@ -0,0 +1,209 @@
+import logging
+import collections
+import itertools
+import threading
+import time
+
+import numpy as np
+
+from thesis.models import (
+    DBSession,
+    Base,
+    Layer,
+    DEFAULT_PROJECTION,
+    MappablePoint,
+    GriddedAndBoundMappablePoint,
+    )
+
+from thesis.cache import add_invalidation_listener
+
+from sqlalchemy import func as func
+
+class InMemoryGriddedAndBoundMappablePoint(GriddedAndBoundMappablePoint):
+    """ Clusters a layer's points within a bbox, like the
+        GriddedAndBoundMappablePoint, but in process.
+
+        A layer's coordinates are loaded from the database once, into
+        contiguous NumPy arrays, and each request is then answered with
+        vectorised bbox masking, cell calculation and aggregation, without
+        a database round trip.
+
+        The arrays are dropped when the layer is invalidated (see
+        thesis.cache.invalidate_layer, called once its points change), and
+        reloaded every LAYER_COORDINATES_MAX_AGE seconds, picking up the
+        changes of other processes.
+    """
+
+    """ A cluster, with the same attributes as the rows of the SQL strategies """
+    Cluster = collections.namedtuple('Cluster', ['centroid', 'cluster_size'])
+
+    class ClusterList(list):
+        """ The clusters of a request. Quacks enough like a Query for the
+            serialisers and benchmarks.
+        """
+        def all(self):
+            return self
+
+        def count(self):
+            return len(self)
+
+    """ The most layers whose coordinates are held in memory at once. The
+        least recently used layers are dropped first.
+    """
+    MAX_LOADED_LAYERS = 16
+
+    """ The seconds until a layer's coordinates are reloaded """
+    LAYER_COORDINATES_MAX_AGE = 300
+
+    # The loaded layer coordinates, by layer id: (xs, ys, loaded at), least
+    # recently used first
+    layer_coordinates = collections.OrderedDict()
+    layer_coordinates_lock = threading.Lock()
+
+    @classmethod
+    def pre_process(class_, layer, **kwargs):
+        """ Load the layer's coordinates into memory """
+        class_.load_layer(layer)
+
+    @classmethod
+    def load_layer(class_, layer):
+        """ (Re)load the layer's coordinates from the database into memory """
+        log = logging.getLogger(__name__)
+
+        q = DBSession.query(
+            func.ST_X(MappablePoint.location),
+            func.ST_Y(MappablePoint.location),
+        ).filter(
+            MappablePoint.layer_id == layer.id
+        )
+
+        # Stream the coordinates straight into the array, without a list of rows
+        coordinates = np.fromiter(
+            itertools.chain.from_iterable(class_.stream_query(q)),
+            dtype=np.float64
+        ).reshape(-1, 2)
+        xs = np.ascontiguousarray(coordinates[:, 0])
+        ys = np.ascontiguousarray(coordinates[:, 1])
+
+        with class_.layer_coordinates_lock:
+            class_.layer_coordinates.pop(layer.id, None)
+            class_.layer_coordinates[layer.id] = (xs, ys, time.time())
+
+            while len(class_.layer_coordinates) > class_.MAX_LOADED_LAYERS:
+                class_.layer_coordinates.popitem(last=False)
+
+        log.debug("Loaded %i points of layer %s into memory", len(xs), layer.name)
+
+        return xs, ys
+
+    @classmethod
+    def invalidate_layer(class_, layer=None):
+        """ Forget the in memory coordinates of the layer (of all layers if
+            no layer is given). They'll be reloaded on the next request.
+        """
+        class_.invalidate_layer_id(layer.id if layer != None else None)
+
+    @classmethod
+    def invalidate_layer_id(class_, layer_id):
+        """ invalidate_layer, by the layer's id (None for all layers). The
+            listener of thesis.cache's invalidations.
+        """
+        with class_.layer_coordinates_lock:
+            if layer_id == None:
+                class_.layer_coordinates.clear()
+            else:
+                class_.layer_coordinates.pop(layer_id, None)
+
+    @classmethod
+    def get_layer_coordinates(class_, layer):
+        """ The layer's (xs, ys) coordinate arrays, loaded if they aren't
+            already, or are older than LAYER_COORDINATES_MAX_AGE
+        """
+        with class_.layer_coordinates_lock:
+            coordinates = class_.layer_coordinates.pop(layer.id, None)
+            if coordinates != None and time.time() - coordinates[2] <= class_.LAYER_COORDINATES_MAX_AGE:
+                # Now the most recently used
+                class_.layer_coordinates[layer.id] = coordinates
+                return coordinates[:2]
+
+        return class_.load_layer(layer)
+
+    @classmethod
+    def get_clusters(class_, layer, bbox=[-180,-90,180,90], grid_size=None):
+        """ Cluster the layer's points within the bbox.
+
+            Points are snapped to the nearest multiple of the grid size, the
+            same as ST_SnapToGrid (a grid size of 0 doesn't snap), and each
+            cluster's centroid is the mean of its points.
+
+            Returns (centroid_xs, centroid_ys, cluster_sizes) arrays.
+        """
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        w, s, e, n = bbox
+        xs, ys = class_.get_layer_coordinates(layer)
+
+        mask = (xs >= w) & (xs <= e) & (ys >= s) & (ys <= n)
+        xs = xs[mask]
+        ys = ys[mask]
+
+        if len(xs) == 0:
+            return xs, ys, np.zeros(0, dtype=np.int64)
+
+        cells = np.empty(len(xs), dtype=[('x', np.float64), ('y', np.float64)])
+        if grid_size:
+            cells['x'] = np.rint(xs / grid_size)
+            cells['y'] = np.rint(ys / grid_size)
+        else:
+            cells['x'] = xs
+            cells['y'] = ys
+
+        unique_cells, cluster_ids = np.unique(cells, return_inverse=True)
+
+        cluster_sizes = np.bincount(cluster_ids)
+        centroid_xs = np.bincount(cluster_ids, weights=xs) / cluster_sizes
+        centroid_ys = np.bincount(cluster_ids, weights=ys) / cluster_sizes
+
+        return centroid_xs, centroid_ys, cluster_sizes
+
+    @classmethod
+    def get_layers_points(class_, layers, format, **kwargs):
+        # Each layer is clustered from its own arrays, so fan the layers out
+        return class_.fan_out_layers(layers, 'get_points_as_%s' % format, **kwargs)
+
+    @classmethod
+    def query_bboxes_points(class_, layer, bboxes, format, grid_sizes):
+        # Without a database round trip, so cluster each bbox in turn
+        return class_.query_each_bbox_points(layer, bboxes, format, grid_sizes)
+
+    @classmethod
+    def get_points_as_geojson(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        centroid_xs, centroid_ys, cluster_sizes = class_.get_clusters(layer, bbox, grid_size)
+        precision = class_.get_coordinate_precision(layer, bbox=bbox, grid_size=grid_size)
+        format_coordinate = class_.format_coordinate
+
+        return class_.ClusterList(
+            class_.Cluster(
+                '{"type":"Point","coordinates":[%s,%s]}' % (format_coordinate(x, precision), format_coordinate(y, precision)),
+                int(cluster_size)
+            )
+            for x, y, cluster_size in zip(centroid_xs, centroid_ys, cluster_sizes)
+        )
+
+    @classmethod
+    def get_points_as_wkt(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        centroid_xs, centroid_ys, cluster_sizes = class_.get_clusters(layer, bbox, grid_size)
+        precision = class_.get_coordinate_precision(layer, bbox=bbox, grid_size=grid_size)
+        format_coordinate = class_.format_coordinate
+
+        return class_.ClusterList(
+            class_.Cluster(
+                'POINT(%s %s)' % (format_coordinate(x, precision), format_coordinate(y, precision)),
+                int(cluster_size)
+            )
+            for x, y, cluster_size in zip(centroid_xs, centroid_ys, cluster_sizes)
+        )
+
+# Drop a layer's coordinates once its points change
+add_invalidation_listener(InMemoryGriddedAndBoundMappablePoint.invalidate_layer_id)
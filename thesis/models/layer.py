@@ -5,11 +5,14 @@ from thesis.models import DBSession, Base, DEFAULT_PROJECTION
 from sqlalchemy import (
     Column,
     Integer,
+    Float,
     Text,
     Unicode,
     ForeignKey,
     )
 
+from sqlalchemy.dialects.postgresql import ARRAY
+
 from sqlalchemy.ext.declarative import declarative_base
 
 from sqlalchemy.orm import (
@@ -26,6 +29,10 @@ class Layer(Base):
     id = Column(Integer, primary_key=True)
     name = Column(Text)
 
+    # The layer's own (adaptive) grid sizes, see GriddedMappablePoint.compute_grid_sizes.
+    # When not set, the strategy's GRID_SIZES are used.
+    grid_sizes = Column(ARRAY(Float))
+
     def __init__(self, name):
         """ Layer constructor
 
@@ -1,9 +1,28 @@
 from thesis.models import DBSession, Base, Layer, DEFAULT_PROJECTION
+from thesis.cache import (
+    get_or_create_clusters_str,
+    get_or_create_encoded_clusters_str,
+    )
+from thesis.benchmark import (
+    STATS,
+    benchmark,
+    time_call,
+    time_cpu_call,
+    )
+from thesis.compression import (
+    compress,
+    get_encodings,
+    )
 import logging
-import datetime
-import json
+import collections
+import transaction
+import math
 import csv
 import os
+import struct
+import threading
+
+from multiprocessing.pool import ThreadPool
 
 from sqlalchemy import (
     Column,
@@ -23,6 +42,7 @@ from sqlalchemy.orm import (
     relationship,
     backref,
     )
+from sqlalchemy.orm.query import Query
 
 from sqlalchemy import func as func
 from geoalchemy2 import *
@@ -64,9 +84,70 @@ class MappablePoint(Base):
 
     # The mappable point MUST be associated with a layer
     layer_id = Column(Integer, ForeignKey("layers.id"), nullable=False)
-    layer = relationship("Layer", backref=backref("mappable_points", order_by=id, enable_typechecks=False))
+    # Deleting a layer doesn't touch its points (they must be deleted first, or
+    # go with the layer's partition when partitioned by layer)
+    layer = relationship("Layer", backref=backref("mappable_points", order_by=id, enable_typechecks=False, passive_deletes='all'))
     location = Column(Geometry(geometry_type='POINT', srid=DEFAULT_PROJECTION))
 
+    """ The number of features/centroids the *_str serializers emit per chunk """
+    SERIALIZE_CHUNK_SIZE = 1000
+
+    """ The number of rows fetched per round trip when a query's results are
+        streamed through a server side cursor. 0 fetches the whole result at
+        once (into client memory).
+    """
+    STREAM_BATCH_SIZE = 1000
+
+    """ The calls of each benchmarked (test_get_points_as_*) method made, and
+        not measured, after its first (cold) call
+    """
+    BENCHMARK_WARMUPS = 2
+
+    """ The measured calls of each benchmarked method, after the warmups """
+    BENCHMARK_ITERATIONS = 10
+
+    """ The most threads (and database connections) that batches of layers are
+        fanned out over, by strategies that can't query them all at once. The
+        threads are shared by all requests (see get_fan_out_pool).
+    """
+    BATCH_FAN_OUT_THREADS = 4
+
+    # The threads of fan_out_layers, made on first use
+    fan_out_pool = None
+    fan_out_pool_lock = threading.Lock()
+
+    """ The centroid function of each format of the batch API """
+    CENTROID_FUNCTIONS = {
+        'geojson': geo_func.ST_AsGeoJSON,
+        'wkt': geo_func.ST_AsText,
+    }
+
+    """ Centroids are output to the decimal places that resolve
+        1/COORDINATE_PRECISION_GRID_FRACTION of the grid size they're clustered
+        at, or (if they aren't gridded) 1/COORDINATE_PRECISION_BBOX_FRACTION of
+        the span of the bbox. Without either, to full precision.
+    """
+    COORDINATE_PRECISION_GRID_FRACTION = 1000
+    COORDINATE_PRECISION_BBOX_FRACTION = 10000
+
+    """ The most decimal places of an output coordinate """
+    MAX_COORDINATE_PRECISION = 15
+
+    """ A cluster of the packed format: little-endian float32 lon, float32 lat
+        and uint32 cluster_size
+    """
+    PACKED_CLUSTER = struct.Struct('<ffI')
+
+    """ The number of decimal places of the TWKB coordinates (-7 to 7) """
+    TWKB_PRECISION = 6
+
+    """ The TWKB geometry type of a multipoint, and the metadata flags of an
+        id list and of an empty geometry
+    """
+    TWKB_MULTIPOINT = 4
+    TWKB_IDLIST_FLAG = 0x04
+    TWKB_EMPTY_FLAG = 0x10
+
     def __init__(self, location_wkt, projection=DEFAULT_PROJECTION):
         """ Mappable Point constructor
 
@@ -76,6 +157,271 @@ class MappablePoint(Base):
         """
         self.location = WKTElement(location_wkt, srid=projection)
 
+    @classmethod
+    def get_strategies(class_):
+        """ This class, and all of its subclasses (the available strategies)
+        """
+        strategies = [class_]
+        for subclass in class_.__subclasses__():
+            strategies += subclass.get_strategies()
+
+        return class_.uniq_list(strategies)
+
+    @classmethod
+    def get_strategy(class_, name):
+        """ Find a strategy (this class or one of its subclasses) by class name.
+            Returns None if there is no such strategy.
+        """
+        for strategy in class_.get_strategies():
+            if strategy.__name__ == name:
+                return strategy
+
+        return None
+
+    @classmethod
+    def get_cache_key_params(class_, layer=None, **kwargs):
+        """ The (bbox, grid_size) that this strategy's clusters of the layer
+            depend on, used to key the cluster cache. None for those that don't
+            affect the result.
+        """
+        return (None, None)
+
+    @classmethod
+    def stream_query(class_, q, batch_size=None):
+        """ Iterate the rows of the query through a named server side cursor,
+            batch_size (defaults to STREAM_BATCH_SIZE) rows at a time, so the
+            whole result is never held in memory.
+
+            The cursor only lives as long as the transaction, so the rows must
+            be consumed within it. Results that aren't queries (e.g. the in
+            memory strategy's ClusterList) are returned as is.
+        """
+        if batch_size == None:
+            batch_size = class_.STREAM_BATCH_SIZE
+
+        if not batch_size or not isinstance(q, Query):
+            return q
+
+        return q.yield_per(batch_size).execution_options(stream_results=True)
+
+    @classmethod
+    def get_layers_points_as_geojson(class_, layers, **kwargs):
+        """ The clusters of each of the layers, as per get_points_as_geojson.
+            Returns an OrderedDict of each layer's (centroid, cluster_size)
+            rows, by layer id, in the order of the layers.
+        """
+        return class_.get_layers_points(layers, 'geojson', **kwargs)
+
+    @classmethod
+    def get_layers_points_as_wkt(class_, layers, **kwargs):
+        """ The clusters of each of the layers, as per get_points_as_wkt (and
+            get_layers_points_as_geojson)
+        """
+        return class_.get_layers_points(layers, 'wkt', **kwargs)
+
+    @classmethod
+    def get_layers_points(class_, layers, format, **kwargs):
+        """ The clusters of each of the layers in the format (geojson or wkt).
+
+            The layers are queried concurrently (see fan_out_layers).
+            Strategies that can cluster many layers in a single grouped query
+            override this.
+        """
+        return class_.fan_out_layers(layers, 'get_points_as_%s' % format, **kwargs)
+
+    @classmethod
+    def get_fan_out_pool(class_):
+        """ The pool of threads that fan_out_layers queries on. It's shared by
+            all of the strategies and requests, so however many batches are in
+            flight, they take at most its threads' connections. It has
+            BATCH_FAN_OUT_THREADS threads, but no more than one less than the
+            engine's pool_size, leaving a connection for the requests
+            themselves.
+        """
+        with MappablePoint.fan_out_pool_lock:
+            if MappablePoint.fan_out_pool == None:
+                threads = class_.BATCH_FAN_OUT_THREADS
+
+                connection_pool = DBSession.get_bind().pool
+                if hasattr(connection_pool, 'size'):
+                    threads = max(1, min(threads, connection_pool.size() - 1))
+
+                MappablePoint.fan_out_pool = ThreadPool(threads)
+
+            return MappablePoint.fan_out_pool
+
+    @classmethod
+    def fan_out_layers(class_, layers, method_name, **kwargs):
+        """ Query method_name(layer, **kwargs) for each of the layers, over the
+            shared pool of threads (see get_fan_out_pool). Returns an
+            OrderedDict of each layer's rows, by layer id, in the order of the
+            layers.
+
+            Each thread queries in a transaction (and on a connection) of its
+            own, so changes the caller hasn't committed aren't seen. Callers
+            that hold a connection they won't use meanwhile (e.g. a read only
+            request) should give it back to the pool first.
+        """
+        layer_ids = [layer.id for layer in layers]
+
+        def get_layer_points(layer_id):
+            try:
+                with transaction.manager:
+                    layer = DBSession.query(Layer).get(layer_id)
+                    q = getattr(class_, method_name)(layer, **kwargs)
+                    return layer_id, list(class_.stream_query(q))
+            finally:
+                DBSession.remove()
+
+        if not layer_ids:
+            return collections.OrderedDict()
+
+        pool = class_.get_fan_out_pool()
+        return collections.OrderedDict(pool.map(get_layer_points, layer_ids))
+
+    @classmethod
+    def get_bboxes_points_as_geojson(class_, layer, bboxes, grid_sizes=None):
+        """ The layer's clusters within each of the bboxes, as per
+            get_points_as_geojson. Returns a list of each bbox's
+            (centroid, cluster_size) rows, in the order of the bboxes.
+        """
+        return class_.get_bboxes_points(layer, bboxes, 'geojson', grid_sizes)
+
+    @classmethod
+    def get_bboxes_points_as_wkt(class_, layer, bboxes, grid_sizes=None):
+        """ The layer's clusters within each of the bboxes, as per
+            get_points_as_wkt (and get_bboxes_points_as_geojson)
+        """
+        return class_.get_bboxes_points(layer, bboxes, 'wkt', grid_sizes)
+
+    @classmethod
+    def get_bboxes_points(class_, layer, bboxes, format, grid_sizes=None):
+        """ The layer's clusters within each of the bboxes (e.g. a viewport,
+            its neighbours and the next zoom level) in the format (geojson or
+            wkt), each at its own grid size (None to calculate it from the
+            bbox). Returns a list of each bbox's rows, in the order of the
+            bboxes.
+
+            Repeated (bbox, grid size) requests are only queried once.
+        """
+        if grid_sizes == None:
+            grid_sizes = [None] * len(bboxes)
+
+        requests = [(tuple(bbox), grid_size) for bbox, grid_size in zip(bboxes, grid_sizes)]
+        unique_requests = class_.uniq_list(requests)
+
+        results = class_.query_bboxes_points(
+            layer,
+            [list(bbox) for bbox, grid_size in unique_requests],
+            format,
+            [grid_size for bbox, grid_size in unique_requests]
+        )
+
+        results = dict(zip(unique_requests, results))
+        return [results[request] for request in requests]
+
+    @classmethod
+    def query_bboxes_points(class_, layer, bboxes, format, grid_sizes):
+        """ Query the layer's clusters within each of the (distinct) bboxes,
+            as per get_bboxes_points.
+
+            By default, each bbox is queried in turn. Strategies that can query
+            many bboxes in a single round trip override this.
+        """
+        return class_.query_each_bbox_points(layer, bboxes, format, grid_sizes)
+
+    @classmethod
+    def query_each_bbox_points(class_, layer, bboxes, format, grid_sizes):
+        """ Query the layer's clusters within each of the bboxes in turn """
+        get_points = getattr(class_, 'get_points_as_%s' % format)
+
+        return [
+            list(class_.stream_query(get_points(layer, bbox=bbox, grid_size=grid_size)))
+            for bbox, grid_size in zip(bboxes, grid_sizes)
+        ]
+
+    @classmethod
+    def get_values_sql(class_, rows, types):
+        """ A VALUES list of the rows, with each value a bound param cast to
+            the SQL type of its column. Returns the (sql, params).
+        """
+        values = []
+        params = {}
+
+        for i, row in enumerate(rows):
+            casts = []
+            for j, (value, type_) in enumerate(zip(row, types)):
+                name = 'value_%i_%i' % (i, j)
+                params[name] = value
+                casts.append('CAST(:%s AS %s)' % (name, type_))
+
+            values.append('(%s)' % ', '.join(casts))
+
+        return ', '.join(values), params
+
+    @classmethod
+    def group_rows_by_layer(class_, layers, q):
+        """ Split the (layer_id, centroid, cluster_size) rows of a query of
+            many layers into an OrderedDict of each layer's rows, by layer id,
+            in the order of the layers
+        """
+        results = collections.OrderedDict((layer.id, []) for layer in layers)
+
+        for row in class_.stream_query(q):
+            results[row.layer_id].append(row)
+
+        return results
+
+    @classmethod
+    def get_coordinate_precision(class_, layer=None, **kwargs):
+        """ The decimal places of the centroids of a request for the layer's
+            clusters (None for full precision)
+        """
+        bbox, grid_size = class_.get_cache_key_params(layer=layer, **kwargs)
+        return class_.compute_coordinate_precision(bbox, grid_size)
+
+    @classmethod
+    def compute_coordinate_precision(class_, bbox=None, grid_size=None):
+        """ The decimal places that resolve a fraction of the grid size (or of
+            the bbox's span, if the clusters aren't gridded). Returns None if
+            neither is given.
+        """
+        if grid_size:
+            resolution = grid_size / float(class_.COORDINATE_PRECISION_GRID_FRACTION)
+        elif bbox:
+            w, s, e, n = bbox
+            span = max(abs(e - w), abs(n - s))
+            resolution = span / float(class_.COORDINATE_PRECISION_BBOX_FRACTION)
+        else:
+            return None
+
+        if resolution <= 0:
+            return None
+
+        # The epsilon stops exact powers of ten rounding up a place
+        precision = int(math.ceil(-math.log10(resolution) - 1e-9))
+        return min(max(precision, 0), class_.MAX_COORDINATE_PRECISION)
+
+    @classmethod
+    def format_centroid(class_, centroid_function, geom, precision=None):
+        """ ST_AsGeoJSON/ST_AsText of the geometry, to precision decimal
+            places if given
+        """
+        if precision == None:
+            return centroid_function(geom)
+
+        return centroid_function(geom, precision)
+
+    @classmethod
+    def format_coordinate(class_, value, precision=None):
+        """ A coordinate as it's output by PostGIS: to precision decimal places
+            if given, without trailing zeros
+        """
+        if precision != None:
+            value = round(value, precision)
+
+        return '%.15g' % value
+
     @classmethod
     def uniq_list(class_, seq):
         seen = set()
@@ -92,6 +438,42 @@ class MappablePoint(Base):
         class_.write_get_points_as_geojson_str_csv(results_dir, in_rows)
         class_.write_get_points_as_wkt_str_csv(results_dir, in_rows)
 
+        class_.write_get_points_as_compressed_str_csv(results_dir, in_rows)
+
+        class_.write_timing_stats_csv(results_dir, in_rows)
+
+    @classmethod
+    def benchmark(class_, fn):
+        """ Time fn() cold, and over BENCHMARK_ITERATIONS (at least one) calls
+            after BENCHMARK_WARMUPS (see thesis.benchmark.benchmark). Returns
+            the result of the cold call, and the timing stats.
+        """
+        return benchmark(fn, class_.BENCHMARK_WARMUPS, max(1, class_.BENCHMARK_ITERATIONS))
+
+    @classmethod
+    def write_timing_stats_csv(class_, results_dir, in_rows):
+        """ Write the timing stats (cold, and min/median/p95/p99/stddev of the
+            warm calls) of each benchmarked (method, strategy, layer, bbox)
+        """
+        methods = [
+            "get_points_as_geojson",
+            "get_points_as_wkt",
+            "get_points_as_geojson_str",
+            "get_points_as_wkt_str",
+        ]
+        rows = [row for row in in_rows if row[0] in methods]
+
+        out_rows = [["Method", "Strategy", "Layer", "BBOX"] + [stat.title() for stat in STATS]]
+        for row in rows:
+            method, strategy, layer_name = row[0:3]
+            kwargs, timing = row[5], row[7]
+            out_rows.append([method, strategy, layer_name, str(kwargs["bbox"])] + [timing[stat] for stat in STATS])
+
+        timing_stats_csv = os.path.join(results_dir, "timing_stats.csv")
+        with open(timing_stats_csv, 'wb') as csvfile:
+            my_writer = csv.writer(csvfile, delimiter=',')
+            my_writer.writerows(out_rows)
+
     @classmethod
     def pre_process(class_, layer, **kwargs):
         pass
@@ -102,13 +484,7 @@ class MappablePoint(Base):
 
         log.debug("Start: pre_process")
 
-        start_t = datetime.datetime.now()
-
-        result = class_.pre_process(layer, **kwargs)
-
-        end_t = datetime.datetime.now()
-        delta_t = end_t - start_t
-        delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+        result, delta_t_s = time_call(lambda: class_.pre_process(layer, **kwargs))
 
         log.debug("End: pre_process")
 
@@ -120,7 +496,7 @@ class MappablePoint(Base):
             delta_t_s,
         )
 
-        return ["pre_process", class_.__name__, layer.name, delta_t_s, kwargs, class_.extra_log_details()]
+        return ["pre_process", class_.__name__, layer.name, delta_t_s, kwargs, class_.extra_log_details(layer)]
 
     @classmethod
     def write_pre_process_csv(class_, results_dir, in_rows):
@@ -174,8 +550,10 @@ class MappablePoint(Base):
 #            geo_func.ST_AsGeoJSON(
 #                ST_Multi(ST_Collect(MappablePoint.location))
 #            ).label("locations"),
-            geo_func.ST_AsGeoJSON(
-                MappablePoint.location
+            class_.format_centroid(
+                geo_func.ST_AsGeoJSON,
+                MappablePoint.location,
+                class_.get_coordinate_precision(layer, **kwargs)
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).filter(
@@ -192,26 +570,27 @@ class MappablePoint(Base):
 
         log.debug("Start: get_points_as_geojson")
 
-        start_t = datetime.datetime.now()
-
-        result = class_.get_points_as_geojson(layer, **kwargs).all()
+        def get_clusters():
+            q = class_.get_points_as_geojson(layer, **kwargs)
+            return sum(1 for el in class_.stream_query(q))
 
-        end_t = datetime.datetime.now()
-        delta_t = end_t - start_t
-        delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+        clusters, timing = class_.benchmark(get_clusters)
+        delta_t_s = timing['median']
 
         log.debug("End: get_points_as_geojson")
 
         log.info(
-            "(%s) get_points_as_geojson(%s, %s) clusters: %i, took: seconds: %f",
+            "(%s) get_points_as_geojson(%s, %s) clusters: %i, took: seconds: %f (cold: %f, p95: %f)",
             class_.__name__,
             layer.name,
             kwargs,
-            len(result),
+            clusters,
             delta_t_s,
+            timing['cold'],
+            timing['p95'],
         )
 
-        return ["get_points_as_geojson", class_.__name__, layer.name, len(result), delta_t_s, kwargs, class_.extra_log_details()]
+        return ["get_points_as_geojson", class_.__name__, layer.name, clusters, delta_t_s, kwargs, class_.get_request_log_details(layer, **kwargs), timing]
 
 
     @classmethod
@@ -295,29 +674,53 @@ class MappablePoint(Base):
             my_writer.writerows(cluster_size_rows)
 
     @classmethod
-    def get_points_as_geojson_str(class_, layer, **kwargs):
+    def iter_points_as_geojson_str(class_, layer, **kwargs):
+        """ Generate the GeoJSON FeatureCollection for the layer as a sequence
+            of string chunks.
+        """
         q = class_.get_points_as_geojson(layer, **kwargs)
-        result = q.all()
+        return class_.iter_geojson_str(q)
+
+    @classmethod
+    def iter_geojson_str(class_, q):
+        """ Generate a GeoJSON FeatureCollection of the (centroid, cluster_size)
+            rows of a query as a sequence of string chunks.
+
+            Rows are pulled from the query as we go, and the GeoJSON geometry
+            produced by the database is spliced in verbatim (no json.loads/dumps
+            round trip). Each chunk holds up to SERIALIZE_CHUNK_SIZE features.
+        """
+        yield '{"type": "FeatureCollection", "features": ['
 
-        return_geojson_obj = {
-            "type": "FeatureCollection",
-            "features": [
-            ]
-        }
+        separator = ''
+        features = []
+        for el in class_.stream_query(q):
+            features.append(
+                '{"type": "Feature", "geometry": %s, "properties": {"cluster_size": %i}}' %
+                (el.centroid, el.cluster_size)
+            )
 
-        for el in result:
-            centroid     = json.loads(el.centroid)
-            cluster_size = el.cluster_size
+            if len(features) == class_.SERIALIZE_CHUNK_SIZE:
+                yield separator + ', '.join(features)
+                separator = ', '
+                features = []
 
-            return_geojson_obj["features"].append({
-                "type": "Feature",
-                "geometry": centroid,
-                "properties": {
-                    "cluster_size": cluster_size
-                }
-            })
+        if features:
+            yield separator + ', '.join(features)
 
-        return json.dumps(return_geojson_obj)
+        yield ']}'
+
+    @classmethod
+    def get_points_as_geojson_str(class_, layer, **kwargs):
+        """ The GeoJSON FeatureCollection for the layer, from the cluster cache
+            if it's configured.
+        """
+        bbox, grid_size = class_.get_cache_key_params(layer=layer, **kwargs)
+        return get_or_create_clusters_str(
+            class_, layer, 'geojson',
+            lambda: ''.join(class_.iter_points_as_geojson_str(layer, **kwargs)),
+            bbox, grid_size
+        )
 
     @classmethod
     def test_get_points_as_geojson_str(class_, layer, **kwargs):
@@ -325,26 +728,23 @@ class MappablePoint(Base):
 
         log.debug("Start: get_points_as_geojson_str")
 
-        start_t = datetime.datetime.now()
-
-        result = class_.get_points_as_geojson_str(layer, **kwargs)
-
-        end_t = datetime.datetime.now()
-        delta_t = end_t - start_t
-        delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+        result, timing = class_.benchmark(lambda: class_.get_points_as_geojson_str(layer, **kwargs))
+        delta_t_s = timing['median']
 
         log.debug("End: get_points_as_geojson_str")
 
         log.info(
-            "(%s) get_points_as_geojson_str(%s, %s) string length: %i, took: seconds: %f",
+            "(%s) get_points_as_geojson_str(%s, %s) string length: %i, took: seconds: %f (cold: %f, p95: %f)",
             class_.__name__,
             layer.name,
             kwargs,
             len(result),
             delta_t_s,
+            timing['cold'],
+            timing['p95'],
         )
 
-        return ["get_points_as_geojson_str", class_.__name__, layer.name, len(result), delta_t_s, kwargs, class_.extra_log_details()]
+        return ["get_points_as_geojson_str", class_.__name__, layer.name, len(result), delta_t_s, kwargs, class_.get_request_log_details(layer, **kwargs), timing]
 
     @classmethod
     def write_get_points_as_geojson_str_csv(class_, results_dir, in_rows):
@@ -425,31 +825,6 @@ class MappablePoint(Base):
             my_writer = csv.writer(csvfile, delimiter=',')
             my_writer.writerows(string_length_rows)
 
-    @classmethod
-    def get_points_as_geojson_str(class_, layer, **kwargs):
-        q = class_.get_points_as_geojson(layer, **kwargs)
-        result = q.all()
-
-        return_geojson_obj = {
-            "type": "FeatureCollection",
-            "features": [
-            ]
-        }
-
-        for el in result:
-            centroid     = json.loads(el.centroid)
-            cluster_size = el.cluster_size
-
-            return_geojson_obj["features"].append({
-                "type": "Feature",
-                "geometry": centroid,
-                "properties": {
-                    "cluster_size": cluster_size
-                }
-            })
-
-        return json.dumps(return_geojson_obj)
-
     @classmethod
     def get_points_as_wkt(class_, layer, **kwargs):
         MappablePoint = class_
@@ -458,8 +833,10 @@ class MappablePoint(Base):
 #            geo_func.ST_AsText(
 #                ST_Multi(ST_Collect(MappablePoint.location))
 #            ).label("locations"),
-            geo_func.ST_AsText(
-                MappablePoint.location
+            class_.format_centroid(
+                geo_func.ST_AsText,
+                MappablePoint.location,
+                class_.get_coordinate_precision(layer, **kwargs)
             ).label('centroid'),
             func.count(MappablePoint.location).label('cluster_size')
         ).filter(
@@ -476,26 +853,27 @@ class MappablePoint(Base):
 
         log.debug("Start: get_points_as_wkt")
 
-        start_t = datetime.datetime.now()
-
-        result = class_.get_points_as_wkt(layer, **kwargs).all()
+        def get_clusters():
+            q = class_.get_points_as_wkt(layer, **kwargs)
+            return sum(1 for el in class_.stream_query(q))
 
-        end_t = datetime.datetime.now()
-        delta_t = end_t - start_t
-        delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+        clusters, timing = class_.benchmark(get_clusters)
+        delta_t_s = timing['median']
 
         log.debug("End: get_points_as_wkt")
 
         log.info(
-            "(%s) get_points_as_wkt(%s, %s) clusters: %i, took: seconds: %f",
+            "(%s) get_points_as_wkt(%s, %s) clusters: %i, took: seconds: %f (cold: %f, p95: %f)",
             class_.__name__,
             layer.name,
             kwargs,
-            len(result),
+            clusters,
             delta_t_s,
+            timing['cold'],
+            timing['p95'],
         )
 
-        return ["get_points_as_wkt", class_.__name__, layer.name, len(result), delta_t_s, kwargs, class_.extra_log_details()]
+        return ["get_points_as_wkt", class_.__name__, layer.name, clusters, delta_t_s, kwargs, class_.get_request_log_details(layer, **kwargs), timing]
 
     @classmethod
     def write_get_points_as_wkt_csv(class_, results_dir, in_rows):
@@ -578,19 +956,47 @@ class MappablePoint(Base):
             my_writer.writerows(cluster_size_rows)
 
     @classmethod
-    def get_points_as_wkt_str(class_, layer, **kwargs):
+    def iter_points_as_wkt_str(class_, layer, **kwargs):
+        """ Generate the WKT GEOMETRYCOLLECTION for the layer as a sequence
+            of string chunks.
+        """
         q = class_.get_points_as_wkt(layer, **kwargs)
-        result = q.all()
+        return class_.iter_wkt_str(q)
+
+    @classmethod
+    def iter_wkt_str(class_, q):
+        """ Generate a WKT GEOMETRYCOLLECTION of the centroid rows of a query as
+            a sequence of string chunks, pulling rows from the query as we go.
+            Each chunk holds up to SERIALIZE_CHUNK_SIZE centroids.
+        """
+        yield 'GEOMETRYCOLLECTION('
 
+        separator = ''
         wkt_centroids = []
+        for el in class_.stream_query(q):
+            wkt_centroids.append(el.centroid)
 
-        for el in result:
-            centroid_wkt     = el.centroid
+            if len(wkt_centroids) == class_.SERIALIZE_CHUNK_SIZE:
+                yield separator + ','.join(wkt_centroids)
+                separator = ','
+                wkt_centroids = []
 
-            wkt_centroids.append(centroid_wkt)
+        if wkt_centroids:
+            yield separator + ','.join(wkt_centroids)
 
-        return_str = "GEOMETRYCOLLECTION(" + ','.join(wkt_centroids) + ")"
-        return return_str
+        yield ')'
+
+    @classmethod
+    def get_points_as_wkt_str(class_, layer, **kwargs):
+        """ The WKT GEOMETRYCOLLECTION for the layer, from the cluster cache
+            if it's configured.
+        """
+        bbox, grid_size = class_.get_cache_key_params(layer=layer, **kwargs)
+        return get_or_create_clusters_str(
+            class_, layer, 'wkt',
+            lambda: ''.join(class_.iter_points_as_wkt_str(layer, **kwargs)),
+            bbox, grid_size
+        )
 
     @classmethod
     def test_get_points_as_wkt_str(class_, layer, **kwargs):
@@ -598,28 +1004,25 @@ class MappablePoint(Base):
 
         log.debug("Start: get_points_as_wkt_str")
 
-        start_t = datetime.datetime.now()
-
-        result = class_.get_points_as_wkt_str(layer, **kwargs)
-
-        end_t = datetime.datetime.now()
-        delta_t = end_t - start_t
-        delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+        result, timing = class_.benchmark(lambda: class_.get_points_as_wkt_str(layer, **kwargs))
+        delta_t_s = timing['median']
 
         log.debug("End: get_points_as_wkt_str")
 
 
 
         log.info(
-            "(%s) get_points_as_wkt_str(%s, %s) string length: %i, took: seconds: %f",
+            "(%s) get_points_as_wkt_str(%s, %s) string length: %i, took: seconds: %f (cold: %f, p95: %f)",
             class_.__name__,
             layer.name,
             kwargs,
             len(result),
             delta_t_s,
+            timing['cold'],
+            timing['p95'],
         )
 
-        return ["get_points_as_wkt_str", class_.__name__, layer.name, len(result), delta_t_s, kwargs, class_.extra_log_details()]
+        return ["get_points_as_wkt_str", class_.__name__, layer.name, len(result), delta_t_s, kwargs, class_.get_request_log_details(layer, **kwargs), timing]
 
     @classmethod
     def write_get_points_as_wkt_str_csv(class_, results_dir, in_rows):
@@ -701,5 +1104,204 @@ class MappablePoint(Base):
             my_writer.writerows(string_length_rows)
 
     @classmethod
-    def extra_log_details(class_):
+    def parse_wkt_point(class_, wkt):
+        """ The (x, y) of a WKT POINT, e.g. a centroid from get_points_as_wkt """
+        x, y = wkt[wkt.index('(') + 1:wkt.rindex(')')].split()
+        return float(x), float(y)
+
+    @classmethod
+    def iter_points_as_packed_str(class_, layer, **kwargs):
+        """ Generate the layer's clusters in the packed format as a sequence of
+            byte string chunks.
+        """
+        q = class_.get_points_as_wkt(layer, **kwargs)
+        return class_.iter_packed_str(q)
+
+    @classmethod
+    def iter_packed_str(class_, q):
+        """ Generate the (centroid, cluster_size) rows of a WKT query as packed
+            PACKED_CLUSTER structs (12 bytes per cluster, ready to upload as a
+            typed array). Each chunk holds up to SERIALIZE_CHUNK_SIZE clusters.
+        """
+        pack = class_.PACKED_CLUSTER.pack
+
+        clusters = []
+        for el in class_.stream_query(q):
+            x, y = class_.parse_wkt_point(el.centroid)
+            clusters.append(pack(x, y, el.cluster_size))
+
+            if len(clusters) == class_.SERIALIZE_CHUNK_SIZE:
+                yield ''.join(clusters)
+                clusters = []
+
+        if clusters:
+            yield ''.join(clusters)
+
+    @classmethod
+    def get_points_as_packed_str(class_, layer, **kwargs):
+        """ The layer's clusters in the packed format, from the cluster cache
+            if it's configured.
+        """
+        bbox, grid_size = class_.get_cache_key_params(layer=layer, **kwargs)
+        return get_or_create_clusters_str(
+            class_, layer, 'packed',
+            lambda: ''.join(class_.iter_points_as_packed_str(layer, **kwargs)),
+            bbox, grid_size
+        )
+
+    @classmethod
+    def iter_points_as_twkb_str(class_, layer, **kwargs):
+        """ Generate the layer's clusters as TWKB. The count of the clusters
+            comes first, so this is a single chunk.
+        """
+        q = class_.get_points_as_wkt(layer, **kwargs)
+        yield class_.get_twkb_str(q, class_.get_twkb_precision(class_.get_coordinate_precision(layer, **kwargs)))
+
+    @classmethod
+    def get_points_as_encoded_str(class_, layer, format, encoding=None, **kwargs):
+        """ The layer's clusters in the format (geojson, wkt, twkb or packed),
+            compressed with the content encoding (if not None). Both the
+            response and its compressed copy are cached if the cluster cache
+            is configured.
+        """
+        bbox, grid_size = class_.get_cache_key_params(layer=layer, **kwargs)
+        iter_method = getattr(class_, 'iter_points_as_%s_str' % format)
+        return get_or_create_encoded_clusters_str(
+            class_, layer, format, encoding,
+            lambda: ''.join(iter_method(layer, **kwargs)),
+            bbox, grid_size
+        )
+
+    @classmethod
+    def test_get_points_as_compressed_str(class_, layer, format='geojson', **kwargs):
+        """ Compress the layer's clusters in the format with each of the
+            content encodings, and measure the compressed length and the CPU
+            time (and wall time) compressing took. Returns a row per encoding.
+        """
+        log = logging.getLogger(__name__)
+
+        body = ''.join(getattr(class_, 'iter_points_as_%s_str' % format)(layer, **kwargs))
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+
+        rows = []
+        for encoding in get_encodings():
+            result, cpu_delta_t_s, delta_t_s = time_cpu_call(lambda: compress(body, encoding))
+
+            log.info(
+                "(%s) get_points_as_compressed_str(%s, %s, %s, %s) string length: %i, compressed length: %i, took: CPU seconds: %f (seconds: %f)",
+                class_.__name__,
+                layer.name,
+                format,
+                encoding,
+                kwargs,
+                len(body),
+                len(result),
+                cpu_delta_t_s,
+                delta_t_s,
+            )
+
+            rows.append(["get_points_as_compressed_str", class_.__name__, layer.name, format, encoding, len(body), len(result), cpu_delta_t_s, delta_t_s, kwargs, class_.get_request_log_details(layer, **kwargs)])
+
+        return rows
+
+    @classmethod
+    def write_get_points_as_compressed_str_csv(class_, results_dir, in_rows):
+        rows =  [row for row in in_rows if row[0] == "get_points_as_compressed_str"]
+
+        out_rows = [["Strategy", "Layer", "BBOX", "Format", "Encoding", "String Length", "Compressed Length", "Compression Ratio", "CPU Seconds", "Seconds"]]
+        for row in rows:
+            strategy, layer_name, format, encoding, string_length, compressed_length, cpu_delta_t_s, delta_t_s, kwargs = row[1:10]
+            ratio = compressed_length / float(string_length) if string_length else None
+            out_rows.append([strategy, layer_name, str(kwargs["bbox"]), format, encoding, string_length, compressed_length, ratio, cpu_delta_t_s, delta_t_s])
+
+        get_points_as_compressed_str_csv = os.path.join(results_dir, "get_points_as_compressed_str.csv")
+        with open(get_points_as_compressed_str_csv, 'wb') as csvfile:
+            my_writer = csv.writer(csvfile, delimiter=',')
+            my_writer.writerows(out_rows)
+
+    @classmethod
+    def get_twkb_precision(class_, precision=None):
+        """ The TWKB precision of coordinates output to precision decimal
+            places: no finer than TWKB_PRECISION
+        """
+        if precision == None:
+            return class_.TWKB_PRECISION
+
+        return min(precision, class_.TWKB_PRECISION)
+
+    @classmethod
+    def get_twkb_str(class_, q, precision=None):
+        """ The (centroid, cluster_size) rows of a WKT query as a TWKB
+            MultiPoint, with each cluster's size as its id.
+
+            Coordinates are rounded to precision decimal places (defaults to
+            TWKB_PRECISION), and delta encoded as zigzag varints.
+        """
+        if precision == None:
+            precision = class_.TWKB_PRECISION
+
+        scale = 10 ** precision
+
+        rows = [(class_.parse_wkt_point(el.centroid), el.cluster_size) for el in class_.stream_query(q)]
+
+        twkb = bytearray()
+        twkb.append(class_.TWKB_MULTIPOINT | (class_.zigzag(precision) << 4))
+
+        if not rows:
+            twkb.append(class_.TWKB_EMPTY_FLAG)
+            return str(twkb)
+
+        twkb.append(class_.TWKB_IDLIST_FLAG)
+        class_.append_varint(twkb, len(rows))
+
+        for point, cluster_size in rows:
+            class_.append_varint(twkb, class_.zigzag(cluster_size))
+
+        last_x, last_y = 0, 0
+        for (x, y), cluster_size in rows:
+            x, y = int(round(x * scale)), int(round(y * scale))
+            class_.append_varint(twkb, class_.zigzag(x - last_x))
+            class_.append_varint(twkb, class_.zigzag(y - last_y))
+            last_x, last_y = x, y
+
+        return str(twkb)
+
+    @classmethod
+    def get_points_as_twkb_str(class_, layer, **kwargs):
+        """ The layer's clusters as TWKB, from the cluster cache if it's configured """
+        bbox, grid_size = class_.get_cache_key_params(layer=layer, **kwargs)
+        return get_or_create_clusters_str(
+            class_, layer, 'twkb',
+            lambda: ''.join(class_.iter_points_as_twkb_str(layer, **kwargs)),
+            bbox, grid_size
+        )
+
+    @classmethod
+    def zigzag(class_, value):
+        """ ZigZag encode a signed integer (0, -1, 1, -2 => 0, 1, 2, 3) """
+        return value << 1 if value >= 0 else ((-value) << 1) - 1
+
+    @classmethod
+    def append_varint(class_, buf, value):
+        """ Append an unsigned integer to the bytearray as a varint """
+        while value >= 0x80:
+            buf.append((value & 0x7f) | 0x80)
+            value >>= 7
+        buf.append(value)
+
+    @classmethod
+    def extra_log_details(class_, layer=None):
+        """ The strategy's settings (for the layer, if given) to log with its
+            benchmarks
+        """
         return {}
+
+    @classmethod
+    def get_request_log_details(class_, layer, **kwargs):
+        """ The extra_log_details of a benchmarked request, with the coordinate
+            precision of its output
+        """
+        details = dict(class_.extra_log_details(layer))
+        details["coordinate_precision"] = class_.get_coordinate_precision(layer, **kwargs)
+        return details
@@ -0,0 +1,132 @@
+""" Optional storage mode: the mappable_points and cached_mappable_point_cluster
+    tables list partitioned by layer_id (needs PostgreSQL 11+).
+
+    Each layer gets its own partition of both tables, created when the layer
+    is inserted and dropped when it's deleted. Queries filter by layer_id, so
+    they're pruned to the layer's partition (and its small indexes), and a
+    layer's points can be replaced with a TRUNCATE rather than a DELETE.
+"""
+import logging
+
+from thesis.models import (
+    Base,
+    Layer,
+    DEFAULT_PROJECTION,
+    )
+
+from sqlalchemy import event
+from sqlalchemy.sql import text
+
+""" The tables that are partitioned by layer_id """
+PARTITIONED_TABLES = ['mappable_points', 'cached_mappable_point_cluster']
+
+""" The DDL of the partitioned tables. The primary keys must include the
+    partition key.
+"""
+CREATE_PARTITIONED_TABLES_SQL = [
+    """
+    CREATE TABLE mappable_points (
+        id SERIAL,
+        layer_id INTEGER NOT NULL REFERENCES layers (id),
+        location geometry(POINT, %(projection)i),
+        PRIMARY KEY (id, layer_id)
+    ) PARTITION BY LIST (layer_id)
+    """,
+    """
+    CREATE INDEX idx_mappable_points_location ON mappable_points USING gist (location)
+    """,
+    """
+    CREATE TABLE cached_mappable_point_cluster (
+        id SERIAL,
+        cache_record_id INTEGER NOT NULL REFERENCES cache_records (id),
+        layer_id INTEGER NOT NULL REFERENCES layers (id),
+        cluster_size INTEGER NOT NULL,
+        centroid geometry(POINT, %(projection)i),
+        cell_x FLOAT,
+        cell_y FLOAT,
+        sum_x FLOAT,
+        sum_y FLOAT,
+        PRIMARY KEY (id, layer_id)
+    ) PARTITION BY LIST (layer_id)
+    """,
+    """
+    CREATE INDEX idx_cached_mappable_point_cluster_centroid
+    ON cached_mappable_point_cluster USING gist (centroid)
+    """,
+    """
+    CREATE INDEX ix_cached_mappable_point_cluster_cache_record_id
+    ON cached_mappable_point_cluster (cache_record_id)
+    """,
+    """
+    CREATE INDEX ix_cached_mappable_point_cluster_cell
+    ON cached_mappable_point_cluster (cache_record_id, cell_x, cell_y)
+    """,
+]
+
+def get_partition_name(table, layer_id):
+    """ The name of the layer's partition of the table """
+    return '%s_layer_%i' % (table, layer_id)
+
+def create_partitioned_tables(engine, projection=DEFAULT_PROJECTION):
+    """ Create all of the tables, with the PARTITIONED_TABLES partitioned
+        by layer_id. Partitions are then created as layers are added.
+    """
+    tables = [table for table in Base.metadata.sorted_tables if table.name not in PARTITIONED_TABLES]
+    Base.metadata.create_all(engine, tables=tables)
+
+    connection = engine.connect()
+    try:
+        with connection.begin():
+            for sql in CREATE_PARTITIONED_TABLES_SQL:
+                connection.execute(sql % { 'projection': projection })
+    finally:
+        connection.close()
+
+def is_partitioned(connection):
+    """ Are the mappable points partitioned by layer in this database """
+    if connection.dialect.server_version_info < (10,):
+        # No declarative partitioning
+        return False
+
+    return connection.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = to_regclass('mappable_points'))"
+    )).scalar()
+
+def create_layer_partitions(connection, layer_id):
+    """ Create the layer's partition of each of the PARTITIONED_TABLES """
+    log = logging.getLogger(__name__)
+
+    for table in PARTITIONED_TABLES:
+        partition = get_partition_name(table, layer_id)
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES IN (%i)" %
+            (partition, table, layer_id)
+        )
+        log.debug("Created partition: %s", partition)
+
+def drop_layer_partitions(connection, layer_id):
+    """ Drop the layer's partitions, and with them its points and clusters """
+    log = logging.getLogger(__name__)
+
+    for table in PARTITIONED_TABLES:
+        partition = get_partition_name(table, layer_id)
+        connection.execute("DROP TABLE IF EXISTS %s" % partition)
+        log.debug("Dropped partition: %s", partition)
+
+def truncate_layer_partitions(connection, layer_id):
+    """ Empty the layer's partitions, e.g. to reload the layer's points.
+        The layer's cache records should be deleted or rebuilt after.
+    """
+    connection.execute("TRUNCATE %s" % ", ".join(
+        get_partition_name(table, layer_id) for table in PARTITIONED_TABLES
+    ))
+
+@event.listens_for(Layer, 'after_insert')
+def layer_after_insert(mapper, connection, layer):
+    if is_partitioned(connection):
+        create_layer_partitions(connection, layer.id)
+
+@event.listens_for(Layer, 'before_delete')
+def layer_before_delete(mapper, connection, layer):
+    if is_partitioned(connection):
+        drop_layer_partitions(connection, layer.id)
@@ -0,0 +1,383 @@
+import logging
+import math
+
+from thesis.models import (
+    DBSession,
+    Base,
+    Layer,
+    DEFAULT_PROJECTION,
+    GriddedAndBoundMappablePoint,
+    CachedGriddedAndBoundMappablePoint,
+    ST_MakeEnvelope,
+    )
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    Float,
+    Text,
+    Unicode,
+    ForeignKey,
+    Index,
+    )
+
+from sqlalchemy.sql import (
+    text,
+    literal_column,
+    )
+
+from sqlalchemy.orm import (
+    relationship,
+    backref,
+    )
+
+from sqlalchemy import func as func
+
+from zope.sqlalchemy import mark_changed
+
+from thesis.cache import (
+    invalidate_layer_after_commit,
+    get_or_create_encoded_clusters_str,
+    )
+
+from geoalchemy2 import *
+import geoalchemy2.functions as geo_func
+
+class TiledCachedMappablePoint(GriddedAndBoundMappablePoint):
+    """ Caches a layer's clusters per standard web map (z/x/y) tile.
+
+        The clusters of each zoom level are built at a grid size derived
+        from the zoom level's tile size, and each cluster is stored against
+        the tile containing its centroid. A tile is then served straight
+        from the cache, and the same tiles are shared by every client.
+    """
+
+    class CachedTileCluster(Base):
+        __tablename__ = 'cached_tile_clusters'
+        id = Column(Integer, primary_key=True)
+
+        # The cached tile cluster MUST be associated with a layer
+        layer_id = Column(Integer, ForeignKey("layers.id"), nullable=False)
+        layer = relationship("Layer", backref=backref("cached_tile_clusters", order_by=id, enable_typechecks=False))
+
+        zoom = Column(Integer, nullable=False)
+        tile_x = Column(Integer, nullable=False)
+        tile_y = Column(Integer, nullable=False)
+
+        cluster_size = Column(Integer, nullable=False)
+        centroid = Column(Geometry(geometry_type='POINT', srid=DEFAULT_PROJECTION))
+
+        __table_args__ = (
+            Index('ix_cached_tile_clusters_tile', 'layer_id', 'zoom', 'tile_x', 'tile_y'),
+        )
+
+    """ The zoom levels that are cached. Past these, the grid size is 0 (the
+        points aren't clustered), and tiles are served from the points.
+    """
+    TILE_ZOOMS = range(0, 12)
+
+    """ The latitude limits of the (web mercator) tiles """
+    MAX_LATITUDE = 85.0511287798
+
+    """ How long clients and caches may hold on to a tile (seconds) """
+    TILE_CACHE_MAX_AGE = 86400
+
+    """ The name of the layer, the extent (tile coordinate resolution) and the
+        projection of the vector tiles
+    """
+    MVT_LAYER_NAME = 'clusters'
+    MVT_EXTENT = 4096
+    MVT_PROJECTION = 3857
+
+    """ Build a zoom level's tile clusters from the aggregates of the layer's
+        points at the zoom level's grid size. The tile of each cluster is the
+        tile containing its centroid.
+    """
+    INSERT_TILE_CLUSTERS_SQL = """
+        INSERT INTO cached_tile_clusters
+            (layer_id, zoom, tile_x, tile_y, cluster_size, centroid)
+        SELECT
+            :layer_id,
+            :zoom,
+            LEAST(GREATEST(floor((centroid_x + 180.0) / 360.0 * :tiles), 0), :tiles - 1),
+            LEAST(GREATEST(floor(
+                (1.0 - ln(tan(radians(centroid_lat)) + 1.0 / cos(radians(centroid_lat))) / pi()) / 2.0 * :tiles
+            ), 0), :tiles - 1),
+            cluster_size,
+            ST_SetSRID(ST_MakePoint(centroid_x, centroid_y), :projection)
+        FROM (
+            SELECT
+                cluster_size,
+                sum_x / cluster_size AS centroid_x,
+                sum_y / cluster_size AS centroid_y,
+                LEAST(GREATEST(sum_y / cluster_size, -:max_latitude), :max_latitude) AS centroid_lat
+            FROM (%s) AS clusters
+        ) AS centroids
+    """ % CachedGriddedAndBoundMappablePoint.CACHE_CLUSTER_AGGREGATES_SQL
+
+    @classmethod
+    def pre_process(class_, layer, **kwargs):
+        """ Generate the tile clusters of all of the cached zoom levels """
+        class_.generate_tile_cache(layer)
+
+    @classmethod
+    def generate_tile_cache(class_, layer, projection=DEFAULT_PROJECTION):
+        log = logging.getLogger(__name__)
+        log.debug("Generating tile cache for layer: %s", layer.name)
+
+        DBSession.query(class_.CachedTileCluster).filter(
+            class_.CachedTileCluster.layer_id == layer.id
+        ).delete(synchronize_session=False)
+
+        for zoom in class_.TILE_ZOOMS:
+            result = DBSession.execute(text(class_.INSERT_TILE_CLUSTERS_SQL), {
+                'layer_id': layer.id,
+                'zoom': zoom,
+                'tiles': 2 ** zoom,
+                'grid_size': class_.get_tile_grid_size(zoom),
+                'max_latitude': class_.MAX_LATITUDE,
+                'projection': projection,
+            })
+            log.debug("Generated %i tile clusters for zoom: %i", result.rowcount, zoom)
+
+        mark_changed(DBSession())
+        invalidate_layer_after_commit(layer.id)
+
+        log.debug("Finished generating tile cache for layer: %s", layer.name)
+
+    @classmethod
+    def get_tile_grid_size(class_, zoom):
+        """ The (normalised) grid size of a zoom level, from the span of its tiles """
+        tile_span = 360.0 / (2 ** zoom)
+        return class_.normalise_grid_size(tile_span / class_.GRID_SIZE_WINDOW_FRACTION)
+
+    @classmethod
+    def get_zoom_for_grid_size(class_, grid_size):
+        """ The cached zoom level clustered at the (normalised) grid size.
+            Returns None if no cached zoom level is.
+        """
+        for zoom in class_.TILE_ZOOMS:
+            if class_.get_tile_grid_size(zoom) == grid_size:
+                return zoom
+
+        return None
+
+    @classmethod
+    def get_tile_x(class_, lng, zoom):
+        tiles = 2 ** zoom
+        return min(max(int(math.floor((lng + 180.0) / 360.0 * tiles)), 0), tiles - 1)
+
+    @classmethod
+    def get_tile_y(class_, lat, zoom):
+        tiles = 2 ** zoom
+        lat = math.radians(min(max(lat, -class_.MAX_LATITUDE), class_.MAX_LATITUDE))
+        y = (1.0 - math.log(math.tan(lat) + 1.0 / math.cos(lat)) / math.pi) / 2.0 * tiles
+        return min(max(int(math.floor(y)), 0), tiles - 1)
+
+    @classmethod
+    def get_tile_bbox(class_, zoom, x, y):
+        """ The w,s,e,n bounds of a tile """
+        tiles = float(2 ** zoom)
+
+        tile_lat = lambda y: math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / tiles))))
+
+        return [
+            x / tiles * 360.0 - 180.0,
+            tile_lat(y + 1),
+            (x + 1) / tiles * 360.0 - 180.0,
+            tile_lat(y),
+        ]
+
+    @classmethod
+    def is_valid_tile(class_, zoom, x, y):
+        return zoom >= 0 and 0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom
+
+    @classmethod
+    def get_tile_clusters(class_, layer, zoom, centroid_function, bbox=None, tile_xs=None, tile_ys=None):
+        """ Query the cached clusters of a zoom level within a range of tiles
+            (and optionally, a bbox).
+        """
+        CachedTileCluster = class_.CachedTileCluster
+
+        precision = class_.get_tile_coordinate_precision(zoom)
+
+        q = DBSession.query(
+            class_.format_centroid(centroid_function, CachedTileCluster.centroid, precision).label('centroid'),
+            CachedTileCluster.cluster_size.label('cluster_size')
+        ).filter(
+            CachedTileCluster.layer_id == layer.id
+        ).filter(
+            CachedTileCluster.zoom == zoom
+        ).filter(
+            CachedTileCluster.tile_x.between(*tile_xs)
+        ).filter(
+            CachedTileCluster.tile_y.between(*tile_ys)
+        )
+
+        if bbox != None:
+            q = q.filter(CachedTileCluster.centroid.intersects(ST_MakeEnvelope(*bbox)))
+
+        return q
+
+    @classmethod
+    def get_tile_coordinate_precision(class_, zoom):
+        """ The decimal places of the centroids of a zoom level's tiles """
+        return class_.compute_coordinate_precision(grid_size=class_.get_tile_grid_size(zoom))
+
+    @classmethod
+    def get_tile(class_, layer, zoom, x, y, centroid_function):
+        if zoom not in class_.TILE_ZOOMS:
+            # Not cached, cluster the tile's points at the zoom's grid size
+            tile_bbox = class_.get_tile_bbox(zoom, x, y)
+            grid_size = class_.get_tile_grid_size(zoom)
+
+            if centroid_function == geo_func.ST_AsGeoJSON:
+                return GriddedAndBoundMappablePoint.get_points_as_geojson(layer, bbox=tile_bbox, grid_size=grid_size)
+            else:
+                return GriddedAndBoundMappablePoint.get_points_as_wkt(layer, bbox=tile_bbox, grid_size=grid_size)
+
+        return class_.get_tile_clusters(layer, zoom, centroid_function, tile_xs=(x, x), tile_ys=(y, y))
+
+    @classmethod
+    def get_tile_as_geojson(class_, layer, zoom, x, y):
+        return class_.get_tile(layer, zoom, x, y, geo_func.ST_AsGeoJSON)
+
+    @classmethod
+    def get_tile_as_wkt(class_, layer, zoom, x, y):
+        return class_.get_tile(layer, zoom, x, y, geo_func.ST_AsText)
+
+    @classmethod
+    def iter_tile_as_geojson_str(class_, layer, zoom, x, y):
+        return class_.iter_geojson_str(class_.get_tile_as_geojson(layer, zoom, x, y))
+
+    @classmethod
+    def iter_tile_as_wkt_str(class_, layer, zoom, x, y):
+        return class_.iter_wkt_str(class_.get_tile_as_wkt(layer, zoom, x, y))
+
+    @classmethod
+    def iter_tile_as_packed_str(class_, layer, zoom, x, y):
+        return class_.iter_packed_str(class_.get_tile_as_wkt(layer, zoom, x, y))
+
+    @classmethod
+    def iter_tile_as_twkb_str(class_, layer, zoom, x, y):
+        precision = class_.get_twkb_precision(class_.get_tile_coordinate_precision(zoom))
+        yield class_.get_twkb_str(class_.get_tile_as_wkt(layer, zoom, x, y), precision)
+
+    @classmethod
+    def get_tile_as_mvt(class_, layer, zoom, x, y):
+        """ The tile's clusters as a Mapbox Vector Tile (built by PostGIS 2.4+),
+            with a single MVT_LAYER_NAME layer of points with a cluster_size.
+        """
+        clusters = class_.get_tile_as_wkt(layer, zoom, x, y).subquery('clusters')
+
+        w, s, e, n = class_.get_tile_bbox(zoom, x, y)
+        tile_envelope = func.ST_Transform(ST_MakeEnvelope(w, s, e, n, DEFAULT_PROJECTION), class_.MVT_PROJECTION)
+
+        # Web mercator can't project the poles
+        centroid = func.ST_GeomFromText(clusters.c.centroid, DEFAULT_PROJECTION)
+        centroid = func.ST_SetSRID(func.ST_MakePoint(
+            func.ST_X(centroid),
+            func.least(func.greatest(func.ST_Y(centroid), -class_.MAX_LATITUDE), class_.MAX_LATITUDE)
+        ), DEFAULT_PROJECTION)
+
+        tile = DBSession.query(
+            func.ST_AsMVTGeom(
+                func.ST_Transform(centroid, class_.MVT_PROJECTION),
+                tile_envelope,
+                class_.MVT_EXTENT
+            ).label('geom'),
+            clusters.c.cluster_size.label('cluster_size')
+        ).subquery('tile')
+
+        mvt = DBSession.query(
+            func.ST_AsMVT(literal_column('tile'), class_.MVT_LAYER_NAME, class_.MVT_EXTENT, 'geom')
+        ).select_from(tile).scalar()
+
+        return str(mvt) if mvt != None else ''
+
+    @classmethod
+    def iter_tile_as_mvt_str(class_, layer, zoom, x, y):
+        yield class_.get_tile_as_mvt(layer, zoom, x, y)
+
+    @classmethod
+    def get_tile_as_encoded_str(class_, layer, zoom, x, y, format, encoding=None):
+        """ The tile in the format (geojson, wkt, twkb, packed or mvt),
+            compressed with the content encoding (if not None). Both the tile
+            and its compressed copy are cached if the cluster cache is
+            configured.
+        """
+        iter_method = getattr(class_, 'iter_tile_as_%s_str' % format)
+        return get_or_create_encoded_clusters_str(
+            class_, layer, 'tile.%s' % format, encoding,
+            lambda: ''.join(iter_method(layer, zoom, x, y)),
+            class_.get_tile_bbox(zoom, x, y), class_.get_tile_grid_size(zoom)
+        )
+
+    @classmethod
+    def get_bbox_clusters(class_, layer, bbox, grid_size, centroid_function):
+        """ Answer an arbitrary bbox request from the tiles of the zoom level
+            with the request's (normalised) grid size.
+        """
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        normalised_grid_size = class_.normalise_grid_size(grid_size)
+        zoom = class_.get_zoom_for_grid_size(normalised_grid_size)
+
+        if zoom == None:
+            return None
+
+        w, s, e, n = bbox
+        tile_xs = (class_.get_tile_x(w, zoom), class_.get_tile_x(e, zoom))
+        # Tile y increases southwards
+        tile_ys = (class_.get_tile_y(n, zoom), class_.get_tile_y(s, zoom))
+
+        return class_.get_tile_clusters(layer, zoom, centroid_function, bbox, tile_xs, tile_ys)
+
+    @classmethod
+    def get_cache_key_params(class_, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        if grid_size == None:
+            grid_size = class_.get_cluster_grid_size(bbox)
+
+        return (list(bbox), class_.normalise_grid_size(grid_size))
+
+    @classmethod
+    def get_layers_points(class_, layers, format, **kwargs):
+        # The tiles are per layer, so fan the layers out
+        return class_.fan_out_layers(layers, 'get_points_as_%s' % format, **kwargs)
+
+    @classmethod
+    def query_bboxes_points(class_, layer, bboxes, format, grid_sizes):
+        # The tiles are per bbox, so query each bbox in turn
+        return class_.query_each_bbox_points(layer, bboxes, format, grid_sizes)
+
+    @classmethod
+    def get_points_as_geojson(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        q = class_.get_bbox_clusters(layer, bbox, grid_size, geo_func.ST_AsGeoJSON)
+
+        if q == None:
+            # The grid size isn't cached, cluster the points
+            if grid_size == None:
+                grid_size = class_.get_cluster_grid_size(bbox)
+            q = GriddedAndBoundMappablePoint.get_points_as_geojson(layer, bbox, class_.normalise_grid_size(grid_size))
+
+        return q
+
+    @classmethod
+    def get_points_as_wkt(class_, layer, bbox=[-180,-90,180,90], grid_size=None, **kwargs):
+        q = class_.get_bbox_clusters(layer, bbox, grid_size, geo_func.ST_AsText)
+
+        if q == None:
+            # The grid size isn't cached, cluster the points
+            if grid_size == None:
+                grid_size = class_.get_cluster_grid_size(bbox)
+            q = GriddedAndBoundMappablePoint.get_points_as_wkt(layer, bbox, class_.normalise_grid_size(grid_size))
+
+        return q
+
+    @classmethod
+    def extra_log_details(class_, layer=None):
+        return {
+            "tile_zooms": class_.TILE_ZOOMS,
+            "tile_grid_sizes": [class_.get_tile_grid_size(zoom) for zoom in class_.TILE_ZOOMS],
+        }
@@ -0,0 +1,261 @@
+""" The viewports requested of the cluster API, counted so the hottest of
+    them can be replayed into the cluster cache (see ViewportAccess.warm)
+    after a deploy or a pre_process, rather than the cache starting cold.
+"""
+import logging
+import datetime
+import threading
+import time
+import atexit
+
+from thesis.models import DBSession, Base
+from thesis.models.layer import Layer
+from thesis.models.mappable_point import MappablePoint
+from thesis.models.gridded_mappable_point import GriddedMappablePoint
+
+from thesis.compression import get_encodings
+
+from sqlalchemy import (
+    Column,
+    Integer,
+    Float,
+    Text,
+    DateTime,
+    ForeignKey,
+    UniqueConstraint,
+    )
+
+from sqlalchemy.sql import text
+
+class ViewportAccess(Base):
+    """ The hits of a (layer, strategy, format, canonical bbox, normalised
+        grid size) cluster request
+    """
+    __tablename__ = 'viewport_accesses'
+    id = Column(Integer, primary_key=True)
+
+    layer_id = Column(Integer, ForeignKey("layers.id", ondelete='CASCADE'), nullable=False)
+    strategy = Column(Text, nullable=False)
+    format = Column(Text, nullable=False)
+    grid_size = Column(Float, nullable=False)
+    w = Column(Float, nullable=False)
+    s = Column(Float, nullable=False)
+    e = Column(Float, nullable=False)
+    n = Column(Float, nullable=False)
+
+    hits = Column(Integer, nullable=False, default=0)
+    last_accessed = Column(DateTime, nullable=False)
+
+    __table_args__ = (
+        UniqueConstraint(
+            'layer_id', 'strategy', 'format', 'grid_size', 'w', 's', 'e', 'n',
+            name='uq_viewport_accesses_viewport'
+        ),
+    )
+
+    """ Record the accesses of the cluster API (set by the app from the
+        thesis.record_viewport_accesses setting)
+    """
+    RECORD_ACCESSES = False
+
+    """ Buffered hits are written at least this often (seconds) """
+    FLUSH_INTERVAL = 60
+
+    """ Buffered hits are written once this many viewports are pending """
+    FLUSH_MAX_PENDING = 1000
+
+    """ The number of viewports warmed by default """
+    DEFAULT_WARM_TOP_N = 100
+
+    """ Viewports not accessed in this many days aren't warmed """
+    WARM_MAX_AGE_DAYS = 7
+
+    """ Add the buffered hits of the viewports to their rows (creating them).
+        Needs PostgreSQL 9.5+ (ON CONFLICT).
+    """
+    UPSERT_SQL = """
+        INSERT INTO viewport_accesses (layer_id, strategy, format, grid_size, w, s, e, n, hits, last_accessed)
+        VALUES (:layer_id, :strategy, :format, :grid_size, :w, :s, :e, :n, :hits, :last_accessed)
+        ON CONFLICT ON CONSTRAINT uq_viewport_accesses_viewport DO UPDATE SET
+            hits = viewport_accesses.hits + EXCLUDED.hits,
+            last_accessed = greatest(viewport_accesses.last_accessed, EXCLUDED.last_accessed)
+    """
+
+    # The hits not yet written: {viewport: [hits, last accessed]}
+    pending_hits = {}
+    pending_hits_lock = threading.Lock()
+    flushed_at = time.time()
+
+    @property
+    def bbox(self):
+        return [self.w, self.s, self.e, self.n]
+
+    @classmethod
+    def record(class_, strategy, layer, format, bbox, grid_size):
+        """ Count a hit of the (canonical) viewport. Hits are buffered, and
+            written every FLUSH_INTERVAL seconds (or FLUSH_MAX_PENDING
+            viewports), so recording doesn't add a write to every request.
+        """
+        if not class_.RECORD_ACCESSES or bbox == None or grid_size == None:
+            return
+
+        viewport = (layer.id, strategy.__name__, format, float(grid_size)) + tuple(float(edge) for edge in bbox)
+
+        with class_.pending_hits_lock:
+            pending = class_.pending_hits.setdefault(viewport, [0, None])
+            pending[0] += 1
+            pending[1] = datetime.datetime.utcnow()
+
+            flush = (
+                len(class_.pending_hits) >= class_.FLUSH_MAX_PENDING or
+                time.time() - class_.flushed_at >= class_.FLUSH_INTERVAL
+            )
+
+        if flush:
+            class_.flush()
+
+    @classmethod
+    def flush(class_):
+        """ Write the buffered hits, in a transaction of their own. Hits that
+            fail to be written are logged and dropped.
+        """
+        log = logging.getLogger(__name__)
+
+        with class_.pending_hits_lock:
+            pending_hits = class_.pending_hits
+            class_.pending_hits = {}
+            class_.flushed_at = time.time()
+
+        if not pending_hits:
+            return 0
+
+        rows = [
+            {
+                'layer_id': layer_id,
+                'strategy': strategy,
+                'format': format,
+                'grid_size': grid_size,
+                'w': w, 's': s, 'e': e, 'n': n,
+                'hits': hits,
+                'last_accessed': last_accessed,
+            }
+            for (layer_id, strategy, format, grid_size, w, s, e, n), (hits, last_accessed) in pending_hits.iteritems()
+        ]
+
+        try:
+            connection = DBSession.get_bind().connect()
+            try:
+                with connection.begin():
+                    connection.execute(text(class_.UPSERT_SQL), rows)
+            finally:
+                connection.close()
+        except Exception, e:
+            log.warn("Couldn't record %i viewport accesses: %s", len(rows), e)
+            return 0
+
+        log.debug("Recorded %i viewport accesses", len(rows))
+        return len(rows)
+
+    @classmethod
+    def get_top(class_, top_n=DEFAULT_WARM_TOP_N, layer_ids=None, max_age_days=WARM_MAX_AGE_DAYS):
+        """ The top_n most accessed viewports (of the layers, if given) that
+            were accessed within the last max_age_days days, hottest first
+        """
+        ViewportAccess = class_
+        q = DBSession.query(ViewportAccess)
+
+        if layer_ids:
+            q = q.filter(ViewportAccess.layer_id.in_(layer_ids))
+
+        if max_age_days != None:
+            since = datetime.datetime.utcnow() - datetime.timedelta(days=max_age_days)
+            q = q.filter(ViewportAccess.last_accessed >= since)
+
+        q = q.order_by(ViewportAccess.hits.desc(), ViewportAccess.id)
+        return q.limit(top_n).all()
+
+    @classmethod
+    def get_neighbours(class_, strategy, layer, bbox, grid_size):
+        """ The canonical (bbox, grid_size) of the viewports a zoom out and a
+            zoom in from the viewport (about its centre), i.e. those a client
+            is likely to request next. Neighbours that canonicalise to the
+            viewport itself are left out.
+        """
+        # Strategies that don't grid are still canonicalised to the standard grid
+        gridded_strategy = strategy if issubclass(strategy, GriddedMappablePoint) else GriddedMappablePoint
+
+        w, s, e, n = bbox
+        centre_x = (w + e) / 2.0
+        centre_y = (s + n) / 2.0
+
+        neighbours = []
+        for scale in (2.0, 0.5):
+            half_width = (e - w) * scale / 2.0
+            half_height = (n - s) * scale / 2.0
+
+            neighbour_bbox, neighbour_grid_size = gridded_strategy.canonicalise_bbox(
+                [centre_x - half_width, centre_y - half_height, centre_x + half_width, centre_y + half_height],
+                grid_size * scale,
+                layer
+            )
+
+            if (neighbour_bbox, neighbour_grid_size) != (list(bbox), grid_size):
+                neighbours.append((neighbour_bbox, neighbour_grid_size))
+
+        return neighbours
+
+    @classmethod
+    def warm(class_, top_n=DEFAULT_WARM_TOP_N, neighbours=0, layer_ids=None,
+             encodings=None, max_age_days=WARM_MAX_AGE_DAYS):
+        """ Replay the top_n most accessed viewports into the cluster cache,
+            and the zoom out/in neighbours (see get_neighbours) of the hottest
+            `neighbours` of them. Each viewport's response is cached as is, and
+            compressed with each of the encodings (defaults to all of them).
+
+            Without a cluster cache, the queries still warm the database's
+            buffers.
+            Returns the number of responses warmed.
+        """
+        log = logging.getLogger(__name__)
+
+        class_.flush()
+
+        if encodings == None:
+            encodings = [None] + get_encodings()
+
+        accesses = class_.get_top(top_n, layer_ids, max_age_days)
+
+        viewports = []
+        for i, access in enumerate(accesses):
+            strategy = MappablePoint.get_strategy(access.strategy)
+            if strategy == None:
+                log.warn("Unknown strategy: %s, skipping", access.strategy)
+                continue
+
+            layer = DBSession.query(Layer).get(access.layer_id)
+            viewports.append((strategy, layer, access.format, access.bbox, access.grid_size))
+
+            if i < neighbours:
+                for bbox, grid_size in class_.get_neighbours(strategy, layer, access.bbox, access.grid_size):
+                    viewports.append((strategy, layer, access.format, bbox, grid_size))
+
+        viewports = MappablePoint.uniq_list(
+            [(strategy, layer, format, tuple(bbox), grid_size) for strategy, layer, format, bbox, grid_size in viewports]
+        )
+
+        warmed = 0
+        for strategy, layer, format, bbox, grid_size in viewports:
+            for encoding in encodings:
+                strategy.get_points_as_encoded_str(layer, format, encoding, bbox=list(bbox), grid_size=grid_size)
+                warmed += 1
+
+            log.debug(
+                "(%s) Warmed %s %s bbox: %s grid size: %s",
+                strategy.__name__, layer.name, format, list(bbox), grid_size
+            )
+
+        log.info("Warmed %i responses of %i viewports", warmed, len(viewports))
+        return warmed
+
+# Write what's left in the buffer on the way out
+atexit.register(ViewportAccess.flush)
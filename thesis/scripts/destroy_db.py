@@ -14,6 +14,8 @@ from ..models import (
     Base,
     )
 
+from ..cache import configure_cluster_cache, invalidate_all
+
 
 def usage(argv):
     cmd = os.path.basename(argv[0])
@@ -33,3 +35,6 @@ def main(argv=sys.argv):
     # Drop all the models
     Base.metadata.drop_all(engine)
     DBSession.remove()
+    # Layer ids will be reused, forget all of the cached responses
+    configure_cluster_cache(settings)
+    invalidate_all()
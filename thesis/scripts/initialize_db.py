@@ -9,6 +9,8 @@ from pyramid.paster import (
     setup_logging,
     )
 
+from pyramid.settings import asbool
+
 from thesis.models import *
 
 def usage(argv):
@@ -17,8 +19,14 @@ def usage(argv):
           '(example: "%s development.ini")' % (cmd, cmd))
     sys.exit(1)
 
-def initialize_db(engine):
-    Base.metadata.create_all(engine)
+def initialize_db(engine, partition_by_layer=False):
+    """ Create the tables. If partition_by_layer is set, the mappable points
+        and cached clusters are partitioned by layer (see thesis.models.partitioning).
+    """
+    if partition_by_layer:
+        create_partitioned_tables(engine)
+    else:
+        Base.metadata.create_all(engine)
 
 def main(argv=sys.argv):
     if len(argv) != 2:
@@ -28,4 +36,4 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri)
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
-    initialize_db(engine)
+    initialize_db(engine, asbool(settings.get('thesis.partition_by_layer', False)))
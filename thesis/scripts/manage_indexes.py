@@ -0,0 +1,259 @@
+import os
+import sys
+import re
+import transaction
+import logging
+import argparse
+
+from sqlalchemy import (
+    engine_from_config,
+    func,
+    )
+
+from zope.sqlalchemy import mark_changed
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from thesis.models import *
+
+""" The recommended indexes of the strategies' hot queries: (name, create SQL).
+
+    GeoAlchemy2 only creates a GiST index on each geometry column. The bound
+    strategies filter by layer_id and bbox, and the cached strategy by
+    cache_record_id and bbox, so they get composite GiST indexes
+    (btree_gist provides the GiST operator class of the integer column).
+"""
+INDEXES = [
+    (
+        'ix_mappable_points_layer_id_location',
+        'CREATE INDEX %s ix_mappable_points_layer_id_location '
+        'ON mappable_points USING gist (layer_id, location)'
+    ),
+    (
+        'ix_mappable_points_layer_id',
+        'CREATE INDEX %s ix_mappable_points_layer_id '
+        'ON mappable_points (layer_id)'
+    ),
+    (
+        'ix_cached_mappable_point_cluster_record_centroid',
+        'CREATE INDEX %s ix_cached_mappable_point_cluster_record_centroid '
+        'ON cached_mappable_point_cluster USING gist (cache_record_id, centroid)'
+    ),
+]
+
+""" The prefix of the per layer partial GiST indexes """
+LAYER_INDEX_PREFIX = 'ix_mappable_points_location_layer_'
+
+""" Layers with at least this many points get their own partial GiST index,
+    and have their hot queries verified (the planner rightly seq scans small
+    layers).
+"""
+DEFAULT_MIN_LAYER_POINTS = 100000
+
+""" The bbox of the verified queries: small, so an index scan is expected """
+VERIFY_BBOX = [152.557418, -27.738907, 153.266036, -27.271171]
+
+""" The strategies whose get_points_as_wkt queries are verified, and the
+    table each query should reach through an index
+"""
+VERIFY_STRATEGIES = [
+    (GriddedAndBoundMappablePoint, 'mappable_points'),
+    (CachedGriddedAndBoundMappablePoint, 'cached_mappable_point_cluster'),
+    (TiledCachedMappablePoint, 'cached_tile_clusters'),
+]
+
+def get_layer_point_counts(min_points=0, layer_names=None):
+    """ The (layer, point count) of the layers with at least min_points points """
+    q = DBSession.query(
+        Layer,
+        func.count(MappablePoint.id)
+    ).join(
+        MappablePoint, MappablePoint.layer_id == Layer.id
+    ).group_by(
+        Layer.id
+    ).having(
+        func.count(MappablePoint.id) >= min_points
+    )
+
+    if layer_names:
+        q = q.filter(Layer.name.in_(layer_names))
+
+    return q.all()
+
+def execute_ddl(engine, statements, concurrently=False):
+    """ Run the DDL statements. Concurrent index builds can't run in a
+        transaction, so they're run in autocommit mode.
+    """
+    log = logging.getLogger(__name__)
+
+    if concurrently:
+        connection = engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+        try:
+            for statement in statements:
+                log.info(statement)
+                connection.execute(statement)
+        finally:
+            connection.close()
+    else:
+        with transaction.manager:
+            for statement in statements:
+                log.info(statement)
+                DBSession.execute(statement)
+            mark_changed(DBSession())
+
+def is_partitioned_db(engine):
+    """ Are the tables partitioned by layer (see thesis.models.partitioning) """
+    connection = engine.connect()
+    try:
+        return is_partitioned(connection)
+    finally:
+        connection.close()
+
+def create_indexes(engine, min_points=DEFAULT_MIN_LAYER_POINTS, concurrently=False):
+    """ Create the recommended indexes, and a partial GiST index for each
+        layer with at least min_points points. Existing indexes are kept.
+
+        If the tables are partitioned by layer, each layer's partition already
+        has small indexes of its own, so there are no per layer partial
+        indexes. Indexes of partitioned tables can't be built concurrently.
+    """
+    log = logging.getLogger(__name__)
+
+    partitioned = is_partitioned_db(engine)
+    if partitioned and concurrently:
+        log.warn("Partitioned tables can't be indexed concurrently, locking out writes instead")
+        concurrently = False
+
+    option = 'CONCURRENTLY IF NOT EXISTS' if concurrently else 'IF NOT EXISTS'
+
+    statements = ['CREATE EXTENSION IF NOT EXISTS btree_gist']
+    statements += [create_sql % option for name, create_sql in INDEXES]
+
+    layer_ids = []
+    if not partitioned:
+        with transaction.manager:
+            layer_ids = [layer.id for layer, points in get_layer_point_counts(min_points)]
+
+    for layer_id in layer_ids:
+        statements.append(
+            'CREATE INDEX %s %s%i ON mappable_points USING gist (location) WHERE layer_id = %i' %
+            (option, LAYER_INDEX_PREFIX, layer_id, layer_id)
+        )
+
+    execute_ddl(engine, statements, concurrently)
+
+    with transaction.manager:
+        DBSession.execute('ANALYZE mappable_points')
+        DBSession.execute('ANALYZE cached_mappable_point_cluster')
+        mark_changed(DBSession())
+
+def drop_indexes(engine, concurrently=False):
+    """ Drop the recommended indexes, and all of the per layer partial indexes """
+    if concurrently and is_partitioned_db(engine):
+        logging.getLogger(__name__).warn("Partitioned tables' indexes can't be dropped concurrently")
+        concurrently = False
+
+    option = 'CONCURRENTLY IF EXISTS' if concurrently else 'IF EXISTS'
+
+    with transaction.manager:
+        layer_index_names = [row[0] for row in DBSession.execute(
+            "SELECT indexname FROM pg_indexes WHERE indexname LIKE :prefix",
+            { 'prefix': LAYER_INDEX_PREFIX + '%' }
+        )]
+
+    names = [name for name, create_sql in INDEXES] + layer_index_names
+
+    execute_ddl(engine, ['DROP INDEX %s %s' % (option, name) for name in names], concurrently)
+
+def explain(q):
+    """ The EXPLAIN plan of a query, as a list of lines """
+    compiled = q.statement.compile(dialect=DBSession.bind.dialect)
+    result = DBSession.connection().execute('EXPLAIN ' + unicode(compiled), compiled.params)
+    return [row[0] for row in result]
+
+def uses_index(plan, table):
+    """ Does the plan reach the table (or its layer partitions) through an
+        index, without a sequential scan
+    """
+    plan_text = '\n'.join(plan)
+    table_pattern = r'%s(_layer_\d+)?\b' % re.escape(table)
+
+    # Bitmap scans name the index on the Bitmap Index Scan, and the table on
+    # the Bitmap Heap Scan above it
+    return (
+        re.search(r'Seq Scan on ' + table_pattern, plan_text) == None and
+        re.search(r'(Index.*Scan|Bitmap Heap Scan).* on ' + table_pattern, plan_text) != None
+    )
+
+def verify_indexes(min_points=DEFAULT_MIN_LAYER_POINTS, layer_names=None, bbox=VERIFY_BBOX):
+    """ EXPLAIN the get_points_as_wkt queries of each strategy, for each layer
+        with at least min_points points, and check they use an index.
+
+        Strategies without a cache for the layer (whose query doesn't reach
+        their table) are skipped.
+        Returns the failures: (strategy name, layer name, plan).
+    """
+    log = logging.getLogger(__name__)
+
+    failures = []
+
+    with transaction.manager:
+        for layer, points in get_layer_point_counts(min_points, layer_names):
+            for strategy, table in VERIFY_STRATEGIES:
+                q = strategy.get_points_as_wkt(layer, bbox=bbox)
+
+                if table not in unicode(q.statement):
+                    log.info("(%s) %s has no cache, skipping", strategy.__name__, layer.name)
+                    continue
+
+                plan = explain(q)
+
+                if uses_index(plan, table):
+                    log.info("(%s) %s (%i points) uses an index", strategy.__name__, layer.name, points)
+                else:
+                    log.error(
+                        "(%s) %s (%i points) doesn't use an index:\n%s",
+                        strategy.__name__, layer.name, points, '\n'.join(plan)
+                    )
+                    failures.append((strategy.__name__, layer.name, plan))
+
+    return failures
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description="Create, drop or verify the indexes of the strategies' queries",
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('command', choices=['create', 'drop', 'verify'])
+    parser.add_argument(
+        '-m', '--min-points', type=int, default=DEFAULT_MIN_LAYER_POINTS,
+        help='the number of points a layer needs for its own partial index, '
+             'and for its queries to be verified (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-l', '--layer', action='append', dest='layer_names',
+        help='a layer to verify (default: all layers)'
+    )
+    parser.add_argument(
+        '--concurrently', action='store_true',
+        help="create/drop the indexes without locking out writes"
+    )
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+
+    if args.command == 'create':
+        create_indexes(engine, args.min_points, args.concurrently)
+    elif args.command == 'drop':
+        drop_indexes(engine, args.concurrently)
+    else:
+        failures = verify_indexes(args.min_points, args.layer_names)
+        if failures:
+            sys.exit(1)
@@ -0,0 +1,188 @@
+import os
+import sys
+import transaction
+import logging
+import datetime
+import uuid
+import argparse
+import multiprocessing
+
+from sqlalchemy import (
+    engine_from_config,
+    create_engine,
+    )
+
+from sqlalchemy.pool import NullPool
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from thesis.models import *
+from thesis.cache import configure_cluster_cache
+
+""" The number of worker processes, by default """
+DEFAULT_PROCESSES = multiprocessing.cpu_count()
+
+# Each worker process's own engine. Set up by init_worker.
+worker_engine = None
+
+def init_worker(db_url):
+    """ Give the worker process an engine (and connection) of its own """
+    global worker_engine
+    worker_engine = create_engine(db_url, poolclass=NullPool)
+
+def build_unit(unit):
+    """ Stage the cache clusters of a single (layer, grid size) build unit.
+        Runs in a worker process.
+    """
+    build_id, layer_id, grid_size = unit
+
+    start_t = datetime.datetime.now()
+
+    connection = worker_engine.connect()
+    try:
+        with connection.begin():
+            clusters = CachedGriddedAndBoundMappablePoint.stage_cache_clusters(
+                connection, build_id, layer_id, grid_size
+            )
+    finally:
+        connection.close()
+
+    end_t = datetime.datetime.now()
+    delta_t = end_t - start_t
+    delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+
+    return layer_id, grid_size, clusters, delta_t_s
+
+def pre_process_in_parallel(engine, layer_names=None, processes=DEFAULT_PROCESSES, replace=True, adaptive=False):
+    """ Build the CachedGriddedAndBoundMappablePoint cache of the named layers
+        (all layers by default), with the (layer, grid size) build units farmed
+        out to a pool of worker processes.
+
+        The workers stage their clusters, and the new cache records are then
+        created from the staged clusters in a single, final transaction.
+
+        If adaptive is set, each layer's own grid sizes are computed first,
+        and stored in the final transaction along with the cache built at them.
+    """
+    log = logging.getLogger(__name__)
+
+    class_ = CachedGriddedAndBoundMappablePoint
+    build_id = uuid.uuid4().hex
+
+    with transaction.manager:
+        q = DBSession.query(Layer)
+        if layer_names:
+            q = q.filter(Layer.name.in_(layer_names))
+
+        layers = []
+        for layer in q:
+            if adaptive:
+                grid_sizes = class_.compute_grid_sizes(layer)
+            else:
+                grid_sizes = class_.get_grid_sizes(layer)
+            layers.append((layer.id, layer.name, grid_sizes))
+
+    units = [
+        (build_id, layer_id, grid_size)
+        for layer_id, layer_name, grid_sizes in layers
+        for grid_size in grid_sizes
+    ]
+
+    log.info(
+        "Building cache for %i layers (%i build units) with %i processes",
+        len(layers),
+        len(units),
+        processes,
+    )
+
+    # Don't share the parent's connections with the workers
+    DBSession.remove()
+    engine.dispose()
+
+    start_t = datetime.datetime.now()
+
+    try:
+        pool = multiprocessing.Pool(processes, init_worker, (engine.url,))
+        try:
+            for layer_id, grid_size, clusters, delta_t_s in pool.imap_unordered(build_unit, units):
+                log.debug(
+                    "Staged %i clusters for layer %i grid size: %s, took: seconds: %f",
+                    clusters,
+                    layer_id,
+                    grid_size,
+                    delta_t_s,
+                )
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+        with transaction.manager:
+            for layer_id, layer_name, grid_sizes in layers:
+                layer = DBSession.query(Layer).get(layer_id)
+                if adaptive:
+                    class_.store_grid_sizes(layer, grid_sizes)
+                class_.commit_staged_cache(layer, build_id, grid_sizes, replace=replace)
+    finally:
+        # Clear out anything the build staged but didn't commit
+        with transaction.manager:
+            DBSession.query(class_.CacheBuildCluster).filter(
+                class_.CacheBuildCluster.build_id == build_id
+            ).delete(synchronize_session=False)
+
+    end_t = datetime.datetime.now()
+    delta_t = end_t - start_t
+    delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+
+    log.info("Built cache for %i layers, took: seconds: %f", len(layers), delta_t_s)
+
+    return delta_t_s
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description="Build the cluster cache of layers in parallel",
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument(
+        '-p', '--processes', type=int, default=DEFAULT_PROCESSES,
+        help='the number of worker processes (default: %(default)s)'
+    )
+    parser.add_argument(
+        '-l', '--layer', action='append', dest='layer_names',
+        help='a layer to build the cache of (default: all layers)'
+    )
+    parser.add_argument(
+        '--keep-existing', action='store_false', dest='replace',
+        help="don't delete the layers' existing cache records"
+    )
+    parser.add_argument(
+        '--adaptive', action='store_true',
+        help="compute each layer's own grid sizes from its points first"
+    )
+    parser.add_argument(
+        '--warm', type=int, default=0, metavar='TOP_N',
+        help="then warm the cluster cache with the TOP_N most accessed viewports"
+    )
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    configure_cluster_cache(settings)
+
+    pre_process_in_parallel(engine, args.layer_names, args.processes, args.replace, args.adaptive)
+
+    if args.warm:
+        with transaction.manager:
+            layer_ids = None
+            if args.layer_names:
+                layer_ids = [layer.id for layer in DBSession.query(Layer).filter(Layer.name.in_(args.layer_names))]
+
+            ViewportAccess.warm(args.warm, layer_ids=layer_ids)
@@ -3,15 +3,19 @@ import sys
 import transaction
 import csv
 import logging
+import datetime
 
 from sqlalchemy import engine_from_config
 
+from zope.sqlalchemy import mark_changed
+
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
     )
 
 from thesis.models import *
+from thesis.cache import configure_cluster_cache, invalidate_layer_after_commit
 
 LAYER_NAMES = [
     "10_points_worldwide",
@@ -29,7 +33,107 @@ def usage(argv):
           '(example: "%s development.ini")' % (cmd, cmd))
     sys.exit(1)
 
-def seed_db(layer_names = LAYER_NAMES):
+""" How often (in rows) the bulk loader reports progress """
+BULK_LOAD_PROGRESS_EVERY = 100000
+
+""" How many bytes psycopg2 reads from the csv file per COPY chunk """
+BULK_LOAD_READ_SIZE = 65536
+
+
+class CopyProgressReader(object):
+    """ Wraps a csv file handed to COPY, counting the rows as psycopg2
+        reads them so that we can report progress without buffering the file.
+    """
+
+    def __init__(self, csvfile, progress_callback=None, progress_every=BULK_LOAD_PROGRESS_EVERY):
+        self.csvfile = csvfile
+        self.progress_callback = progress_callback
+        self.progress_every = progress_every
+        self.rows = 0
+        self._next_report = progress_every
+
+    def read(self, size=BULK_LOAD_READ_SIZE):
+        data = self.csvfile.read(size)
+        self.rows += data.count('\n')
+
+        if self.progress_callback and self.rows >= self._next_report:
+            self.progress_callback(self.rows)
+            self._next_report = self.rows + self.progress_every
+
+        return data
+
+    def readline(self, size=-1):
+        line = self.csvfile.readline(size)
+        self.rows += line.count('\n')
+        return line
+
+
+def bulk_load_layer(layer, csvfile, progress_callback=None,
+        progress_every=BULK_LOAD_PROGRESS_EVERY, projection=DEFAULT_PROJECTION):
+    """ Stream a lng,lat csv file into the layer's mappable points using COPY.
+
+        The csv is copied into a temporary staging table of numeric
+        longitude/latitude pairs, and the point geometries are then built
+        server-side with a single INSERT ... SELECT. Memory use is bounded
+        by BULK_LOAD_READ_SIZE, regardless of the size of the file.
+
+        Takes the following params:
+            * layer : The (flushed) Layer to load the points into
+            * csvfile : An open file of longitude,latitude rows
+            * progress_callback : Called with the number of rows read so far
+            * progress_every : Roughly how many rows between progress_callback calls
+            * projection : The EPSG projection as an integer
+
+        Returns the number of points loaded.
+    """
+    log = logging.getLogger(__name__)
+
+    start_t = datetime.datetime.now()
+
+    connection = DBSession.connection()
+    cursor = connection.connection.cursor()
+
+    try:
+        cursor.execute(
+            "CREATE TEMPORARY TABLE seed_points "
+            "(longitude double precision, latitude double precision)"
+        )
+        cursor.copy_expert(
+            "COPY seed_points (longitude, latitude) FROM STDIN WITH CSV",
+            CopyProgressReader(csvfile, progress_callback, progress_every),
+            size=BULK_LOAD_READ_SIZE
+        )
+        cursor.execute(
+            "INSERT INTO mappable_points (layer_id, location) "
+            "SELECT %(layer_id)s, ST_SetSRID(ST_MakePoint(longitude, latitude), %(projection)s) "
+            "FROM seed_points",
+            {'layer_id': layer.id, 'projection': projection}
+        )
+        loaded = cursor.rowcount
+        cursor.execute("DROP TABLE seed_points")
+    finally:
+        cursor.close()
+
+    # We wrote behind the ORM's back, make sure the transaction commits.
+    mark_changed(DBSession())
+    invalidate_layer_after_commit(layer.id)
+
+    end_t = datetime.datetime.now()
+    delta_t = end_t - start_t
+    delta_t_s = delta_t.seconds + ( delta_t.microseconds *  (10 ** -6) )
+
+    log.info(
+        "Bulk loaded %i points into %s, took: seconds: %f (%f rows/sec)",
+        loaded,
+        layer.name,
+        delta_t_s,
+        loaded / delta_t_s if delta_t_s else float(loaded),
+    )
+
+    return loaded
+
+
+def seed_db(layer_names = LAYER_NAMES, bulk=True):
     log = logging.getLogger(__name__)
 
     scripts_path = os.path.dirname(os.path.abspath(__file__))
@@ -41,6 +145,19 @@ def seed_db(layer_names = LAYER_NAMES):
 
         layer_csv_path = os.path.join(test_fixtures_path, layer_name + '.csv')
 
+        if bulk:
+            # COPY needs the layer's id
+            DBSession.flush()
+
+            with open(layer_csv_path, 'rb') as csvfile:
+                bulk_load_layer(
+                    layer,
+                    csvfile,
+                    progress_callback=lambda rows: log.debug("Up to point: %i", rows)
+                )
+
+            continue
+
         with open(layer_csv_path, 'rb') as csvfile:
             layer_reader = csv.reader(csvfile)
 
@@ -68,5 +185,6 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri)
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
+    configure_cluster_cache(settings)
     with transaction.manager:
         seed_db()
@@ -0,0 +1,81 @@
+""" Serve the app from a single process of cooperative (gevent) greenlets,
+    rather than from waitress's thread per request.
+
+    psycopg2 is made to yield to the other greenlets while it waits on the
+    database (via psycogreen), so a request waiting on a cluster query doesn't
+    hold up the others, and the number of requests in flight is bounded by
+    the connection pool rather than by a thread count.
+
+    The strategies, views and queries are unchanged. Needs the gevent and
+    psycogreen packages (pip install thesis[green]).
+
+    The standard library is patched by the thesis_green module, which the
+    serve_green script runs, as it has to be patched before thesis is
+    imported.
+"""
+import os
+import sys
+import argparse
+
+""" The most requests in flight at once, by default """
+DEFAULT_MAX_REQUESTS = 1000
+
+""" The settings of the engine's connection pool, by default. The pool bounds
+    the number of concurrent queries (the rest of the requests wait for a
+    connection), so it's larger than the default pool.
+"""
+DEFAULT_POOL_SETTINGS = {
+    'sqlalchemy.pool_size': '20',
+    'sqlalchemy.max_overflow': '10',
+    'sqlalchemy.pool_timeout': '30',
+}
+
+def is_patched():
+    """ Was the standard library patched (by thesis_green) before thesis was
+        imported, so that each greenlet gets its own session
+    """
+    from gevent import monkey
+    return monkey.is_module_patched('threading')
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description="Serve the app from gevent greenlets, with non blocking database queries",
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=6543)
+    parser.add_argument(
+        '-m', '--max-requests', type=int, default=DEFAULT_MAX_REQUESTS,
+        help='the most requests in flight at once (default: %(default)s)'
+    )
+    args = parser.parse_args(argv[1:])
+
+    try:
+        patched = is_patched()
+    except ImportError, e:
+        sys.exit("%s: needs gevent and psycogreen (%s)" % (parser.prog, e))
+
+    if not patched:
+        sys.exit("%s: run from the thesis_green module, which patches the standard library before thesis is imported" % parser.prog)
+
+    from gevent.pool import Pool
+    from gevent.pywsgi import WSGIServer
+
+    from pyramid.paster import (
+        get_appsettings,
+        setup_logging,
+        )
+
+    from thesis import main as make_app
+
+    setup_logging(args.config_uri)
+
+    # The ini file's pool settings take precedence
+    app_settings = get_appsettings(args.config_uri)
+    settings = dict(DEFAULT_POOL_SETTINGS)
+    settings.update(app_settings)
+    app = make_app(app_settings.global_conf, **settings)
+
+    server = WSGIServer((args.host, args.port), app, spawn=Pool(args.max_requests))
+    server.serve_forever()
@@ -3,15 +3,25 @@ import sys
 import transaction
 import logging
 import gc
+import copy
 
-from sqlalchemy import engine_from_config
+from sqlalchemy import (
+    engine_from_config,
+    create_engine,
+    )
+
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.pool import NullPool
 
 from pyramid.paster import (
     get_appsettings,
     setup_logging,
     )
 
+from pyramid.settings import asbool
+
 from thesis.models import *
+import thesis.benchmark
 
 from thesis.scripts.seed_db import seed_db, LAYER_NAMES
 from thesis.scripts.initialize_db import initialize_db
@@ -49,6 +59,99 @@ def get_db_size(engine):
     ).fetchone()
     return int(res[0])
 
+def get_admin_engine(engine):
+    """ An engine of the server's maintenance (postgres) database, from which
+        the benchmark database can be dropped and created
+    """
+    url = copy.copy(engine.url)
+    url.database = 'postgres'
+    return create_engine(url, poolclass=NullPool)
+
+def get_template_name(engine):
+    """ The name of the template database snapshot of the benchmark database """
+    return '%s_template' % engine.url.database
+
+def disconnect(engine):
+    """ Close all of our connections to the engine's database, so it can be
+        dropped or used as a template
+    """
+    DBSession.remove()
+    engine.dispose()
+
+def execute_autocommit(admin_engine, statements):
+    """ Run the statements outside of a transaction (CREATE and DROP
+        DATABASE can't run in one)
+    """
+    log = logging.getLogger(__name__)
+
+    connection = admin_engine.connect().execution_options(isolation_level='AUTOCOMMIT')
+    try:
+        for statement in statements:
+            log.debug(statement)
+            connection.execute(statement)
+    finally:
+        connection.close()
+
+def clone_database(admin_engine, name, template):
+    """ (Re)create the database name as a copy of the template database """
+    execute_autocommit(admin_engine, [
+        'DROP DATABASE IF EXISTS "%s"' % name,
+        'CREATE DATABASE "%s" TEMPLATE "%s"' % (name, template),
+    ])
+
+def drop_database(admin_engine, name):
+    execute_autocommit(admin_engine, ['DROP DATABASE IF EXISTS "%s"' % name])
+
+def seed_layer(engine, layer_name, partition_by_layer=False):
+    """ Recreate the tables of the benchmark database, with only the layer """
+    log = logging.getLogger(__name__)
+
+    # Drop All
+    log.debug("Dropping DB")
+
+    DBSession.remove()
+    Base.metadata.drop_all(engine)
+
+    # Init DB
+    log.debug("Init DB")
+    DBSession.configure(bind=engine)
+    initialize_db(engine, partition_by_layer)
+    log.debug("End Init DB")
+
+    # Seed DB
+    log.debug("Start Seed DB")
+    with transaction.manager:
+        # Seed DB
+        seed_db([layer_name])
+    log.debug("End Seed DB")
+
+def snapshot_database(admin_engine, engine):
+    """ Snapshot the (seeded) benchmark database as a template database, so
+        each strategy can start from a clone of it rather than reseeding.
+        Returns the template's name, or None if it couldn't be created (e.g.
+        without the CREATEDB privilege).
+    """
+    log = logging.getLogger(__name__)
+
+    template = get_template_name(engine)
+    disconnect(engine)
+
+    try:
+        clone_database(admin_engine, template, engine.url.database)
+    except DBAPIError, e:
+        log.warn("Couldn't snapshot the seeded DB, reseeding for each strategy instead: %s", e)
+        return None
+
+    return template
+
+def restore_database(admin_engine, engine, template):
+    """ Replace the benchmark database with a clone of the template """
+    disconnect(engine)
+    clone_database(admin_engine, engine.url.database, template)
+
+    # The cache record ids of the last strategy's database are gone
+    CachedGriddedAndBoundMappablePoint.invalidate_cache_record_index()
+
 def main(argv=sys.argv):
     if len(argv) != 2:
         usage(argv)
@@ -57,6 +160,16 @@ def main(argv=sys.argv):
     settings = get_appsettings(config_uri)
     engine = engine_from_config(settings, 'sqlalchemy.')
     DBSession.configure(bind=engine)
+    partition_by_layer = asbool(settings.get('thesis.partition_by_layer', False))
+
+    MappablePoint.BENCHMARK_WARMUPS = int(settings.get('thesis.benchmark.warmups', MappablePoint.BENCHMARK_WARMUPS))
+    MappablePoint.BENCHMARK_ITERATIONS = int(settings.get('thesis.benchmark.iterations', MappablePoint.BENCHMARK_ITERATIONS))
+
+    if not thesis.benchmark.MONOTONIC:
+        logging.getLogger(__name__).warn(
+            "Timing with the wall clock, as there's no monotonic clock. "
+            "Install the monotonic package (thesis[benchmark]) for trustworthy timings."
+        )
 
 
     # Step 1
@@ -78,37 +191,32 @@ def main(argv=sys.argv):
     lines = []
     lines.append(["DEBUG", "layers", LAYER_NAMES])
 
+    admin_engine = get_admin_engine(engine)
+
     for layer_name in LAYER_NAMES:
         log = logging.getLogger(__name__)
 
         log.debug("Start tests for layer: %s", layer_name)
 
-        for class_ in all_mappable_point_classes:
+        # Seed the layer once, and start each strategy from a clone of it
+        seed_layer(engine, layer_name, partition_by_layer)
+        template = snapshot_database(admin_engine, engine)
 
-            log.debug("Start for class: %s", class_.__name__)
-
-            # Drop All
-            log.debug("Dropping DB")
+        for i, class_ in enumerate(all_mappable_point_classes):
 
-            DBSession.remove()
-            Base.metadata.drop_all(engine)
+            log.debug("Start for class: %s", class_.__name__)
 
-            # Init DB
-            log.debug("Init DB")
-            DBSession.configure(bind=engine)
-            initialize_db(engine)
-            log.debug("End Init DB")
+            if i > 0:
+                if template != None:
+                    log.debug("Start Restore DB")
+                    restore_database(admin_engine, engine, template)
+                    log.debug("End Restore DB")
+                else:
+                    seed_layer(engine, layer_name, partition_by_layer)
 
             before_db_size = None
             after_db_size = None
 
-            # Seed DB
-            log.debug("Start Seed DB")
-            with transaction.manager:
-                # Seed DB
-                seed_db([layer_name])
-            log.debug("End Seed DB")
-
             # Pre-Process DB
             log.debug("Start Pre-Process DB")
             before_db_size = get_db_size(engine)
@@ -158,12 +266,29 @@ def main(argv=sys.argv):
                     lines.append(res_points_as_geo_json_str)
                     lines.append(res_points_as_wkt_str)
 
+                    # Compressed vs uncompressed clusters GeoJSON
+                    res_points_as_compressed_str = class_.test_get_points_as_compressed_str(layer, bbox=bbox)
+                    for res in res_points_as_compressed_str:
+                        log.info("RES: %s", res)
+                    lines.extend(res_points_as_compressed_str)
+
             log.debug("End Run Tests")
 
             log.debug("End tests for class: %s", class_.__name__)
 
+        if template != None:
+            drop_database(admin_engine, template)
+
         log.debug("End tests for layer: %s", layer_name)
 
+    # Cache key hit rates of near identical viewports, raw vs canonicalised
+    for class_ in all_mappable_point_classes:
+        if issubclass(class_, GriddedMappablePoint):
+            for bbox in bboxes:
+                res_cache_key_hit_rate = class_.test_cache_key_hit_rate(bbox)
+                log.info("RES: %s", res_cache_key_hit_rate)
+                lines.append(res_cache_key_hit_rate)
+
     time_now = datetime.datetime.now()
 
     results_dir = "results %s" % time_now
@@ -176,3 +301,4 @@ def main(argv=sys.argv):
         my_writer.writerows(lines)
 
     MappablePoint.write_csvs(results_dir, lines)
+    GriddedMappablePoint.write_cache_key_hit_rate_csv(results_dir, lines)
@@ -0,0 +1,55 @@
+import os
+import sys
+import transaction
+import logging
+import argparse
+
+from sqlalchemy import engine_from_config
+
+from pyramid.paster import (
+    get_appsettings,
+    setup_logging,
+    )
+
+from thesis.models import *
+from thesis.cache import configure_cluster_cache
+
+def main(argv=sys.argv):
+    parser = argparse.ArgumentParser(
+        prog=os.path.basename(argv[0]),
+        description="Warm the cluster cache with the most accessed viewports",
+    )
+    parser.add_argument('config_uri', help='e.g. development.ini')
+    parser.add_argument(
+        '-n', '--top', type=int, default=ViewportAccess.DEFAULT_WARM_TOP_N,
+        help='the number of viewports to warm (default: %(default)s)'
+    )
+    parser.add_argument(
+        '--neighbours', type=int, default=0, metavar='N',
+        help='also warm the zoom out/in neighbours of the N hottest viewports'
+    )
+    parser.add_argument(
+        '-l', '--layer', action='append', dest='layer_names',
+        help='a layer to warm the viewports of (default: all layers)'
+    )
+    parser.add_argument(
+        '--max-age', type=int, default=ViewportAccess.WARM_MAX_AGE_DAYS, metavar='DAYS',
+        help="skip viewports not accessed in this many days (default: %(default)s)"
+    )
+    args = parser.parse_args(argv[1:])
+
+    setup_logging(args.config_uri)
+    settings = get_appsettings(args.config_uri)
+    engine = engine_from_config(settings, 'sqlalchemy.')
+    DBSession.configure(bind=engine)
+    configure_cluster_cache(settings)
+
+    if not settings.get('cache.clusters.backend'):
+        logging.getLogger(__name__).warn("No cluster cache backend configured, only the database will be warmed")
+
+    with transaction.manager:
+        layer_ids = None
+        if args.layer_names:
+            layer_ids = [layer.id for layer in DBSession.query(Layer).filter(Layer.name.in_(args.layer_names))]
+
+        ViewportAccess.warm(args.top, args.neighbours, layer_ids, max_age_days=args.max_age)
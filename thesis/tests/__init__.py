@@ -2,3 +2,15 @@ from thesis.tests.mappable_point import *
 from thesis.tests.gridded_mappable_point import *
 from thesis.tests.gridded_and_bound_mappable_point import *
 from thesis.tests.cached_gridded_and_bound_mappable_point import *
+from thesis.tests.seed_db import *
+from thesis.tests.in_memory_gridded_and_bound_mappable_point import *
+from thesis.tests.tiled_cached_mappable_point import *
+from thesis.tests.cache import *
+from thesis.tests.manage_indexes import *
+from thesis.tests.partitioning import *
+from thesis.tests.compression import *
+from thesis.tests.viewport_access import *
+from thesis.tests.benchmark import *
+from thesis.tests.views import *
+from thesis.tests.pre_process_db import *
+from thesis.tests.serve_green import *
@@ -0,0 +1,65 @@
+import unittest
+
+from pyramid import testing
+
+from thesis.benchmark import (
+    STATS,
+    percentile,
+    summarise,
+    benchmark,
+    time_cpu_call,
+    )
+
+class TestBenchmark(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_percentile(self):
+        samples = [4, 1, 3, 2, 5]
+
+        self.assertEqual(percentile(samples, 0), 1)
+        self.assertEqual(percentile(samples, 50), 3)
+        self.assertEqual(percentile(samples, 100), 5)
+        # Interpolated between the closest ranks
+        self.assertAlmostEqual(percentile(samples, 95), 4.8)
+        self.assertAlmostEqual(percentile([1, 2], 50), 1.5)
+
+        self.assertEqual(percentile([], 50), None)
+
+    def test_summarise(self):
+        stats = summarise([2, 4, 4, 4, 5, 5, 7, 9], cold=20)
+
+        self.assertEqual(sorted(stats.keys()), sorted(STATS))
+        self.assertEqual(stats['cold'], 20)
+        self.assertEqual(stats['iterations'], 8)
+        self.assertEqual(stats['min'], 2)
+        self.assertEqual(stats['max'], 9)
+        self.assertEqual(stats['median'], 4.5)
+        self.assertEqual(stats['mean'], 5)
+        self.assertAlmostEqual(stats['stddev'], 2.138089935)
+
+        # A single sample has no stddev
+        self.assertEqual(summarise([1])['stddev'], None)
+
+    def test_benchmark(self):
+        calls = []
+
+        result, stats = benchmark(lambda: calls.append(1) or len(calls), 2, 5)
+
+        # The cold call's result, and only the iterations are measured
+        self.assertEqual(result, 1)
+        self.assertEqual(len(calls), 8)
+        self.assertEqual(stats['iterations'], 5)
+        self.assertTrue(stats['cold'] >= 0)
+        self.assertTrue(stats['min'] <= stats['median'] <= stats['p95'] <= stats['p99'] <= stats['max'])
+
+    def test_time_cpu_call(self):
+        result, cpu_delta_t_s, delta_t_s = time_cpu_call(lambda: sum(i * i for i in xrange(100000)))
+
+        self.assertEqual(result, sum(i * i for i in xrange(100000)))
+        self.assertTrue(cpu_delta_t_s >= 0)
+        self.assertTrue(delta_t_s >= 0)
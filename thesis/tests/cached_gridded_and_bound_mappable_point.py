@@ -13,6 +13,7 @@ from sqlalchemy import create_engine
 from thesis.models import (
     Base,
     CachedGriddedAndBoundMappablePoint,
+    GriddedAndBoundMappablePoint,
     Layer
 )
 
@@ -94,6 +95,8 @@ class TestCachedGriddedAndBoundMappableItem(unittest.TestCase):
 
     def tearDown(self):
 
+        CachedGriddedAndBoundMappablePoint.invalidate_cache_record_index()
+
         DBSession.remove()
         testing.tearDown()
 
@@ -160,7 +163,7 @@ class TestCachedGriddedAndBoundMappableItem(unittest.TestCase):
 
         q3 = CachedGriddedAndBoundMappablePoint.get_points_as_geojson(test_layer_2, grid_size=100)
         result3 = q3.one()
-        self.assertEqual(result3.centroid, '{"type":"Point","coordinates":[16.6666666666667,15]}')
+        self.assertEqual(result3.centroid, '{"type":"Point","coordinates":[16.67,15]}')
 
     def test_bounds_not_intersecting_points(self):
 
@@ -230,3 +233,295 @@ class TestCachedGriddedAndBoundMappableItem(unittest.TestCase):
                 len(smallest_grid_size_cache_record.cached_mappable_point_clusters),
                 len(largest_grid_size_cache_record.cached_mappable_point_clusters)
         )
+
+    def assertCacheMatchesLayer(self, layer):
+        # Every cache record should hold the same clusters as a live query
+        # at its grid size.
+        for cache_record in layer.cache_records:
+            clusters = cache_record.cached_mappable_point_clusters
+            live_clusters = GriddedAndBoundMappablePoint.get_points_as_wkt(layer, grid_size=cache_record.grid_size).all()
+
+            self.assertEqual(sum(cluster.cluster_size for cluster in clusters), len(layer.mappable_points))
+            self.assertEqual(
+                sorted(cluster.cluster_size for cluster in clusters),
+                sorted(cluster.cluster_size for cluster in live_clusters)
+            )
+
+    def test_add_points_updates_cache(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+        cache_record_ids = [cache_record.id for cache_record in test_layer_1.cache_records]
+
+        CachedGriddedAndBoundMappablePoint.add_points(test_layer_1, [
+            'Point(30 10)',
+            'Point(30.001 10.001)',
+            'Point(-100 -40)',
+        ])
+
+        self.assertEqual(len(test_layer_1.mappable_points), 5)
+        # The cache records were updated, not rebuilt
+        self.assertEqual([cache_record.id for cache_record in test_layer_1.cache_records], cache_record_ids)
+        self.assertCacheMatchesLayer(test_layer_1)
+
+        q = CachedGriddedAndBoundMappablePoint.get_points_as_geojson(test_layer_1, grid_size=100, bbox=[0,0,180,90])
+        result = q.one()
+        self.assertEqual(result.cluster_size, 4)
+
+    def test_remove_points_updates_cache(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        mappable_points = test_emu_layer.mappable_points[:10]
+
+        CachedGriddedAndBoundMappablePoint.remove_points(test_emu_layer, mappable_points)
+
+        self.assertCacheMatchesLayer(test_emu_layer)
+
+    def test_pre_process_hierarchically(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        per_level_cache_records = list(test_emu_layer.cache_records)
+
+        CachedGriddedAndBoundMappablePoint.pre_process(test_emu_layer, mode='hierarchical')
+
+        hierarchical_cache_records = test_emu_layer.cache_records[len(per_level_cache_records):]
+        self.assertEqual(len(hierarchical_cache_records), len(CachedGriddedAndBoundMappablePoint.GRID_SIZES))
+        self.assertTrue(CachedGriddedAndBoundMappablePoint.verify_cache(test_emu_layer))
+
+        # Rolling up from the finer levels should give exactly the clusters
+        # of building each level from the points.
+        for cache_record in hierarchical_cache_records:
+            per_level_cache_record = next(
+                per_level_cache_record for per_level_cache_record in per_level_cache_records
+                if per_level_cache_record.grid_size == cache_record.grid_size
+            )
+            self.assertEqual(
+                sorted((c.cell_x, c.cell_y, c.cluster_size) for c in cache_record.cached_mappable_point_clusters),
+                sorted((c.cell_x, c.cell_y, c.cluster_size) for c in per_level_cache_record.cached_mappable_point_clusters)
+            )
+
+    def test_generate_cache_clusters_in_db(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        per_level_cache_record = next(
+            cache_record for cache_record in test_emu_layer.cache_records
+            if cache_record.grid_size == 1
+        )
+
+        clusters, delta_t_s = CachedGriddedAndBoundMappablePoint.generate_cache_clusters_in_db(test_emu_layer, 1)
+
+        self.assertEqual(clusters, len(per_level_cache_record.cached_mappable_point_clusters))
+
+        cache_record = test_emu_layer.cache_records[-1]
+        self.assertEqual(cache_record.grid_size, 1)
+        self.assertEqual(
+            sorted((c.cell_x, c.cell_y, c.cluster_size) for c in cache_record.cached_mappable_point_clusters),
+            sorted((c.cell_x, c.cell_y, c.cluster_size) for c in per_level_cache_record.cached_mappable_point_clusters)
+        )
+
+    def test_generate_cache_clusters_in_batches(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        per_level_cache_record = next(
+            cache_record for cache_record in test_emu_layer.cache_records
+            if cache_record.grid_size == 1
+        )
+        expected = sorted(
+            (c.cell_x, c.cell_y, c.cluster_size) for c in per_level_cache_record.cached_mappable_point_clusters
+        )
+        DBSession.expunge_all()
+
+        batch_size = CachedGriddedAndBoundMappablePoint.CACHE_CLUSTER_INSERT_BATCH_SIZE
+        CachedGriddedAndBoundMappablePoint.CACHE_CLUSTER_INSERT_BATCH_SIZE = 7
+        try:
+            test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+            CachedGriddedAndBoundMappablePoint.generate_cache_clusters(test_emu_layer, 1)
+        finally:
+            CachedGriddedAndBoundMappablePoint.CACHE_CLUSTER_INSERT_BATCH_SIZE = batch_size
+
+        # The clusters weren't held by the session
+        self.assertFalse(any(
+            isinstance(obj, CachedGriddedAndBoundMappablePoint.CachedMappablePointCluster)
+            for obj in DBSession.identity_map.values()
+        ))
+
+        cache_record = test_emu_layer.cache_records[-1]
+        self.assertEqual(cache_record.grid_size, 1)
+        self.assertEqual(
+            sorted((c.cell_x, c.cell_y, c.cluster_size) for c in cache_record.cached_mappable_point_clusters),
+            expected
+        )
+
+    def test_commit_staged_cache(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        grid_sizes = CachedGriddedAndBoundMappablePoint.GRID_SIZES
+
+        # Stage the clusters the way a parallel build's workers would
+        build_id = 'test_build'
+        for grid_size in grid_sizes:
+            clusters = CachedGriddedAndBoundMappablePoint.stage_cache_clusters(
+                DBSession.connection(), build_id, test_emu_layer.id, grid_size
+            )
+            self.assertGreater(clusters, 0)
+
+        CachedGriddedAndBoundMappablePoint.commit_staged_cache(test_emu_layer, build_id, grid_sizes)
+
+        # The existing cache records were replaced
+        self.assertEqual(len(test_emu_layer.cache_records), len(grid_sizes))
+        self.assertTrue(CachedGriddedAndBoundMappablePoint.verify_cache(test_emu_layer))
+
+        staged = DBSession.query(CachedGriddedAndBoundMappablePoint.CacheBuildCluster).count()
+        self.assertEqual(staged, 0)
+
+    def test_get_cache_record_id(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        for cache_record in test_layer_1.cache_records:
+            self.assertEqual(
+                CachedGriddedAndBoundMappablePoint.get_cache_record_id(test_layer_1, cache_record.grid_size),
+                cache_record.id
+            )
+
+        self.assertEqual(CachedGriddedAndBoundMappablePoint.get_cache_record_id(test_layer_1, 3), None)
+
+        # Loaded from the database when it's not indexed
+        CachedGriddedAndBoundMappablePoint.invalidate_cache_record_index()
+        cache_record = test_layer_1.cache_records[0]
+        self.assertEqual(
+            CachedGriddedAndBoundMappablePoint.get_cache_record_id(test_layer_1, cache_record.grid_size),
+            cache_record.id
+        )
+
+        CachedGriddedAndBoundMappablePoint.invalidate_cache_record_index()
+        index = CachedGriddedAndBoundMappablePoint.load_cache_record_index()
+        self.assertEqual(len(index), 3)
+
+    def test_get_cache_record_id_newest_wins(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        grid_size = test_layer_1.cache_records[0].grid_size
+        newer_cache_record = CachedGriddedAndBoundMappablePoint.CacheRecord(grid_size)
+        test_layer_1.cache_records.append(newer_cache_record)
+        DBSession.flush()
+
+        CachedGriddedAndBoundMappablePoint.invalidate_cache_record_index()
+        self.assertEqual(
+            CachedGriddedAndBoundMappablePoint.get_cache_record_id(test_layer_1, grid_size),
+            newer_cache_record.id
+        )
+
+        index = CachedGriddedAndBoundMappablePoint.load_cache_record_index()
+        self.assertEqual(index[test_layer_1.id][grid_size], newer_cache_record.id)
+
+    def test_cache_record_index_forgotten_after_commit(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+        layer_id = test_layer_1.id
+
+        CachedGriddedAndBoundMappablePoint.delete_cache(test_layer_1)
+
+        # Ids loaded by the transaction (none, as it deleted them)
+        self.assertEqual(CachedGriddedAndBoundMappablePoint.get_cache_record_id(test_layer_1, 100), None)
+        self.assertIn(layer_id, CachedGriddedAndBoundMappablePoint.cache_record_index)
+
+        transaction.commit()
+        self.assertNotIn(layer_id, CachedGriddedAndBoundMappablePoint.cache_record_index)
+
+    def test_stale_cache_record_falls_back_to_clustering(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+        test_layer_2 = DBSession.query(Layer).filter_by(name='TestLayer2').one()
+
+        grid_size = CachedGriddedAndBoundMappablePoint.normalise_grid_size(100, test_layer_1)
+
+        def index_stale_cache_record():
+            # As if another process deleted the record since it was indexed
+            CachedGriddedAndBoundMappablePoint.cache_record_index[test_layer_1.id] = {grid_size: -1}
+
+        index_stale_cache_record()
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_1, grid_size=100).all()
+        self.assertEqual([el.cluster_size for el in result], [2])
+        self.assertNotIn(test_layer_1.id, CachedGriddedAndBoundMappablePoint.cache_record_index)
+
+        index_stale_cache_record()
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_geojson(test_layer_1, grid_size=100).all()
+        self.assertEqual([el.cluster_size for el in result], [2])
+
+        index_stale_cache_record()
+        results = CachedGriddedAndBoundMappablePoint.get_layers_points_as_wkt([test_layer_1, test_layer_2], grid_size=100)
+        self.assertEqual([row.cluster_size for row in results[test_layer_1.id]], [2])
+        self.assertEqual([row.cluster_size for row in results[test_layer_2.id]], [3])
+
+        index_stale_cache_record()
+        results = CachedGriddedAndBoundMappablePoint.get_bboxes_points_as_wkt(test_layer_1, [[0,0,40,40]], [100])
+        self.assertEqual([row.cluster_size for row in results[0]], [2])
+
+        # An empty result of a record that still exists is trusted
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_1, bbox=[-180,-89,-170,-80], grid_size=100).all()
+        self.assertEqual(result, [])
+        self.assertIn(test_layer_1.id, CachedGriddedAndBoundMappablePoint.cache_record_index)
+
+    def test_uncached_grid_size_falls_back_to_clustering(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        CachedGriddedAndBoundMappablePoint.delete_cache(test_layer_1)
+
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_1, grid_size=100).all()
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].cluster_size, 2)
+
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_geojson(test_layer_1, grid_size=1).all()
+        self.assertEqual(sorted(el.cluster_size for el in result), [1, 1])
+
+    def test_get_layers_points_as_wkt(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+        test_layer_2 = DBSession.query(Layer).filter_by(name='TestLayer2').one()
+
+        # Layers with and without a cache are batched together
+        CachedGriddedAndBoundMappablePoint.delete_cache(test_layer_1)
+
+        results = CachedGriddedAndBoundMappablePoint.get_layers_points_as_wkt([test_layer_2, test_layer_1], grid_size=100)
+
+        self.assertEqual(results.keys(), [test_layer_2.id, test_layer_1.id])
+        self.assertEqual(sorted(row.cluster_size for row in results[test_layer_1.id]), [2])
+        self.assertEqual(sorted(row.cluster_size for row in results[test_layer_2.id]), [3])
+
+    def test_get_bboxes_points_as_wkt(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        bboxes = [[0,0,40,40], [25,0,40,40], [-180,-89,-170,-80]]
+
+        results = CachedGriddedAndBoundMappablePoint.get_bboxes_points_as_wkt(test_layer_1, bboxes, [1, 1, 100])
+
+        self.assertEqual(sorted(row.cluster_size for row in results[0]), [1, 1])
+        self.assertEqual([row.centroid for row in results[1]], ['POINT(30 10)'])
+        self.assertEqual(results[2], [])
+
+        # Bboxes without a cache are clustered from the points
+        CachedGriddedAndBoundMappablePoint.delete_cache(test_layer_1)
+
+        results = CachedGriddedAndBoundMappablePoint.get_bboxes_points_as_wkt(test_layer_1, bboxes[:1], [100])
+        self.assertEqual([row.cluster_size for row in results[0]], [2])
+
+    def test_update_grid_sizes_rebuilds_cache(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        # The cache would be left at the old grid sizes
+        self.assertRaises(ValueError, GriddedAndBoundMappablePoint.update_grid_sizes, test_layer_1)
+        self.assertFalse(test_layer_1.grid_sizes)
+
+        self.assertEqual(CachedGriddedAndBoundMappablePoint.update_grid_sizes(test_layer_1), [0, 32])
+        for grid_size in [0, 32]:
+            self.assertNotEqual(CachedGriddedAndBoundMappablePoint.get_cache_record_id(test_layer_1, grid_size), None)
+
+    def test_pre_process_with_adaptive_grid_sizes(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        CachedGriddedAndBoundMappablePoint.delete_cache(test_layer_1)
+        CachedGriddedAndBoundMappablePoint.pre_process(test_layer_1, adaptive=True, verify=True)
+
+        self.assertEqual(test_layer_1.grid_sizes, [0, 32])
+
+        # The benchmarks log the layer's own grid sizes
+        details = CachedGriddedAndBoundMappablePoint.get_request_log_details(test_layer_1, grid_size=100)
+        self.assertEqual(details["grid_sizes"], [0, 32])
+        self.assertEqual(sorted(c.grid_size for c in test_layer_1.cache_records), [0, 32])
+
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_1, grid_size=100).all()
+        self.assertEqual(len(result), 1)
+        self.assertEqual(result[0].cluster_size, 2)
+
+        result = CachedGriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_1, grid_size=20).all()
+        self.assertEqual(len(result), 2)
@@ -0,0 +1,64 @@
+import unittest
+import zlib
+
+from pyramid import testing
+
+import thesis.compression
+
+from thesis.compression import (
+    parse_accept_encoding,
+    negotiate_encoding,
+    compress,
+    iter_compress,
+    )
+
+class TestCompression(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+        # Don't depend on whether brotli is installed
+        self.brotli = thesis.compression.brotli
+        thesis.compression.brotli = None
+
+    def tearDown(self):
+        thesis.compression.brotli = self.brotli
+
+        testing.tearDown()
+
+    def test_parse_accept_encoding(self):
+        self.assertEqual(
+            parse_accept_encoding('gzip, deflate;q=0.5, br;q=0'),
+            { 'gzip': 1.0, 'deflate': 0.5, 'br': 0.0 }
+        )
+        self.assertEqual(parse_accept_encoding('gzip;q=x'), { 'gzip': 0.0 })
+
+    def test_negotiate_encoding(self):
+        request = testing.DummyRequest()
+        self.assertEqual(negotiate_encoding(request), None)
+
+        request = testing.DummyRequest(headers={ 'Accept-Encoding': 'gzip, deflate' })
+        self.assertEqual(negotiate_encoding(request), 'gzip')
+
+        request = testing.DummyRequest(headers={ 'Accept-Encoding': 'gzip;q=0, deflate' })
+        self.assertEqual(negotiate_encoding(request), None)
+
+        request = testing.DummyRequest(headers={ 'Accept-Encoding': '*' })
+        self.assertEqual(negotiate_encoding(request), 'gzip')
+
+        # Only if brotli is installed
+        request = testing.DummyRequest(headers={ 'Accept-Encoding': 'br' })
+        self.assertEqual(negotiate_encoding(request), None)
+
+    def test_compress(self):
+        body = '{"type": "FeatureCollection", "features": []}' * 100
+
+        compressed = compress(body, 'gzip')
+        self.assertLess(len(compressed), len(body))
+        self.assertEqual(zlib.decompress(compressed, 16 + zlib.MAX_WBITS), body)
+
+        # Streamed compression gives the same body
+        streamed = ''.join(iter_compress(iter([body[:1000], body[1000:]]), 'gzip'))
+        self.assertEqual(zlib.decompress(streamed, 16 + zlib.MAX_WBITS), body)
+
+        self.assertRaises(ValueError, compress, body, 'br')
@@ -152,7 +152,7 @@ class TestGriddedAndBoundMappableItem(unittest.TestCase):
 
         q3 = GriddedAndBoundMappablePoint.get_points_as_geojson(test_layer_2, grid_size=100)
         result3 = q3.one()
-        self.assertEqual(result3.centroid, '{"type":"Point","coordinates":[16.6666666666667,15]}')
+        self.assertEqual(result3.centroid, '{"type":"Point","coordinates":[16.7,15]}')
 
     def test_bounds_not_intersecting_points(self):
         test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
@@ -160,6 +160,54 @@ class TestGriddedAndBoundMappableItem(unittest.TestCase):
         result = q.all()
         self.assertEqual(len(result),0)
 
+    def test_get_layers_points_as_wkt(self):
+        layers = DBSession.query(Layer).order_by(Layer.name).all()
+
+        results = GriddedAndBoundMappablePoint.get_layers_points_as_wkt(layers, grid_size=1)
+
+        # The same clusters as querying each layer, by layer id in order
+        self.assertEqual(results.keys(), [layer.id for layer in layers])
+        for layer in layers:
+            self.assertEqual(
+                sorted((row.centroid, row.cluster_size) for row in results[layer.id]),
+                sorted(GriddedAndBoundMappablePoint.get_points_as_wkt(layer, grid_size=1).all())
+            )
+
+        results = GriddedAndBoundMappablePoint.get_layers_points_as_geojson(layers, grid_size=1, bbox=[-180,-89,-170,-80])
+        self.assertEqual(results.values(), [[] for layer in layers])
+
+    def test_get_bboxes_points_as_wkt(self):
+        test_layer_2 = DBSession.query(Layer).filter_by(name='TestLayer2').one()
+
+        bboxes = [[0,0,40,40], [20,0,40,40], [-180,-89,-170,-80], [0,0,40,40]]
+        grid_sizes = [1, 1, 1, 100]
+
+        results = GriddedAndBoundMappablePoint.get_bboxes_points_as_wkt(test_layer_2, bboxes, grid_sizes)
+
+        # The same clusters as querying each bbox, in the order of the bboxes
+        self.assertEqual(len(results), len(bboxes))
+        for bbox, grid_size, result in zip(bboxes, grid_sizes, results):
+            self.assertEqual(
+                sorted((row.centroid, row.cluster_size) for row in result),
+                sorted(GriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_2, bbox=bbox, grid_size=grid_size).all())
+            )
+
+        self.assertEqual(sorted(row.cluster_size for row in results[0]), [1, 2])
+        self.assertEqual([row.cluster_size for row in results[1]], [1])
+        self.assertEqual(results[2], [])
+        self.assertEqual([row.cluster_size for row in results[3]], [3])
+
+    def test_get_bboxes_points_dedupes_bboxes(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        results = GriddedAndBoundMappablePoint.get_bboxes_points_as_geojson(
+            test_layer_1, [[0,0,40,40], [0,0,40,40]], [1, 1]
+        )
+
+        self.assertEqual(len(results), 2)
+        self.assertEqual(len(results[0]), 2)
+        self.assertTrue(results[0] is results[1])
+
     def test_get_layer_points_as_wkt(self):
         test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
         q = GriddedAndBoundMappablePoint.get_points_as_wkt(test_layer_1, grid_size=1)
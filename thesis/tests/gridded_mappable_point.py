@@ -152,7 +152,7 @@ class TestGriddedMappableItem(unittest.TestCase):
 
         q3 = GriddedMappablePoint.get_points_as_geojson(test_layer_2, grid_size=100)
         result3 = q3.one()
-        self.assertEqual(result3.centroid, '{"type":"Point","coordinates":[16.6666666666667,15]}')
+        self.assertEqual(result3.centroid, '{"type":"Point","coordinates":[16.7,15]}')
 
     def test_get_layer_points_as_wkt(self):
         test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
@@ -163,6 +163,25 @@ class TestGriddedMappableItem(unittest.TestCase):
 #        self.assertEqual(result[1].locations, 'MULTIPOINT(30 10)')
 
 
+    def test_compute_coordinate_precision(self):
+        # A thousandth of the grid size
+        self.assertEqual(GriddedMappablePoint.compute_coordinate_precision(grid_size=16), 2)
+        self.assertEqual(GriddedMappablePoint.compute_coordinate_precision(grid_size=1), 3)
+        self.assertEqual(GriddedMappablePoint.compute_coordinate_precision(grid_size=0.015), 5)
+
+        # Ungridded, a ten thousandth of the bbox's span
+        self.assertEqual(GriddedMappablePoint.compute_coordinate_precision(bbox=[-180,-90,180,90]), 2)
+        self.assertEqual(GriddedMappablePoint.compute_coordinate_precision(bbox=[0,0,1,1], grid_size=0), 4)
+
+        # Neither, full precision
+        self.assertEqual(GriddedMappablePoint.compute_coordinate_precision(grid_size=0), None)
+
+    def test_get_cluster_centroids_as_wkt_with_precision(self):
+        test_layer_2 = DBSession.query(Layer).filter_by(name='TestLayer2').one()
+
+        result = GriddedMappablePoint.get_points_as_wkt(test_layer_2, grid_size=100).one()
+        self.assertEqual(result.centroid, 'POINT(16.7 15)')
+
     def test_normalise_grid_size(self):
         grid_size_1 = GriddedMappablePoint.normalise_grid_size(10)
         self.assertEqual(grid_size_1, 8)
@@ -175,3 +194,62 @@ class TestGriddedMappableItem(unittest.TestCase):
 
         grid_size_4 = GriddedMappablePoint.normalise_grid_size(1.1)
         self.assertEqual(grid_size_4, 1)
+
+    def test_canonicalise_bbox(self):
+        bbox, grid_size = GriddedMappablePoint.canonicalise_bbox([113, -43, 153, -10])
+        self.assertEqual(grid_size, 2)
+        self.assertEqual(bbox, [112, -44, 154, -10])
+
+        # Strings are parsed, and the same viewport, panned slightly, is identical
+        self.assertEqual(
+            GriddedMappablePoint.canonicalise_bbox('113.2,-42.9,153.1,-10.3'),
+            ([112, -44, 154, -10], 2)
+        )
+
+        # Clamped to the world
+        self.assertEqual(
+            GriddedMappablePoint.canonicalise_bbox([-180, -90, 180, 90]),
+            ([-180, -90, 180, 90], 32)
+        )
+
+        # A grid size of 0 is expanded to the smallest non zero grid size
+        bbox, grid_size = GriddedMappablePoint.canonicalise_bbox([153.077359,-27.597061,153.080556,-27.596623])
+        self.assertEqual(grid_size, 0)
+        self.assertEqual(bbox, [153.075, -27.6, 153.09, -27.585])
+
+        # An explicit grid size is normalised
+        self.assertEqual(
+            GriddedMappablePoint.canonicalise_bbox([113, -43, 153, -10], 1.1),
+            ([113, -43, 153, -10], 1)
+        )
+
+    def test_canonicalise_invalid_bbox(self):
+        self.assertEqual(GriddedMappablePoint.canonicalise_bbox('a,b,c,d'), (None, None))
+        self.assertEqual(GriddedMappablePoint.canonicalise_bbox([1, 2, 3]), (None, None))
+
+    def test_cache_key_hit_rate(self):
+        row = GriddedMappablePoint.test_cache_key_hit_rate([113, -43, 153, -10], requests=50)
+        self.assertEqual(row[0], "cache_key_hit_rate")
+        self.assertEqual(row[3], 50)
+
+        raw_hit_rate, canonical_hit_rate = row[4], row[5]
+        self.assertGreater(canonical_hit_rate, raw_hit_rate)
+
+    def test_compute_grid_sizes(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        # The two points are only clustered together from a grid size of 32
+        self.assertEqual(GriddedMappablePoint.compute_grid_sizes(test_layer_1), [0, 32])
+
+        self.assertEqual(GriddedMappablePoint.normalise_grid_size(20, test_layer_1), 16)
+        GriddedMappablePoint.update_grid_sizes(test_layer_1)
+        self.assertEqual(test_layer_1.grid_sizes, [0, 32])
+        self.assertEqual(GriddedMappablePoint.normalise_grid_size(20, test_layer_1), 0)
+        self.assertEqual(GriddedMappablePoint.normalise_grid_size(100, test_layer_1), 32)
+
+    def test_candidate_grid_sizes_include_finer_grid_sizes(self):
+        candidates = GriddedMappablePoint.get_candidate_grid_sizes()
+        self.assertEqual(candidates, sorted(candidates))
+        self.assertEqual(candidates[0], 0)
+        self.assertEqual(candidates[1], 0.015 / (2 ** GriddedMappablePoint.ADAPTIVE_FINER_GRID_SIZES))
+        self.assertEqual(candidates[-1], 128)
@@ -1,6 +1,8 @@
 import unittest
 import transaction
 import os
+import json
+import struct
 
 import csv
 
@@ -12,6 +14,7 @@ from sqlalchemy import create_engine
 from thesis.models import (
     Base,
     MappablePoint,
+    GriddedAndBoundMappablePoint,
     Layer
 )
 
@@ -144,6 +147,122 @@ class TestMappableItem(unittest.TestCase):
         self.assertEqual(result[1].centroid, 'POINT(30 10)')
 #        self.assertEqual(result[1].locations, 'MULTIPOINT(30 10)')
 
+    def test_get_layer_points_as_geojson_str(self):
+        test_layer_2 = DBSession.query(Layer).filter_by(name='TestLayer2').one()
+
+        geojson = json.loads(MappablePoint.get_points_as_geojson_str(test_layer_2))
+        self.assertEqual(geojson["type"], "FeatureCollection")
+        self.assertEqual(len(geojson["features"]), 2)
+        self.assertEqual(
+            sorted(feature["properties"]["cluster_size"] for feature in geojson["features"]),
+            [1, 2]
+        )
+        self.assertEqual(
+            sorted(feature["geometry"]["coordinates"] for feature in geojson["features"]),
+            [[10, 15], [30, 15]]
+        )
+
+        # The streamed chunks should concatenate to the same document
+        chunks = list(MappablePoint.iter_points_as_geojson_str(test_layer_2))
+        self.assertEqual(json.loads(''.join(chunks)), geojson)
+
+    def test_get_layer_points_as_wkt_str(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        wkt = MappablePoint.get_points_as_wkt_str(test_layer_1)
+        self.assertEqual(wkt, 'GEOMETRYCOLLECTION(POINT(20 10),POINT(30 10))')
+
+    def test_get_emu_points_as_geojson_str_in_chunks(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        clusters = MappablePoint.get_points_as_geojson(test_emu_layer).count()
+
+        chunks = list(MappablePoint.iter_points_as_geojson_str(test_emu_layer))
+        # header, ceil(clusters / SERIALIZE_CHUNK_SIZE) feature chunks, footer
+        feature_chunks = -(-clusters // MappablePoint.SERIALIZE_CHUNK_SIZE)
+        self.assertEqual(len(chunks), feature_chunks + 2)
+
+        geojson = json.loads(''.join(chunks))
+        self.assertEqual(len(geojson["features"]), clusters)
+
+    def test_get_layers_points_as_geojson(self):
+        layers = DBSession.query(Layer).order_by(Layer.name).all()
+
+        # Fanned out, each layer is queried in a thread of its own
+        results = MappablePoint.get_layers_points_as_geojson(layers)
+
+        self.assertEqual(results.keys(), [layer.id for layer in layers])
+        for layer in layers:
+            self.assertEqual(
+                sorted(results[layer.id]),
+                sorted(MappablePoint.get_points_as_geojson(layer).all())
+            )
+
+    def test_fan_out_pool_is_shared(self):
+        pool = MappablePoint.get_fan_out_pool()
+
+        # One pool of threads for all of the requests (and strategies)
+        self.assertIs(MappablePoint.get_fan_out_pool(), pool)
+        self.assertIs(GriddedAndBoundMappablePoint.get_fan_out_pool(), pool)
+
+        # Leaving a connection for the requests themselves
+        pool_size = DBSession.get_bind().pool.size()
+        self.assertLessEqual(pool._processes, min(MappablePoint.BATCH_FAN_OUT_THREADS, pool_size - 1))
+
+    def test_stream_query(self):
+        test_emu_layer = DBSession.query(Layer).filter_by(name='Emu').one()
+        q = MappablePoint.get_points_as_wkt(test_emu_layer)
+
+        # Fetched in batches through a server side cursor, with the same rows
+        self.assertEqual(
+            sorted(MappablePoint.stream_query(q, batch_size=10)),
+            sorted(q.all())
+        )
+
+        # A batch size of 0 doesn't stream
+        self.assertIs(MappablePoint.stream_query(q, batch_size=0), q)
+
+        # Nor are results that aren't queries
+        clusters = q.all()
+        self.assertIs(MappablePoint.stream_query(clusters), clusters)
+
+    def test_get_layer_points_as_packed_str(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        packed = MappablePoint.get_points_as_packed_str(test_layer_1)
+        self.assertEqual(len(packed), 2 * MappablePoint.PACKED_CLUSTER.size)
+
+        clusters = sorted(
+            MappablePoint.PACKED_CLUSTER.unpack_from(packed, offset)
+            for offset in range(0, len(packed), MappablePoint.PACKED_CLUSTER.size)
+        )
+        self.assertEqual(clusters, [(20.0, 10.0, 1), (30.0, 10.0, 1)])
+
+    def test_get_layer_points_as_twkb_str(self):
+        test_layer_1 = DBSession.query(Layer).filter_by(name='TestLayer1').one()
+
+        twkb = bytearray(MappablePoint.get_points_as_twkb_str(test_layer_1))
+
+        # MultiPoint, precision 6 (zigzag 12), with an idlist of 2 points
+        self.assertEqual(twkb[0], 0xc4)
+        self.assertEqual(twkb[1], MappablePoint.TWKB_IDLIST_FLAG)
+        self.assertEqual(twkb[2], 2)
+        # Each cluster has 1 point (zigzag 2)
+        self.assertEqual(list(twkb[3:5]), [2, 2])
+
+    def test_get_empty_twkb_str(self):
+        twkb = bytearray(MappablePoint.get_twkb_str([]))
+        self.assertEqual(list(twkb), [0xc4, MappablePoint.TWKB_EMPTY_FLAG])
+
+    def test_twkb_varints(self):
+        self.assertEqual(
+            [MappablePoint.zigzag(value) for value in [0, -1, 1, -2, 2]],
+            [0, 1, 2, 3, 4]
+        )
+
+        buf = bytearray()
+        MappablePoint.append_varint(buf, 300)
+        self.assertEqual(list(buf), [0xac, 0x02])
+
 # SELECT ST_AsGeoJSON(location) from mappable_points WHERE location && ST_MakeEnvelope(-20,-20,20,20);
 
 # Each individual point as GeoJSON
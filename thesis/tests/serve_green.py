@@ -0,0 +1,61 @@
+import unittest
+import subprocess
+import json
+import os
+import sys
+
+from pyramid import testing
+
+import thesis
+
+""" Runs two concurrent greenlet "requests" in a fresh interpreter, as
+    serve_green does (thesis_green imported first), and prints the id of each
+    one's session and transaction
+"""
+CONCURRENT_REQUESTS_SCRIPT = """
+import json
+import thesis_green
+import gevent
+import transaction
+
+from thesis.models import DBSession
+
+def request():
+    session = DBSession()
+    txn = transaction.get()
+
+    # Let the other request run, as if waiting on the database
+    gevent.sleep(0.01)
+
+    assert DBSession() is session
+    return [id(session), id(txn)]
+
+greenlets = [gevent.spawn(request) for i in range(2)]
+gevent.joinall(greenlets, raise_error=True)
+
+print(json.dumps([greenlet.value for greenlet in greenlets]))
+"""
+
+class TestServeGreen(unittest.TestCase):
+
+    def setUp(self):
+        self.config = testing.setUp()
+
+        try:
+            import gevent
+            import psycogreen
+        except ImportError:
+            self.skipTest("serve_green needs gevent and psycogreen")
+
+    def tearDown(self):
+        testing.tearDown()
+
+    def test_concurrent_requests_get_distinct_sessions(self):
+        # The directory of thesis_green
+        root = os.path.dirname(os.path.dirname(os.path.abspath(thesis.__file__)))
+
+        output = subprocess.check_output([sys.executable, '-c', CONCURRENT_REQUESTS_SCRIPT], cwd=root)
+        (session_1, txn_1), (session_2, txn_2) = json.loads(output)
+
+        self.assertNotEqual(session_1, session_2)
+        self.assertNotEqual(txn_1, txn_2)
@@ -1,14 +1,335 @@
+import json
+import transaction
+
 from pyramid.response import Response
 from pyramid.view import view_config
+from pyramid.httpexceptions import (
+    HTTPBadRequest,
+    HTTPNotFound,
+    )
 
 from sqlalchemy.exc import DBAPIError
 
 from thesis.models import *
+from thesis.cache import cluster_cache_enabled
+from thesis.compression import (
+    negotiate_encoding,
+    iter_compress,
+    )
+
+""" The strategy used by the cluster API when none is requested """
+DEFAULT_STRATEGY = 'GriddedAndBoundMappablePoint'
+
+""" The output formats of the cluster API: the strategy generator that
+    serialises each format, and the content type of the response.
+"""
+CLUSTER_FORMATS = {
+    'geojson': ('iter_points_as_geojson_str', 'application/json'),
+    'wkt': ('iter_points_as_wkt_str', 'text/plain'),
+    'twkb': ('iter_points_as_twkb_str', 'application/octet-stream'),
+    'packed': ('iter_points_as_packed_str', 'application/octet-stream'),
+}
+
+""" The output formats of the batch cluster API: the strategy method that
+    serialises each layer's clusters, and whether it's JSON already
+"""
+BATCH_FORMATS = {
+    'geojson': ('iter_geojson_str', True),
+    'wkt': ('iter_wkt_str', False),
+}
+
+""" The most layers of a batch cluster request """
+MAX_BATCH_LAYERS = 50
+
+""" The most bboxes of a batch (viewport prefetch) cluster request """
+MAX_BATCH_BBOXES = 16
+
+""" The output formats of the tile API, as per CLUSTER_FORMATS """
+TILE_FORMATS = {
+    'geojson': ('iter_tile_as_geojson_str', 'application/json'),
+    'wkt': ('iter_tile_as_wkt_str', 'text/plain'),
+    'twkb': ('iter_tile_as_twkb_str', 'application/octet-stream'),
+    'packed': ('iter_tile_as_packed_str', 'application/octet-stream'),
+    'mvt': ('iter_tile_as_mvt_str', 'application/vnd.mapbox-vector-tile'),
+}
 
 @view_config(route_name='home', renderer='templates/mytemplate.pt')
 def my_view(request):
     return {'one': one, 'project': 'thesis'}
 
+def parse_cluster_request(request, layer=None):
+    """ Parse and validate the strategy, format, bbox and grid_size params of
+        a cluster request. Raises HTTPBadRequest if any of them are invalid.
+
+        The bbox and grid size are canonicalised (see
+        GriddedMappablePoint.canonicalise_bbox) to the layer's grid sizes, so
+        that near identical viewports share cached responses.
+    """
+    strategy, format, grid_size = parse_cluster_params(request)
+
+    bbox, grid_size = canonicalise_cluster_bbox(
+        strategy,
+        request.params.get('bbox', '-180,-90,180,90'),
+        grid_size,
+        layer
+    )
+
+    return strategy, format, { 'bbox': bbox, 'grid_size': grid_size }
+
+def parse_cluster_params(request):
+    """ Parse and validate the strategy, format and grid_size params of a
+        cluster request (see parse_cluster_request)
+    """
+    strategy_name = request.params.get('strategy', DEFAULT_STRATEGY)
+    strategy = MappablePoint.get_strategy(strategy_name)
+    if strategy is None:
+        raise HTTPBadRequest('Unknown strategy: %s' % strategy_name)
+
+    format = request.params.get('format', 'geojson')
+    if format not in CLUSTER_FORMATS:
+        raise HTTPBadRequest('Unknown format: %s' % format)
+
+    grid_size = request.params.get('grid_size')
+    if grid_size != None:
+        try:
+            grid_size = float(grid_size)
+        except ValueError:
+            raise HTTPBadRequest('Invalid grid_size: %s' % grid_size)
+
+        if grid_size < 0:
+            raise HTTPBadRequest('Invalid grid_size: %s' % grid_size)
+
+    return strategy, format, grid_size
+
+def canonicalise_cluster_bbox(strategy, bbox, grid_size, layer=None):
+    """ The canonical (bbox, grid_size) of a cluster request's bbox param (see
+        parse_cluster_request). Raises HTTPBadRequest if the bbox is invalid.
+    """
+    # Strategies that don't grid are still canonicalised to the standard grid
+    gridded_strategy = strategy if issubclass(strategy, GriddedMappablePoint) else GriddedMappablePoint
+
+    bbox, grid_size = gridded_strategy.canonicalise_bbox(bbox, grid_size, layer)
+    if bbox == None:
+        raise HTTPBadRequest('Invalid bbox, expected: w,s,e,n')
+
+    return bbox, grid_size
+
+def stream_clusters(strategy, iter_method_name, layer_id, *args, **kwargs):
+    """ Generate the response body for a cluster request, from the strategy's
+        iter_method_name(layer, *args, **kwargs) generator.
+
+        The body is iterated by the WSGI server after the view (and its
+        request transaction) has finished, so the query runs in a
+        transaction of its own.
+    """
+    with transaction.manager:
+        layer = DBSession.query(Layer).get(layer_id)
+        for chunk in getattr(strategy, iter_method_name)(layer, *args, **kwargs):
+            if isinstance(chunk, unicode):
+                chunk = chunk.encode('utf-8')
+            yield chunk
+
+@view_config(route_name='clusters')
+def clusters_view(request):
+    """ The clusters of a layer within a bbox, as GeoJSON, WKT, TWKB or packed.
+
+        Takes the following params:
+            * bbox : w,s,e,n (defaults to the whole world)
+            * grid_size : The grid size to cluster to (optional)
+            * format : geojson, wkt, twkb or packed (defaults to geojson)
+            * strategy : The MappablePoint strategy class name
+    """
+    layer = get_layer(request)
+    strategy, format, kwargs = parse_cluster_request(request, layer)
+    encoding = negotiate_encoding(request)
+
+    iter_method_name, content_type = CLUSTER_FORMATS[format]
+
+    ViewportAccess.record(strategy, layer, format, **kwargs)
+
+    if cluster_cache_enabled():
+        # Hot viewports are served whole (and precompressed) from the cluster cache
+        body = strategy.get_points_as_encoded_str(layer, format, encoding, **kwargs)
+        return encoded_response(content_type, encoding, body=body)
+
+    return encoded_response(
+        content_type, encoding,
+        app_iter=stream_clusters(strategy, iter_method_name, layer.id, **kwargs)
+    )
+
+@view_config(route_name='layers_clusters')
+def layers_clusters_view(request):
+    """ The clusters of many layers within a bbox, e.g. the overlays of a map,
+        in a single request. The strategy queries the layers together where
+        it can.
+
+        Takes the params of clusters_view (format is geojson or wkt), and:
+            * layers : The comma separated names of the layers
+
+        Responds with a JSON object of each layer's GeoJSON FeatureCollection
+        (or WKT GEOMETRYCOLLECTION string), by layer name.
+    """
+    layers = get_layers(request)
+    strategy, format, kwargs = parse_cluster_request(request)
+    if format not in BATCH_FORMATS:
+        raise HTTPBadRequest('Unsupported format for many layers: %s' % format)
+
+    serialiser_name, is_json = BATCH_FORMATS[format]
+    serialiser = getattr(strategy, serialiser_name)
+
+    # The request only reads, so its connection can go back to the pool while
+    # the layers are queried (fanned out over connections of their own, by
+    # some strategies). The layers' attributes stay loaded.
+    DBSession.close()
+
+    results = strategy.get_layers_points(layers, format, **kwargs)
+
+    documents = []
+    for layer in layers:
+        document = ''.join(serialiser(results[layer.id]))
+        if not is_json:
+            document = json.dumps(document)
+        documents.append('%s: %s' % (json.dumps(layer.name), document))
+
+    body = '{' + ', '.join(documents) + '}'
+    return encoded_response('application/json', negotiate_encoding(request), body=body)
+
+@view_config(route_name='bboxes_clusters')
+def bboxes_clusters_view(request):
+    """ The clusters of a layer within each of many bboxes, e.g. a viewport
+        and its neighbours (to prefetch as the map pans) in a single request.
+        The strategy queries the bboxes together where it can.
+
+        Takes the params of clusters_view (format is geojson or wkt), but
+        rather than bbox:
+            * bboxes : The semicolon separated bboxes, w,s,e,n;w,s,e,n
+
+        Responds with a JSON array of each bbox's GeoJSON FeatureCollection
+        (or WKT GEOMETRYCOLLECTION string), in the order of the bboxes.
+    """
+    layer = get_layer(request)
+    strategy, format, grid_size = parse_cluster_params(request)
+    if format not in BATCH_FORMATS:
+        raise HTTPBadRequest('Unsupported format for many bboxes: %s' % format)
+
+    bbox_params = [bbox for bbox in request.params.get('bboxes', '').split(';') if bbox.strip()]
+    if not bbox_params:
+        raise HTTPBadRequest('No bboxes, expected: bboxes=w,s,e,n;w,s,e,n')
+    if len(bbox_params) > MAX_BATCH_BBOXES:
+        raise HTTPBadRequest('Too many bboxes, the most is %i' % MAX_BATCH_BBOXES)
+
+    bboxes = []
+    grid_sizes = []
+    for bbox_param in bbox_params:
+        bbox, bbox_grid_size = canonicalise_cluster_bbox(strategy, bbox_param, grid_size, layer)
+        bboxes.append(bbox)
+        grid_sizes.append(bbox_grid_size)
+
+    serialiser_name, is_json = BATCH_FORMATS[format]
+    serialiser = getattr(strategy, serialiser_name)
+
+    documents = []
+    for clusters in strategy.get_bboxes_points(layer, bboxes, format, grid_sizes):
+        document = ''.join(serialiser(clusters))
+        if not is_json:
+            document = json.dumps(document)
+        documents.append(document)
+
+    body = '[' + ', '.join(documents) + ']'
+    return encoded_response('application/json', negotiate_encoding(request), body=body)
+
+@view_config(route_name='tile')
+def tile_view(request):
+    """ The cached clusters of a layer's z/x/y web map tile, as GeoJSON, WKT,
+        TWKB, packed or a Mapbox Vector Tile.
+        Tiles are the same for every client, so they're marked as cacheable.
+    """
+    format = request.matchdict['format']
+    if format not in TILE_FORMATS:
+        raise HTTPNotFound('Unknown format: %s' % format)
+
+    try:
+        zoom, x, y = [int(request.matchdict[key]) for key in ('z', 'x', 'y')]
+    except ValueError:
+        raise HTTPNotFound('Invalid tile')
+
+    if not TiledCachedMappablePoint.is_valid_tile(zoom, x, y):
+        raise HTTPNotFound('Invalid tile')
+
+    layer = get_layer(request)
+    encoding = negotiate_encoding(request)
+
+    iter_method_name, content_type = TILE_FORMATS[format]
+
+    if cluster_cache_enabled():
+        body = TiledCachedMappablePoint.get_tile_as_encoded_str(layer, zoom, x, y, format, encoding)
+        response = encoded_response(content_type, encoding, body=body)
+    else:
+        response = encoded_response(
+            content_type, encoding,
+            app_iter=stream_clusters(TiledCachedMappablePoint, iter_method_name, layer.id, zoom, x, y)
+        )
+
+    response.cache_control.public = True
+    response.cache_control.max_age = TiledCachedMappablePoint.TILE_CACHE_MAX_AGE
+    return response
+
+def encoded_response(content_type, encoding, body=None, app_iter=None):
+    """ A response with the body, or with the streamed app_iter, already
+        compressed with the content encoding (if not None)
+    """
+    if body != None:
+        if isinstance(body, unicode):
+            body = body.encode('utf-8')
+        response = Response(content_type=content_type, body=body)
+    else:
+        if encoding != None:
+            app_iter = iter_compress(app_iter, encoding)
+
+        # Passing the app_iter to the constructor leaves the Content-Length
+        # unset, so the body is streamed.
+        response = Response(content_type=content_type, app_iter=app_iter)
+
+    if encoding != None:
+        response.content_encoding = encoding
+
+    # The body depends on the Accept-Encoding of the request
+    response.vary = ('Accept-Encoding',)
+    return response
+
+def get_layer(request):
+    """ The layer named by the request's route. Raises HTTPNotFound if there
+        is no such layer.
+    """
+    layer = DBSession.query(Layer).filter_by(name=request.matchdict['layer']).first()
+    if layer == None:
+        raise HTTPNotFound('Unknown layer: %s' % request.matchdict['layer'])
+
+    return layer
+
+def get_layers(request):
+    """ The layers named by the request's layers param, in order. Raises
+        HTTPBadRequest if there are none (or too many), and HTTPNotFound if
+        any of them don't exist.
+    """
+    names = [name.strip() for name in request.params.get('layers', '').split(',') if name.strip()]
+    names = MappablePoint.uniq_list(names)
+
+    if not names:
+        raise HTTPBadRequest('No layers, expected: layers=name,name')
+    if len(names) > MAX_BATCH_LAYERS:
+        raise HTTPBadRequest('Too many layers, the most is %i' % MAX_BATCH_LAYERS)
+
+    layers = dict(
+        (layer.name, layer) for layer in DBSession.query(Layer).filter(Layer.name.in_(names))
+    )
+
+    for name in names:
+        if name not in layers:
+            raise HTTPNotFound('Unknown layer: %s' % name)
+
+    return [layers[name] for name in names]
+
 conn_err_msg = """\
 Pyramid is having a problem using your SQL database.  The problem
 might be caused by one of the following things:
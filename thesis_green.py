@@ -0,0 +1,23 @@
+""" The serve_green script (see thesis.scripts.serve_green).
+
+    gevent must patch the standard library before thesis is imported: the
+    DBSession registry and the transaction manager are thread locals, made on
+    import, and if they're made unpatched every greenlet shares the one
+    session (and its connection). So this module lives outside of the thesis
+    package, and patches the standard library, and psycopg2, on import.
+"""
+import sys
+
+try:
+    from gevent import monkey
+    monkey.patch_all()
+
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+except ImportError, e:
+    sys.exit("serve_green: needs gevent and psycogreen (%s)" % e)
+
+from thesis.scripts.serve_green import main
+
+if __name__ == '__main__':
+    main()